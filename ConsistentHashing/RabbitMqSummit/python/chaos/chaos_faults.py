@@ -0,0 +1,109 @@
+import os
+import asyncio
+import standin_control
+
+# The failures a chaos scenario injects, for the two clusters the scripts run
+# against. Every injector has the same coroutines:
+#   kill(node)              the node's RabbitMQ dies, its connections drop
+#   start(node)             a killed node comes back
+#   restart(node, down_sec) kill, down_sec later start
+#   partition(node)         the node is cut off from the rest of the cluster
+#   heal(node)              the partition ends
+#   latency(node, ms)       slows the node's network down, 0 restores it
+#   restore()               undoes whatever the scenario left behind
+#
+# StandInFaults drives the stand-in broker (../standin) over its control API. A
+# stand-in partition cuts the node off from the clients too, so they have to
+# fail over, and any latency in ms can be set.
+# BlockadeFaults runs the ../cluster scripts and blockade. A blockade partition
+# separates the node from the other nodes only, with cluster_partition_handling
+# ignore both sides carry on. Latency is blockade slow, with the parameters of
+# blockade.yml whatever ms is.
+
+CLUSTER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cluster")
+
+class StandInFaults:
+    # its clients only notice a partition through heartbeats
+    partition_cuts_clients = True
+
+    def __init__(self, mgmt_ip, node_names):
+        self.mgmt_ip = mgmt_ip
+        self.node_names = node_names
+
+    # the control API is plain blocking requests, kept off the event loop
+    async def call(self, function, *args):
+        await asyncio.get_running_loop().run_in_executor(None, function, self.mgmt_ip, *args)
+
+    async def kill(self, node):
+        await self.call(standin_control.kill_node, node)
+
+    async def start(self, node):
+        await self.call(standin_control.start_node, node)
+
+    async def restart(self, node, down_sec=0):
+        await self.call(standin_control.restart_node, node, down_sec)
+
+    async def partition(self, node):
+        await self.call(standin_control.pause_node, node)
+
+    async def heal(self, node):
+        await self.call(standin_control.resume_node, node)
+
+    async def latency(self, node, ms):
+        await self.call(standin_control.set_latency, node, ms)
+
+    async def restore(self):
+        for node in self.node_names:
+            await self.start(node)
+            await self.heal(node)
+            await self.latency(node, 0)
+
+
+class BlockadeFaults:
+    partition_cuts_clients = False
+
+    def __init__(self, node_names):
+        self.node_names = node_names
+        self.killed = set()
+
+    async def run(self, *command):
+        print("Running: " + " ".join(command))
+        process = await asyncio.create_subprocess_exec(*command, cwd=CLUSTER_DIR)
+        if await process.wait() != 0:
+            print(f"{' '.join(command)} exited with {process.returncode}")
+
+    async def kill(self, node):
+        await self.run("bash", "kill-node.sh", node)
+        self.killed.add(node)
+
+    async def start(self, node):
+        await self.run("blockade", "start", node)
+        self.killed.discard(node)
+        # a restarted container can come back with another address
+        cache = os.path.join(CLUSTER_DIR, "..", "client", ".node-ips.json")
+        if os.path.exists(cache):
+            os.remove(cache)
+
+    async def restart(self, node, down_sec=0):
+        if down_sec > 0:
+            await self.kill(node)
+            await asyncio.sleep(down_sec)
+            await self.start(node)
+        else:
+            await self.run("bash", "restart-node.sh", node, node)
+
+    async def partition(self, node):
+        others = [name for name in self.node_names if name != node]
+        await self.run("blockade", "partition", node, ",".join(others))
+
+    async def heal(self, node):
+        await self.run("blockade", "join")
+
+    async def latency(self, node, ms):
+        await self.run("blockade", "slow" if ms > 0 else "fast", node)
+
+    async def restore(self):
+        await self.run("blockade", "join")
+        await self.run("blockade", "fast", "--all")
+        for node in list(self.killed):
+            await self.start(node)
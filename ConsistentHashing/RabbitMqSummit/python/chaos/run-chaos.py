@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import asyncio
+import datetime
+from array import array
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "standin"))
+from command_args import get_args, get_optional_arg
+from rabbit_client import (resolve_node_list, cluster_node_names, split_address, get_node_ip, connect_to_cluster,
+                           run_publishers, Consumer, ConnectionLost, heartbeat_detection_sec)
+from failover import FailoverStats
+from token_bucket import TokenBucket
+from message_template import MessageTemplate
+from order_verifier import OrderVerifier
+from chaos_faults import StandInFaults, BlockadeFaults
+import management_api
+
+# python run-chaos.py [--target standin|blockade] [--scenarios scenarios.json] [--scenario kill-master,...]
+#                     [--cluster-size 3] [--rep-factor 2] [--interval-sec 1] [--recovery-pct 90]
+#                     [--output chaos-results.json]
+#
+# Runs failure scenarios against the cluster while producers and consumers run,
+# the scripted version of running kill-node.sh and restart-node.sh by hand
+# during a demo. For every scenario it
+#   - declares an x-consistent-hash exchange and its queues, purged
+#   - starts --producers connections publishing "k<key>=<n>" messages with
+#     n = 1, 2, 3... per key at --rate msg/s, with failover and republish of
+#     unconfirmed messages (rabbit_client.run_publishers), and one consumer
+#     per queue that resubscribes wherever it can after a failover
+#   - injects the scenario's events on schedule (chaos_faults.py)
+#   - records confirmed and consumed messages per --interval-sec
+# and reports per event the throughput dip below the rate before the first
+# event and the time until it was back to --recovery-pct of it, and for the
+# whole scenario the duplicates, reordered (a lower n after a higher one of the
+# same key) and lost messages (published, confirmed or not, and never
+# consumed). Results go to --output as JSON.
+# For kill, restart and partition events it also reports the detection time,
+# from injecting the event until the connections of the clients on the node
+# closed. It is reported on its own because the recovery time includes it.
+#
+# Scenarios are a JSON list, see scenarios.json. Besides name, duration_sec and
+# events ({"at": sec, "action": kill|start|restart|partition|heal|latency,
+# "node": name}, with down_sec for restart and ms for latency) a scenario can
+# set settle_sec, rate, keys, queues, producers and prefetch, and a victim,
+# a node name or "master:<queue>" resolved when the scenario starts, which
+# events refer to as "victim".
+#
+# Against the stand-in broker start run-standin.py with --heartbeat 2 or so.
+# Clients only notice a partitioned node through heartbeats, and pika checks
+# for them every heartbeat + 5 seconds, so with --heartbeat 2 a partition is
+# noticed 7 to 14s after it starts (rabbit_client.heartbeat_detection_sec).
+# The runner reads the heartbeat negotiated with the cluster and warns about
+# partitions that end before their clients can be sure to have noticed them.
+
+args = get_args(sys.argv)
+target = get_optional_arg(args, "--target", "standin")
+scenarios_file = get_optional_arg(args, "--scenarios",
+                                  os.path.join(os.path.dirname(os.path.abspath(__file__)), "scenarios.json"))
+selected = get_optional_arg(args, "--scenario", "")
+node_count = int(get_optional_arg(args, "--cluster-size", "3"))
+rep_factor = int(get_optional_arg(args, "--rep-factor", "2"))
+interval_sec = float(get_optional_arg(args, "--interval-sec", "1"))
+recovery_pct = float(get_optional_arg(args, "--recovery-pct", "90"))
+between_sec = float(get_optional_arg(args, "--between-sec", "5"))
+output = get_optional_arg(args, "--output", "chaos-results.json")
+
+if target not in ["standin", "blockade"]:
+    print(f"Unknown target {target}, use standin or blockade")
+    exit(1)
+
+DEFAULTS = {"duration_sec": 30, "settle_sec": 10, "rate": 5000, "keys": 100, "queues": 6,
+            "producers": 2, "prefetch": 100, "victim": "rabbitmq1", "events": []}
+ACTIONS = ["kill", "start", "restart", "partition", "heal", "latency"]
+# the events that clients connected to the node have to notice
+DETECTED_ACTIONS = ["kill", "restart", "partition"]
+
+EXCHANGE = "chaos-hash-ex"
+QUEUE_PREFIX = "chaos-"
+
+node_names = cluster_node_names(node_count)
+properties = MessageTemplate(content_type='text/plain', delivery_mode=2)
+
+def queue_name(index):
+    return f"{QUEUE_PREFIX}{index + 1:03d}"
+
+
+# messages per interval since the scenario started
+class Timeline:
+
+    def __init__(self, started):
+        self.started = started
+        self.confirmed = list()
+        self.consumed = list()
+
+    def add(self, series, count):
+        index = int((time.monotonic() - self.started) / interval_sec)
+        while len(series) <= index:
+            series.append(0)
+        series[index] += count
+
+    def rates(self, series, length):
+        return [(series[i] if i < len(series) else 0) / interval_sec for i in range(length)]
+
+
+class ScenarioRun:
+
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.key_names = [f"k{key}" for key in range(scenario["keys"])]
+        self.key_prefixes = [f"k{key}=".encode('utf-8') for key in range(scenario["keys"])]
+        self.last_published = array('q', [0] * scenario["keys"])
+        self.verifier = OrderVerifier()
+        self.timeline = None
+        self.stopped = False
+        self.confirmed = 0
+        self.nacked = 0
+        self.consumed = 0
+        self.events = list()
+        # every client's current node and when its connections closed, in
+        # seconds since the scenario started
+        self.connected = dict()
+        self.closed_at = dict()
+        self.node_of_address = dict()
+
+    def connected_to(self, client, connection, node):
+        self.connected[client] = node
+        connection.closed.add_done_callback(lambda _: self.closed_at.setdefault(client, []).append(
+            time.monotonic() - self.timeline.started))
+
+    def on_confirm(self, acked, confirmed):
+        if acked:
+            self.confirmed += confirmed
+            self.timeline.add(self.timeline.confirmed, confirmed)
+        else:
+            self.nacked += confirmed
+
+    def on_delivery(self, body):
+        self.consumed += 1
+        self.timeline.add(self.timeline.consumed, 1)
+        self.verifier.verify(body)
+
+
+# the keys of one producer channel published round robin, the next value of a
+# key is only taken once the message is published
+class KeyPublisher:
+
+    def __init__(self, run, keys, client):
+        self.run = run
+        self.keys = keys
+        self.client = client
+        self.next = 0
+
+    async def publish_messages(self, publisher):
+        run = self.run
+        connection = publisher.connection
+        run.connected_to(self.client, connection, run.node_of_address[(connection.host, connection.port)])
+        while not run.stopped:
+            key = self.keys[self.next]
+            value = run.last_published[key] + 1
+            await publisher.publish(exchange=EXCHANGE,
+                                    routing_key=run.key_names[key],
+                                    body=run.key_prefixes[key] + str(value).encode('utf-8'),
+                                    properties=properties)
+            run.last_published[key] = value
+            self.next += 1
+            if self.next == len(self.keys):
+                self.next = 0
+
+async def produce(run, nodes, index, rate_limiter):
+    keys = list(range(index, run.scenario["keys"], run.scenario["producers"]))
+    key_publisher = KeyPublisher(run, keys, f"producer {index + 1}")
+    return await run_publishers(nodes, node_names, index % len(nodes), [key_publisher.publish_messages],
+                                on_confirm=run.on_confirm, rate_limiter=rate_limiter)
+
+# consumes one queue until cancelled, subscribing again after every lost
+# connection or failover cancel
+async def consume(run, nodes, queue, start_index):
+    while True:
+        connection, start_index = await connect_to_cluster(nodes, node_names, start_index)
+        run.connected_to(f"consumer {queue}", connection, node_names[start_index])
+        try:
+            consumer = await Consumer(connection, queue, run.scenario["prefetch"],
+                                      arguments={"x-cancel-on-ha-failover": True}).open()
+            async for delivery in consumer:
+                run.on_delivery(delivery.body)
+                if delivery.channel.is_open:
+                    consumer.ack(delivery.delivery_tag)
+            print(f"Consumer of {queue}: {consumer.close_reason}")
+        except ConnectionLost as ex:
+            print(f"Consumer of {queue}: {ex}")
+        finally:
+            await connection.close()
+
+async def declare(nodes, scenario):
+    mgmt_ip, _ = split_address(get_node_ip("rabbitmq1"))
+    management_api.put_ha_policy(mgmt_ip, rep_factor)
+    connection, _ = await connect_to_cluster(nodes, node_names, 0)
+    chan = await connection.channel()
+    await connection.rpc(chan, chan.exchange_declare, exchange=EXCHANGE, exchange_type='x-consistent-hash', durable=True)
+    for index in range(scenario["queues"]):
+        await connection.rpc(chan, chan.queue_declare, queue=queue_name(index), durable=True)
+        await connection.rpc(chan, chan.queue_bind, queue=queue_name(index), exchange=EXCHANGE, routing_key="10")
+        await connection.rpc(chan, chan.queue_purge, queue=queue_name(index))
+    heartbeat = connection.heartbeat
+    await connection.close()
+    return heartbeat
+
+def resolve_victim(victim):
+    if not victim.startswith("master:"):
+        return victim
+    mgmt_ip, _ = split_address(get_node_ip("rabbitmq1"))
+    queue = management_api.get_queues(mgmt_ip, columns="name,node")[victim[len("master:"):]]
+    return queue["node"].split("@")[-1]
+
+async def inject(faults, run, event, victim):
+    await asyncio.sleep(max(0, run.timeline.started + event["at"] - time.monotonic()))
+    node = victim if event["node"] == "victim" else event["node"]
+    action = event["action"]
+    print(f"--- {event['at']}s: {action} {node}")
+    started_at = time.monotonic() - run.timeline.started
+    clients = [client for client, client_node in run.connected.items() if client_node == node]
+    if action == "restart":
+        await faults.restart(node, event.get("down_sec", 0))
+    elif action == "latency":
+        await faults.latency(node, event.get("ms", 0))
+    else:
+        await getattr(faults, action)(node)
+    run.events.append({"at": event["at"], "action": action, "node": node,
+                       "injected_at": round(time.monotonic() - run.timeline.started, 2),
+                       "started_at": started_at, "clients": clients})
+
+async def monitor(run):
+    index = 0
+    while True:
+        await asyncio.sleep(max(0, run.timeline.started + (index + 1) * interval_sec - time.monotonic()))
+        confirmed = run.timeline.rates(run.timeline.confirmed, index + 1)[index]
+        consumed = run.timeline.rates(run.timeline.consumed, index + 1)[index]
+        print(f"{index * interval_sec:6.1f}s confirmed {confirmed:8.0f}/s consumed {consumed:8.0f}/s")
+        index += 1
+
+# the dip below baseline and the time to get back to recovery_pct of it, from
+# the event until the next one or the end of the series
+def event_impact(rates, baseline, start, end):
+    window = rates[start:end]
+    if not window or baseline <= 0:
+        return {"dip_pct": None, "recovery_sec": None}
+    lowest = min(window)
+    threshold = baseline * recovery_pct / 100
+    recovery_sec = None
+    if lowest >= threshold:
+        recovery_sec = 0
+    else:
+        for offset in range(window.index(lowest), len(window)):
+            if window[offset] >= threshold:
+                recovery_sec = offset * interval_sec
+                break
+    return {"dip_pct": round(max(0, 1 - lowest / baseline) * 100, 1), "recovery_sec": recovery_sec}
+
+# the time from starting to inject the event until each client connected to the
+# node noticed, counting only connections that closed before end_sec (the next
+# event), so a partition healed before a client noticed leaves it undetected
+def event_detection(run, event, end_sec):
+    delays = list()
+    for client in event["clients"]:
+        closed = [at for at in run.closed_at.get(client, []) if event["started_at"] <= at < end_sec]
+        if closed:
+            delays.append(closed[0] - event["started_at"])
+    return {"clients": len(event["clients"]), "noticed": len(delays),
+            "first_sec": round(min(delays), 2) if delays else None,
+            "last_sec": round(max(delays), 2) if delays else None}
+
+def analyse(run, stats, in_queues, heartbeat):
+    scenario = run.scenario
+    length = int((scenario["duration_sec"] + scenario["settle_sec"]) / interval_sec)
+    confirmed = run.timeline.rates(run.timeline.confirmed, length)
+    consumed = run.timeline.rates(run.timeline.consumed, length)
+
+    # the steady rate before the first event, without the first interval's start up
+    first_event = min([event["at"] for event in scenario["events"]] + [scenario["duration_sec"]])
+    steady = range(1, max(2, int(first_event / interval_sec)))
+    baseline = {"confirmed": sum(confirmed[i] for i in steady) / len(steady),
+                "consumed": sum(consumed[i] for i in steady) / len(steady)}
+
+    events = list()
+    starts = [int(event["at"] / interval_sec) for event in run.events] + [int(scenario["duration_sec"] / interval_sec)]
+    ends_sec = [event["started_at"] for event in run.events[1:]] + [scenario["duration_sec"]]
+    for event, start, end, end_sec in zip(run.events, starts, starts[1:], ends_sec):
+        result = {key: value for key, value in event.items() if key not in ["started_at", "clients"]}
+        result["confirmed"] = event_impact(confirmed, baseline["confirmed"], start, end)
+        result["consumed"] = event_impact(consumed, baseline["consumed"], start, end)
+        if event["action"] in DETECTED_ACTIONS:
+            result["detection"] = event_detection(run, event, end_sec)
+        events.append(result)
+
+    _, jump_forward, jump_back, duplicates = run.verifier.totals()
+    published = sum(run.last_published)
+    lost = sum(run.verifier.missing(name.encode('utf-8'), run.last_published[key])
+               for key, name in enumerate(run.key_names))
+    return {"name": scenario["name"],
+            "target": target,
+            "settings": {key: scenario[key] for key in DEFAULTS if key != "events"},
+            "heartbeat_sec": heartbeat,
+            "detection_limit_sec": heartbeat_detection_sec(heartbeat),
+            "baseline": baseline,
+            "events": events,
+            "published": published,
+            "confirmed": run.confirmed,
+            "nacked": run.nacked,
+            "consumed": run.consumed,
+            "duplicates": duplicates,
+            "reordered": jump_back,
+            "lost": lost,
+            "left_in_queues": in_queues,
+            "failover": stats.to_dict(),
+            "timeline": [{"t": round(i * interval_sec, 2), "confirmed": confirmed[i], "consumed": consumed[i]}
+                         for i in range(length)]}
+
+def print_result(result):
+    print(f"=== {result['name']} on {result['target']}: baseline confirmed {result['baseline']['confirmed']:.0f}/s "
+          f"consumed {result['baseline']['consumed']:.0f}/s")
+    for event in result["events"]:
+        line = f"  {event['at']}s {event['action']} {event['node']}:"
+        for series in ["confirmed", "consumed"]:
+            impact = event[series]
+            recovery = "not recovered" if impact["recovery_sec"] is None else f"recovered in {impact['recovery_sec']}s"
+            line += f" {series} dip {impact['dip_pct']}% {recovery};"
+        detection = event.get("detection")
+        if detection is not None and detection["clients"] > 0:
+            line += f" noticed by {detection['noticed']} of {detection['clients']} clients"
+            if detection["noticed"] > 0:
+                line += f" in {detection['first_sec']}-{detection['last_sec']}s"
+        print(line)
+    print(f"  Published {result['published']} confirmed {result['confirmed']} consumed {result['consumed']} "
+          f"duplicates {result['duplicates']} reordered {result['reordered']} lost {result['lost']} "
+          f"left in queues {result['left_in_queues']}")
+    print("  " + FailoverStats.from_dict(result["failover"]).summary())
+
+# a partition that is healed before the clients on the node have noticed it
+# measures nothing but the heartbeat, warns about those
+def check_partitions(faults, scenario, heartbeat):
+    if not faults.partition_cuts_clients:
+        return
+    limit = heartbeat_detection_sec(heartbeat)
+    events = scenario["events"]
+    for index, event in enumerate(events):
+        if event["action"] != "partition":
+            continue
+        heal = [later["at"] for later in events[index + 1:]
+                if later["node"] == event["node"] and later["action"] in ["heal", "kill", "restart"]]
+        window = min(heal + [scenario["duration_sec"]]) - event["at"]
+        if limit is None:
+            print(f"Warning: heartbeats are off, clients will not notice the partition at {event['at']}s")
+        elif window <= limit:
+            print(f"Warning: the partition at {event['at']}s lasts {window}s, but with a heartbeat of "
+                  f"{heartbeat}s clients can take up to {limit}s to notice it")
+
+async def run_scenario(faults, scenario):
+    run = ScenarioRun(scenario)
+    nodes = resolve_node_list(node_names)
+    run.node_of_address = {split_address(address): name for address, name in zip(nodes, node_names)}
+    heartbeat = await declare(nodes, scenario)
+    victim = resolve_victim(scenario["victim"])
+    print(f"=== Scenario {scenario['name']}, victim {victim}, heartbeat {heartbeat}s")
+    check_partitions(faults, scenario, heartbeat)
+
+    run.timeline = Timeline(time.monotonic())
+    rate_limiter = TokenBucket(scenario["rate"]) if scenario["rate"] > 0 else None
+    consumers = [asyncio.ensure_future(consume(run, nodes, queue_name(index), index % len(nodes)))
+                 for index in range(scenario["queues"])]
+    producers = [asyncio.ensure_future(produce(run, nodes, index, rate_limiter))
+                 for index in range(scenario["producers"])]
+    injections = [asyncio.ensure_future(inject(faults, run, event, victim)) for event in scenario["events"]]
+    monitoring = asyncio.ensure_future(monitor(run))
+
+    await asyncio.sleep(scenario["duration_sec"])
+    run.stopped = True
+    await asyncio.gather(*injections, return_exceptions=True)
+    # producers still failing over at the end get the settle time to finish
+    done, pending = await asyncio.wait(producers, timeout=scenario["settle_sec"])
+    for producer in pending:
+        producer.cancel()
+    stats = FailoverStats()
+    for producer in done:
+        if producer.exception() is None:
+            stats.merge(producer.result())
+    await asyncio.sleep(max(0, run.timeline.started + scenario["duration_sec"] + scenario["settle_sec"] - time.monotonic()))
+    for task in consumers + [monitoring]:
+        task.cancel()
+    await asyncio.gather(*consumers, monitoring, return_exceptions=True)
+
+    mgmt_ip, _ = split_address(get_node_ip("rabbitmq1"))
+    queues = management_api.get_queues(mgmt_ip, columns="name,messages")
+    in_queues = sum(queue.get("messages", 0) for name, queue in queues.items() if name.startswith(QUEUE_PREFIX))
+    await faults.restore()
+    return analyse(run, stats, in_queues, heartbeat)
+
+def load_scenarios():
+    with open(scenarios_file) as f:
+        scenarios = [dict(DEFAULTS, **scenario) for scenario in json.load(f)]
+    if selected:
+        names = selected.split(",")
+        scenarios = [scenario for scenario in scenarios if scenario["name"] in names]
+    for scenario in scenarios:
+        for event in scenario["events"]:
+            if event["action"] not in ACTIONS:
+                print(f"Unknown action {event['action']} in scenario {scenario['name']}, use one of {', '.join(ACTIONS)}")
+                exit(1)
+    return scenarios
+
+async def main():
+    scenarios = load_scenarios()
+    if target == "standin":
+        mgmt_ip, _ = split_address(get_node_ip("rabbitmq1"))
+        faults = StandInFaults(mgmt_ip, node_names)
+    else:
+        faults = BlockadeFaults(node_names)
+
+    results = {"target": target, "started": datetime.datetime.now().isoformat(), "scenarios": list()}
+    for number, scenario in enumerate(scenarios):
+        if number > 0:
+            await asyncio.sleep(between_sec)
+        result = await run_scenario(faults, scenario)
+        results["scenarios"].append(result)
+        print_result(result)
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    for result in results["scenarios"]:
+        print_result(result)
+
+asyncio.run(main())
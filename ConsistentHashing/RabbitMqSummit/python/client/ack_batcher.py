@@ -0,0 +1,86 @@
+import time
+
+# Coalesces consumer acks into one basic.ack with multiple=True per batch.
+# Acking multiple=True covers every unacked delivery up to the tag, so it must
+# only be given tags once every earlier delivery on the channel has been handled.
+# A batch is sent once batch_size acks are pending (0 means no count limit) or
+# the oldest pending ack is interval_ms old. With batch_size 1 and no interval
+# every ack is sent straight away.
+class AckBatcher:
+
+    def __init__(self, channel, batch_size=1, interval_ms=0):
+        self.channel = channel
+        self.batch_size = batch_size
+        self.interval_sec = interval_ms / 1000
+        self.pending = 0
+        self.last_tag = 0
+        self.first_pending_time = 0
+        self.acked = 0
+        self.ack_frames = 0
+        self.discarded = 0
+
+    def is_batching(self):
+        return self.batch_size != 1 or self.interval_sec > 0
+
+    def ack(self, delivery_tag):
+        if not self.is_batching():
+            if not self.channel.is_open:
+                self.discarded += 1
+                return
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+            self.acked += 1
+            self.ack_frames += 1
+            return
+
+        if self.pending == 0:
+            self.first_pending_time = time.monotonic()
+        self.pending += 1
+        self.last_tag = delivery_tag
+        if self.batch_size > 0 and self.pending >= self.batch_size:
+            self.flush()
+        elif self.interval_sec > 0:
+            self.tick()
+
+    # acks count deliveries up to and including delivery_tag in one go
+    def ack_multiple(self, delivery_tag, count):
+        if not self.is_batching():
+            if not self.channel.is_open:
+                self.discarded += count
+                return
+            self.channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+            self.acked += count
+            self.ack_frames += 1
+            return
+
+        if self.pending == 0:
+            self.first_pending_time = time.monotonic()
+        self.pending += count
+        self.last_tag = delivery_tag
+        if self.batch_size > 0 and self.pending >= self.batch_size:
+            self.flush()
+        elif self.interval_sec > 0:
+            self.tick()
+
+    # called periodically to send a partial batch once the interval has passed
+    def tick(self):
+        if self.pending > 0 and time.monotonic() - self.first_pending_time >= self.interval_sec:
+            self.flush()
+
+    def flush(self):
+        if self.pending == 0:
+            return
+        if not self.channel.is_open:
+            self.discard()
+            return
+        self.channel.basic_ack(delivery_tag=self.last_tag, multiple=True)
+        self.acked += self.pending
+        self.ack_frames += 1
+        self.pending = 0
+
+    # the channel has closed so the broker will redeliver anything not yet acked
+    def discard(self):
+        self.discarded += self.pending
+        self.pending = 0
+
+    def stats(self):
+        return f"Acked: {self.acked} in {self.ack_frames} frames, discarded on channel close: {self.discarded}"
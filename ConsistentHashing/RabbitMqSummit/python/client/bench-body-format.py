@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+import sys
+import time
+import pika
+from pika import spec, frame
+from command_args import get_args, get_optional_arg
+from order_verifier import OrderVerifier
+from body_format import TEXT_CONTENT_TYPE, BINARY_CONTENT_TYPE, STATE_UPDATE, encode_state_update
+
+# Compares the state update body formats:
+#   parse cost per message, for
+#     text str     the print mode of output-consumer.py: decode, split('='), int()
+#     text bytes   the verify mode: bytes.partition and int(), no str
+#     text stamped the text equivalent of the binary body: "key=seq;publish_ns;producer"
+#     binary       struct.unpack_from on the body
+#     binary view  struct.iter_unpack over one buffer of many bodies, no body objects at all
+#   and the bytes on the wire per message: the method, content header and body
+#   frames of a persistent publish with a correlation id
+
+args = get_args(sys.argv)
+count = int(get_optional_arg(args, "--msgs", "1000000"))
+key_count = int(get_optional_arg(args, "--keys", "10"))
+runs = int(get_optional_arg(args, "--runs", "3"))
+
+states = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j']
+publish_ns = time.time_ns()
+producer_id = 4242
+
+def key_of(i):
+    return states[i % key_count] if key_count <= len(states) else f"k{i % key_count}"
+
+text_bodies = [f"{key_of(i)}={i // key_count + 1}".encode('utf-8') for i in range(count)]
+stamped_bodies = [f"{key_of(i)}={i // key_count + 1};{publish_ns + i};{producer_id}".encode('utf-8') for i in range(count)]
+binary_bodies = [encode_state_update(i % key_count, i // key_count + 1, publish_ns + i, producer_id) for i in range(count)]
+binary_buffer = b"".join(binary_bodies)
+
+def parse_text_str():
+    for body in text_bodies:
+        parts = str(body, "utf-8").split('=')
+        key = parts[0]
+        value = int(parts[1])
+
+def parse_text_bytes():
+    for body in text_bodies:
+        key, _, value = body.partition(b"=")
+        value = int(value)
+
+def parse_text_stamped():
+    for body in stamped_bodies:
+        key, _, rest = body.partition(b"=")
+        seq, ts, producer = rest.split(b";")
+        seq = int(seq)
+        ts = int(ts)
+        producer = int(producer)
+
+def parse_binary():
+    unpack_from = STATE_UPDATE.unpack_from
+    for body in binary_bodies:
+        key_id, seq, ts, producer = unpack_from(body)
+
+def parse_binary_view():
+    for key_id, seq, ts, producer in STATE_UPDATE.iter_unpack(memoryview(binary_buffer)):
+        pass
+
+def verify_text():
+    verifier = OrderVerifier()
+    for body in text_bodies:
+        verifier.verify(body)
+
+def verify_binary():
+    verifier = OrderVerifier()
+    unpack_from = STATE_UPDATE.unpack_from
+    for body in binary_bodies:
+        key_id, seq, _, _ = unpack_from(body)
+        verifier.verify_value(key_id, seq)
+
+def measure(name, fn):
+    timings = list()
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    print(f"{name:<16} {best * 1e9 / count:8.1f} ns/msg {count / best:12.0f} msg/s")
+
+def wire_bytes(body, content_type):
+    properties = pika.BasicProperties(content_type=content_type,
+                                      delivery_mode=2,
+                                      correlation_id="6f1c0f55-7a0c-4b8e-9d8b-0d5e1b1f3a52")
+    method = frame.Method(1, spec.Basic.Publish(exchange='', routing_key='output-seq'))
+    header = frame.Header(1, len(body), properties)
+    return len(method.marshal()) + len(header.marshal()) + len(frame.Body(1, body).marshal())
+
+print(f"Parsing {count} bodies over {key_count} keys, best of {runs} runs")
+measure("text str", parse_text_str)
+measure("text bytes", parse_text_bytes)
+measure("text stamped", parse_text_stamped)
+measure("binary", parse_binary)
+measure("binary view", parse_binary_view)
+measure("verify text", verify_text)
+measure("verify binary", verify_binary)
+
+print("Bytes per message (body / on the wire incl. method and header frames)")
+for name, body, content_type in [("text", text_bodies[-1], TEXT_CONTENT_TYPE),
+                                 ("text stamped", stamped_bodies[-1], TEXT_CONTENT_TYPE),
+                                 ("binary", binary_bodies[-1], BINARY_CONTENT_TYPE)]:
+    print(f"{name:<16} {len(body):4} / {wire_bytes(body, content_type):4}")
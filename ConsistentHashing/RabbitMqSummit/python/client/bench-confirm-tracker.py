@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+import sys
+import time
+import random
+from command_args import get_args, get_optional_arg
+from confirm_tracker import ConfirmTracker
+
+# Compares confirm handling of the ConfirmTracker with the list based
+# bookkeeping the publishers used before. The broker mostly confirms with
+# multiple=True in batches, with the odd single ack/nack arriving out of order,
+# which is what the confirm stream below reproduces.
+
+def make_confirms(in_flight, batch_size, single_rate):
+    confirms = list()
+    tag = 0
+    while tag < in_flight:
+        upper = min(tag + batch_size, in_flight)
+        if random.uniform(0, 1) < single_rate and upper - tag > 1:
+            # confirm one tag out of order before the batch is confirmed
+            confirms.append((random.randint(tag + 2, upper), False))
+        confirms.append((upper, True))
+        tag = upper
+    return confirms
+
+def run_legacy(in_flight, confirms):
+    pending_messages = list()
+    for tag in range(1, in_flight+1):
+        pending_messages.append(tag)
+
+    start = time.perf_counter()
+    for delivery_tag, multiple in confirms:
+        if multiple == True:
+            messages_to_remove = [item for item in pending_messages if item <= delivery_tag]
+            for val in messages_to_remove:
+                pending_messages.remove(val)
+        else:
+            pending_messages.remove(delivery_tag)
+    return time.perf_counter() - start, len(pending_messages)
+
+def run_tracker(in_flight, confirms):
+    tracker = ConfirmTracker()
+    for tag in range(1, in_flight+1):
+        tracker.published()
+
+    start = time.perf_counter()
+    for delivery_tag, multiple in confirms:
+        tracker.confirm(delivery_tag, multiple)
+    return time.perf_counter() - start, tracker.outstanding()
+
+def report(name, in_flight, confirms, elapsed, left):
+    per_tag_ns = elapsed * 1000000000 / in_flight
+    print(f"{name:<8} in-flight: {in_flight:>9} confirms: {len(confirms):>8} time: {elapsed:>9.4f}s per tag: {per_tag_ns:>10.1f}ns outstanding after: {left}")
+
+args = get_args(sys.argv)
+in_flight = int(get_optional_arg(args, "--in-flight", "1000000"))
+legacy_in_flight = int(get_optional_arg(args, "--legacy-in-flight", "40000"))
+batch_size = int(get_optional_arg(args, "--batch", "100"))
+single_rate = float(get_optional_arg(args, "--single-rate", "0.1"))
+
+random.seed(1)
+
+# the list approach is quadratic so it is only run at a size that completes in reasonable time
+for size in [legacy_in_flight // 2, legacy_in_flight]:
+    confirms = make_confirms(size, batch_size, single_rate)
+    elapsed, left = run_legacy(size, confirms)
+    report("list", size, confirms, elapsed, left)
+    elapsed, left = run_tracker(size, confirms)
+    report("tracker", size, confirms, elapsed, left)
+
+confirms = make_confirms(in_flight, batch_size, single_rate)
+elapsed, left = run_tracker(in_flight, confirms)
+report("tracker", in_flight, confirms, elapsed, left)
+
+confirms = [(tag, False) for tag in range(in_flight, 0, -1)]
+elapsed, left = run_tracker(in_flight, confirms)
+report("tracker", in_flight, confirms, elapsed, left)
+print("(last run: every tag confirmed individually in reverse order, the worst case for the watermark)")
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+import sys
+import time
+import uuid
+import random
+import tracemalloc
+from command_args import get_args, get_optional_arg
+from dedup_cache import DedupCache
+from bloom_dedup import RotatingBloomFilter
+
+# Compares memory and per message cost of the exact DedupCache with the
+# RotatingBloomFilter for a stream of unique correlation ids with a share of
+# redelivered duplicates mixed in, all falling inside one dedup window.
+
+def make_stream(count, dup_rate):
+    stream = list()
+    recent = list()
+    for i in range(count):
+        corr_id = str(uuid.uuid4())
+        stream.append(corr_id)
+        recent.append(corr_id)
+        if len(recent) > 1000:
+            recent.pop(0)
+        if random.uniform(0, 1) < dup_rate:
+            stream.append(random.choice(recent))
+    return stream
+
+def run(name, make_store, stream, unique_count):
+    store = make_store()
+    start = time.perf_counter()
+    duplicates = 0
+    for corr_id in stream:
+        if store.seen(corr_id, 0):
+            duplicates += 1
+    elapsed = time.perf_counter() - start
+
+    expected = len(stream) - unique_count
+    per_msg_ns = elapsed * 1000000000 / len(stream)
+    print(f"{name:<6} messages: {len(stream)} duplicates detected: {duplicates} (actual {expected}, false positives {duplicates - expected}) per message: {per_msg_ns:.0f}ns")
+
+# tracemalloc slows every allocation down, so memory is measured in a separate
+# pass over the first ids of the stream and reported per id
+def measure_memory(name, make_store, stream, memory_ids):
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    store = make_store()
+    for corr_id in stream[:memory_ids]:
+        store.seen(corr_id, 0)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    used = after - before
+    print(f"{name:<6} memory after {memory_ids} ids: {used / 1048576:.1f} MB ({used / memory_ids:.1f} bytes per id)")
+
+args = get_args(sys.argv)
+count = int(get_optional_arg(args, "--ids", "1000000"))
+dup_rate = float(get_optional_arg(args, "--dup-rate", "0.01"))
+fp_rate = float(get_optional_arg(args, "--fp-rate", "0.001"))
+memory_ids = int(get_optional_arg(args, "--memory-ids", "100000"))
+
+random.seed(1)
+stream = make_stream(count, dup_rate)
+
+make_exact = lambda: DedupCache(window_sec=300, max_entries=count)
+make_bloom = lambda: RotatingBloomFilter(window_sec=300, capacity=count, fp_rate=fp_rate)
+
+run("exact", make_exact, stream, count)
+run("bloom", make_bloom, stream, count)
+measure_memory("exact", make_exact, stream, min(memory_ids, len(stream)))
+measure_memory("bloom", make_bloom, stream, min(memory_ids, len(stream)))
+
+# the Bloom filter is sized up front, so its footprint at larger windows is known without running it
+for capacity in [count, 10000000, 50000000]:
+    bloom = RotatingBloomFilter(window_sec=300, capacity=capacity, fp_rate=fp_rate)
+    print(f"bloom  capacity: {capacity} ids per window memory: {bloom.memory_bytes() / 1048576:.1f} MB")
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import node_resolver
+from command_args import get_args, get_optional_arg
+from rabbit_client import cluster_node_names
+
+# Compares the startup cost of resolving every node address:
+#   per-node   one bash + docker inspect process per node, one after another (the old get_node_ip)
+#   batch      one docker inspect for all nodes (a cache miss)
+#   cached     read from the cache file
+#   env        RABBITMQ_NODES override
+# Uses its own cache file so the real one is left alone.
+
+args = get_args(sys.argv)
+node_count = int(get_optional_arg(args, "--cluster-size", "6"))
+runs = int(get_optional_arg(args, "--runs", "5"))
+
+node_names = cluster_node_names(node_count)
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cluster", "get-node-ip.sh")
+
+def per_node_ip(node_name):
+    process = subprocess.Popen(["bash", script, node_name], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    output, error = process.communicate()
+    return output.decode('ascii').replace('\n', '')
+
+def per_node():
+    return [per_node_ip(node_name) for node_name in node_names]
+
+def batch():
+    node_resolver.invalidate_cache()
+    return node_resolver.resolve_node_list(node_names)
+
+def cached():
+    return node_resolver.resolve_node_list(node_names)
+
+def env():
+    return node_resolver.resolve_node_list(node_names)
+
+def measure(name, fn, setup=None):
+    timings = list()
+    result = None
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    resolved = sum(1 for address in result if address)
+    print(f"{name:<10} median: {timings[len(timings) // 2]:8.2f}ms  min: {timings[0]:8.2f}ms  resolved: {resolved}/{len(node_names)}")
+    return result
+
+cache_dir = tempfile.mkdtemp()
+node_resolver.CACHE_FILE = os.path.join(cache_dir, "node-ips.json")
+os.environ["RABBITMQ_HOSTS_FILE"] = os.path.join(cache_dir, "no-hosts.json")
+os.environ.pop("RABBITMQ_NODES", None)
+
+print(f"Resolving {node_count} nodes, {runs} runs each")
+addresses = measure("per-node", per_node)
+measure("batch", batch)
+
+# the cache is only written when docker returned addresses, fake them otherwise
+if not os.path.exists(node_resolver.CACHE_FILE):
+    print("docker returned no addresses, caching placeholder addresses to time the cache")
+    node_resolver.save_cache({node_name: f"10.0.0.{i}" for i, node_name in enumerate(node_names, 2)})
+measure("cached", cached)
+
+os.environ["RABBITMQ_NODES"] = ",".join(f"{node_name}=10.0.0.{i}" for i, node_name in enumerate(node_names, 2))
+measure("env", env)
+
+node_resolver.invalidate_cache()
+os.rmdir(cache_dir)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+import sys
+import time
+import uuid
+import pstats
+import cProfile
+import pika
+from pika import frame, spec
+from command_args import get_args, get_optional_arg
+from body_format import TEXT_CONTENT_TYPE, BINARY_CONTENT_TYPE, encode_state_update
+from message_template import MessageTemplate, CorrelationIds
+
+# CPU per message of the state update publish loop, without a broker: each
+# message is built the way send-state-updates-*.py build it and then marshalled
+# into its method, content header and body frames the way basic_publish does.
+#   per message  a new BasicProperties, a uuid4 correlation id and an f-string
+#                body for every message, as the producers did before
+#   template     MessageTemplate properties, CorrelationIds and a body from a
+#                precomputed key prefix
+# CPU time is process time, best of --runs. With --profile true each loop is also
+# run under cProfile and its most expensive functions are listed.
+
+args = get_args(sys.argv)
+count = int(get_optional_arg(args, "--msgs", "200000"))
+key_count = int(get_optional_arg(args, "--keys", "10"))
+runs = int(get_optional_arg(args, "--runs", "3"))
+body_format = get_optional_arg(args, "--body-format", "text")
+profile = get_optional_arg(args, "--profile", "false") == "true"
+profile_lines = int(get_optional_arg(args, "--profile-lines", "12"))
+
+states = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j']
+producer_id = 4242
+queue = "state-updates"
+
+# what basic_publish sends for one message, frames are marshalled on publish
+def send(exchange, routing_key, body, properties):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    frame.Method(1, spec.Basic.Publish(exchange=exchange, routing_key=routing_key)).marshal()
+    frame.Header(1, len(body), properties).marshal()
+    frame.Body(1, body).marshal()
+
+def per_message_loop():
+    state_index = 0
+    val = 1
+    for _ in range(count):
+        publish_ns = time.time_ns()
+        if body_format == "binary":
+            body = encode_state_update(state_index, val, publish_ns, producer_id)
+            content_type = BINARY_CONTENT_TYPE
+            headers = None
+        else:
+            body = f"{states[state_index]}={val}"
+            content_type = TEXT_CONTENT_TYPE
+            headers = {"publish_ns": publish_ns}
+        corr_id = str(uuid.uuid4())
+        properties = pika.BasicProperties(content_type=content_type,
+                                          delivery_mode=2,
+                                          correlation_id=corr_id,
+                                          headers=headers)
+        send('', queue, body, properties)
+
+        state_index += 1
+        if state_index == key_count:
+            state_index = 0
+            val += 1
+
+def template_loop():
+    correlation_ids = CorrelationIds()
+    if body_format == "binary":
+        properties = MessageTemplate(content_type=BINARY_CONTENT_TYPE, delivery_mode=2,
+                                     variable_correlation_id=True)
+    else:
+        properties = MessageTemplate(content_type=TEXT_CONTENT_TYPE, delivery_mode=2,
+                                     variable_correlation_id=True, int_headers=["publish_ns"])
+    key_prefixes = [f"{state}=".encode('utf-8') for state in states]
+    val_text = b"1"
+    state_index = 0
+    val = 1
+    for _ in range(count):
+        publish_ns = time.time_ns()
+        properties.correlation_id = correlation_ids.next()
+        if body_format == "binary":
+            body = encode_state_update(state_index, val, publish_ns, producer_id)
+        else:
+            body = key_prefixes[state_index] + val_text
+            properties.headers["publish_ns"] = publish_ns
+        send('', queue, body, properties)
+
+        state_index += 1
+        if state_index == key_count:
+            state_index = 0
+            val += 1
+            val_text = str(val).encode('utf-8')
+
+# the method and body frames alone, marshalled the same way in both loops
+def frames_only_loop():
+    body = b"a=1"
+    for _ in range(count):
+        frame.Method(1, spec.Basic.Publish(exchange='', routing_key=queue)).marshal()
+        frame.Body(1, body).marshal()
+
+def measure(name, fn):
+    timings = list()
+    for _ in range(runs):
+        start = time.process_time()
+        fn()
+        timings.append(time.process_time() - start)
+    best = min(timings)
+    print(f"{name:<14} {best * 1e6 / count:6.2f} us/msg cpu {count / best:10.0f} msg/s")
+    return best
+
+def profile_loop(name, fn):
+    profiler = cProfile.Profile()
+    profiler.runcall(fn)
+    print(f"--- {name}: top {profile_lines} functions by own time")
+    pstats.Stats(profiler, stream=sys.stdout).sort_stats("tottime").print_stats(profile_lines)
+
+print(f"Publish loop CPU for {count} {body_format} messages over {key_count} keys, best of {runs} runs")
+before = measure("per message", per_message_loop)
+after = measure("template", template_loop)
+measure("method+body", frames_only_loop)
+print(f"template uses {after / before * 100:.0f}% of the per message CPU")
+
+if profile:
+    profile_loop("per message", per_message_loop)
+    profile_loop("template", template_loop)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+import sys
+import json
+import time
+import asyncio
+import datetime
+import itertools
+import pika
+from command_args import get_args, get_optional_arg
+from rabbit_client import get_node_ip, RabbitConnection, Publisher, ConnectionLost
+from latency_histogram import LatencyHistogram
+
+# Publish throughput and loss benchmark, the fire-and-forget.py measurement
+# made repeatable. Every combination of
+#   --sizes            body sizes in bytes
+#   --delivery-modes   persistent and/or transient
+#   --confirms         true and/or false
+#   --channels         publishing channels on one connection
+# is one run against a purged lazy queue: --warmup-sec of publishing that is not
+# measured, then --duration-sec measured, then the queue's message_count is read
+# once --settle-sec has passed to count what was lost. Each run reports sustained
+# msgs/s and MB/s over the measured window, the latency of the publish call and,
+# with confirms, of the confirm, and the loss.
+#
+# Results are written as JSON to --output. With --baseline pointing to the
+# results of an earlier release, runs of the same parameters are compared and
+# any that lost more than --regression-pct of its msgs/s is reported, the exit
+# code is then 1.
+#
+# python bench-publish.py --node rabbitmq1 --sizes 200,4000 --channels 1,4 --label 3.7.8 --output 3.7.8.json
+
+args = get_args(sys.argv)
+node = get_optional_arg(args, "--node", "rabbitmq1")
+queue = get_optional_arg(args, "--queue", "bench-publish")
+sizes = [int(size) for size in get_optional_arg(args, "--sizes", "200").split(",")]
+delivery_modes = get_optional_arg(args, "--delivery-modes", "persistent,transient").split(",")
+confirm_modes = [mode == "true" for mode in get_optional_arg(args, "--confirms", "true,false").split(",")]
+channel_counts = [int(channels) for channels in get_optional_arg(args, "--channels", "1").split(",")]
+warmup_sec = float(get_optional_arg(args, "--warmup-sec", "2"))
+duration_sec = float(get_optional_arg(args, "--duration-sec", "10"))
+settle_sec = float(get_optional_arg(args, "--settle-sec", "2"))
+max_in_flight = int(get_optional_arg(args, "--max-in-flight", "10000"))
+label = get_optional_arg(args, "--label", "")
+output = get_optional_arg(args, "--output", "bench-publish-results.json")
+baseline = get_optional_arg(args, "--baseline", "")
+regression_pct = float(get_optional_arg(args, "--regression-pct", "10"))
+
+for mode in delivery_modes:
+    if mode not in ["persistent", "transient"]:
+        print(f"Unknown delivery mode {mode}, use persistent and/or transient")
+        exit(1)
+
+class Run:
+
+    def __init__(self, size, delivery_mode, confirms, channels):
+        self.size = size
+        self.delivery_mode = delivery_mode
+        self.confirms = confirms
+        self.channels = channels
+        self.published = 0
+        self.measured = 0
+        self.confirmed = 0
+        self.nacked = 0
+        self.call_latency = LatencyHistogram()
+        self.confirm_latency = LatencyHistogram()
+        self.window_start = 0
+        self.window_end = 0
+        self.error = None
+
+    def params(self):
+        return {"size": self.size, "delivery_mode": self.delivery_mode,
+                "confirms": self.confirms, "channels": self.channels}
+
+    def name(self):
+        return (f"{self.size}B {self.delivery_mode} confirms={'on' if self.confirms else 'off'} "
+                f"channels={self.channels}")
+
+
+def run_key(params):
+    return (params["size"], params["delivery_mode"], params["confirms"], params["channels"])
+
+def latency_result(histogram):
+    if histogram.count == 0:
+        return None
+    return {"p50_us": histogram.percentile(50), "p99_us": histogram.percentile(99),
+            "p99_9_us": histogram.percentile(99.9), "max_us": histogram.max, "count": histogram.count}
+
+async def queue_message_count(connection):
+    chan = await connection.channel()
+    res = await connection.rpc(chan, chan.queue_declare, queue=queue, durable=True, arguments={"x-queue-mode": "lazy"})
+    chan.close()
+    return res.method.message_count
+
+async def reset_queue(connection):
+    chan = await connection.channel()
+    await connection.rpc(chan, chan.queue_declare, queue=queue, durable=True, arguments={"x-queue-mode": "lazy"})
+    await connection.rpc(chan, chan.queue_purge, queue=queue)
+    chan.close()
+
+# publishes on one channel until the end of the run, measuring only the calls
+# and confirms of messages published inside the window
+async def publish_loop(run, publisher, body, properties, window_start, run_end):
+    perf_counter_ns = time.perf_counter_ns
+    call_latency = run.call_latency
+    confirm_latency = run.confirm_latency
+
+    def on_confirmed(started, future):
+        if not future.cancelled() and future.result():
+            confirm_latency.record((perf_counter_ns() - started) // 1000)
+
+    while True:
+        started = perf_counter_ns()
+        if started >= run_end:
+            return
+        future = await publisher.publish(exchange='', routing_key=queue, body=body, properties=properties)
+        run.published += 1
+        if started >= window_start:
+            run.measured += 1
+            call_latency.record((perf_counter_ns() - started) // 1000)
+            if future is not None:
+                future.add_done_callback(lambda done, started=started: on_confirmed(started, done))
+
+async def execute(connection, run):
+    await reset_queue(connection)
+    body = b"x" * run.size
+    properties = pika.BasicProperties(content_type='application/octet-stream',
+                                      delivery_mode=2 if run.delivery_mode == "persistent" else 1)
+
+    def on_confirm(acked, confirmed):
+        now = time.perf_counter_ns()
+        if run.window_start <= now < run.window_end:
+            if acked:
+                run.confirmed += confirmed
+            else:
+                run.nacked += confirmed
+
+    publishers = [await Publisher(connection, confirms=run.confirms, max_in_flight=max_in_flight,
+                                  on_confirm=on_confirm).open() for _ in range(run.channels)]
+    run.window_start = time.perf_counter_ns() + int(warmup_sec * 1e9)
+    run.window_end = run.window_start + int(duration_sec * 1e9)
+    await asyncio.gather(*[publish_loop(run, publisher, body, properties, run.window_start, run.window_end)
+                           for publisher in publishers])
+    for publisher in publishers:
+        if run.confirms:
+            await publisher.wait_for_confirms()
+        publisher.channel.close()
+    nacked = sum(publisher.nacked for publisher in publishers)
+
+    await asyncio.sleep(settle_sec)
+    message_count = await queue_message_count(connection)
+    window = (run.window_end - run.window_start) / 1e9
+    result = {"msgs_per_sec": run.measured / window,
+              "mb_per_sec": run.measured * run.size / window / 1e6,
+              "published": run.published,
+              "in_queue": message_count,
+              "nacked": nacked,
+              "lost": run.published - nacked - message_count,
+              "publish_call_latency": latency_result(run.call_latency)}
+    if run.confirms:
+        result["confirmed_per_sec"] = run.confirmed / window
+        result["confirm_latency"] = latency_result(run.confirm_latency)
+    await reset_queue(connection)
+    return result
+
+def print_result(run, result):
+    call = result["publish_call_latency"]
+    line = (f"{run.name():<48} {result['msgs_per_sec']:9.0f} msg/s {result['mb_per_sec']:8.2f} MB/s "
+            f"call p50/p99 {call['p50_us']}/{call['p99_us']}us lost {result['lost']}")
+    if run.confirms and result["confirm_latency"] is not None:
+        confirm = result["confirm_latency"]
+        line += f" confirm p50/p99 {confirm['p50_us']}/{confirm['p99_us']}us"
+    print(line, flush=True)
+
+def compare(results):
+    with open(baseline) as f:
+        previous = json.load(f)
+    previous_runs = {run_key(run["params"]): run for run in previous["runs"] if "result" in run}
+    regressions = 0
+    print(f"Compared with {baseline} ({previous.get('label') or previous.get('started')}):")
+    for run in results["runs"]:
+        before = previous_runs.get(run_key(run["params"]))
+        if before is None or "result" not in run:
+            continue
+        old_rate = before["result"]["msgs_per_sec"]
+        new_rate = run["result"]["msgs_per_sec"]
+        change = (new_rate - old_rate) / old_rate * 100 if old_rate > 0 else 0
+        regressed = change < -regression_pct
+        regressions += regressed
+        name = Run(**run["params"]).name()
+        print(f"  {name:<48} {old_rate:9.0f} -> {new_rate:9.0f} msg/s ({change:+.1f}%){' REGRESSION' if regressed else ''}")
+    return regressions
+
+async def main():
+    results = {"label": label,
+               "started": datetime.datetime.now().isoformat(),
+               "node": node,
+               "settings": {"warmup_sec": warmup_sec, "duration_sec": duration_sec,
+                            "settle_sec": settle_sec, "max_in_flight": max_in_flight},
+               "runs": list()}
+    connection = await RabbitConnection(get_node_ip(node)).open()
+    for size, delivery_mode, confirms, channels in itertools.product(sizes, delivery_modes, confirm_modes, channel_counts):
+        run = Run(size, delivery_mode, confirms, channels)
+        entry = {"params": run.params()}
+        try:
+            entry["result"] = await execute(connection, run)
+            print_result(run, entry["result"])
+        except ConnectionLost as ex:
+            # the run is recorded as failed, the next one gets a new connection
+            entry["error"] = str(ex)
+            print(f"{run.name():<48} failed: {ex}")
+            await connection.close()
+            connection = await RabbitConnection(get_node_ip(node)).open()
+        results["runs"].append(entry)
+    await connection.close()
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    if baseline and compare(results) > 0:
+        exit(1)
+
+asyncio.run(main())
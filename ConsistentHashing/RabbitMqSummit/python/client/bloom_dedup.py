@@ -0,0 +1,118 @@
+import math
+import time
+import struct
+import hashlib
+
+# Probabilistic deduplication for streams with too many correlation ids to keep
+# exactly. The window is split into time slices, each with its own Bloom filter.
+# Lookups check the current slice and the previous ones that together cover the
+# window, inserts go into the current slice and on rotation the oldest filter is
+# wiped and reused, so memory stays constant however many ids pass through.
+# A slice also rotates early once it holds its share of the capacity, which keeps
+# the false positive rate bounded when the stream runs faster than expected
+# (at the cost of a shorter effective window).
+class RotatingBloomFilter:
+
+    def __init__(self, window_sec=300, capacity=10000000, fp_rate=0.001, slices=4):
+        self.window_sec = window_sec
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.slices = slices
+        self.slice_sec = window_sec / slices
+        self.slice_capacity = max(1, capacity // slices)
+
+        # a lookup can match in any of the slices + 1 live filters, so each
+        # filter gets an equal share of the overall false positive budget
+        slice_fp_rate = fp_rate / (slices + 1)
+        bits = -self.slice_capacity * math.log(slice_fp_rate) / (math.log(2) ** 2)
+        hash_count = -math.log(slice_fp_rate) / math.log(2)
+        self.bit_count = max(64, int(math.ceil(bits / 8)) * 8)
+        # all hash functions are cut from a single blake2b digest (at most 64 bytes)
+        self.hash_count = min(16, max(1, int(round(hash_count))))
+        self.unpack = struct.Struct(f"<{self.hash_count}I").unpack
+
+        self.filters = [bytearray(self.bit_count // 8) for _ in range(slices + 1)]
+        self.current = 0
+        self.current_count = 0
+        self.current_started = None
+        self.hits = 0
+        self.misses = 0
+        self.rotations = 0
+        self.early_rotations = 0
+        self.last_id = None
+        self.last_positions = None
+
+    def positions(self, correlation_id):
+        if isinstance(correlation_id, str):
+            correlation_id = correlation_id.encode('utf-8')
+        digest = hashlib.blake2b(correlation_id, digest_size=4 * self.hash_count).digest()
+        # maps each 32 bit hash onto the filter with a multiply and shift rather than a modulo
+        m = self.bit_count
+        return [(h * m) >> 32 for h in self.unpack(digest)]
+
+    def rotate(self, now):
+        self.current = (self.current + 1) % len(self.filters)
+        # reuse the buffer of the oldest slice rather than allocating a new one
+        self.filters[self.current][:] = bytes(self.bit_count // 8)
+        self.current_count = 0
+        self.current_started = now
+        self.rotations += 1
+
+    def cached_positions(self, correlation_id):
+        # contains() followed by add() for the same id only hashes once
+        if correlation_id != self.last_id:
+            self.last_id = correlation_id
+            self.last_positions = self.positions(correlation_id)
+        return self.last_positions
+
+    # returns True when the correlation id is (probably) a duplicate
+    def contains(self, correlation_id, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.current_started is None:
+            self.current_started = now
+        elif now - self.current_started >= self.slice_sec:
+            # after an idle period several slices may have expired at once
+            elapsed = int((now - self.current_started) / self.slice_sec)
+            for _ in range(min(elapsed, len(self.filters))):
+                self.rotate(now)
+
+        positions = self.cached_positions(correlation_id)
+        for bloom in self.filters:
+            for p in positions:
+                if not bloom[p >> 3] & (1 << (p & 7)):
+                    break
+            else:
+                self.hits += 1
+                return True
+
+        self.misses += 1
+        return False
+
+    def add(self, correlation_id, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.current_started is None:
+            self.current_started = now
+        elif self.current_count >= self.slice_capacity:
+            self.early_rotations += 1
+            self.rotate(now)
+
+        bloom = self.filters[self.current]
+        for p in self.cached_positions(correlation_id):
+            bloom[p >> 3] |= 1 << (p & 7)
+        self.current_count += 1
+
+    # checks and records in one step, returns True for a (probable) duplicate
+    def seen(self, correlation_id, now=None):
+        if self.contains(correlation_id, now):
+            return True
+        self.add(correlation_id, now)
+        return False
+
+    def memory_bytes(self):
+        return len(self.filters) * (self.bit_count // 8)
+
+    def stats(self):
+        return (f"Bloom dedup memory: {self.memory_bytes()} bytes hash functions: {self.hash_count} "
+                f"hits: {self.hits} misses: {self.misses} rotations: {self.rotations} early rotations: {self.early_rotations}")
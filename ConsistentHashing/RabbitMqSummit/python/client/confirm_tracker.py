@@ -0,0 +1,68 @@
+# Tracks publisher confirms for a channel in confirm mode.
+# Delivery tags on a channel are assigned sequentially from 1, so the in-flight
+# tags are always the range (watermark, last_tag] minus the few tags that the
+# broker confirmed out of order. We keep only the watermark and that sparse set,
+# so both single and multiple acks/nacks cost amortized O(1) per tag no matter
+# how many messages are in flight.
+class ConfirmTracker:
+
+    def __init__(self):
+        self.reset()
+
+    # call whenever a new channel is opened as delivery tags restart from 1
+    def reset(self):
+        self.last_tag = 0
+        self.watermark = 0
+        self.confirmed_ahead = set()
+
+    # registers a publish and returns the delivery tag the broker will assign to it
+    def published(self):
+        self.last_tag += 1
+        return self.last_tag
+
+    def outstanding(self):
+        return self.last_tag - self.watermark - len(self.confirmed_ahead)
+
+    def is_outstanding(self, tag):
+        return self.watermark < tag <= self.last_tag and tag not in self.confirmed_ahead
+
+    # returns the number of in-flight messages that this ack/nack confirmed
+    def confirm(self, tag, multiple):
+        if multiple:
+            # a multiple ack with tag 0 confirms everything outstanding
+            if tag == 0 or tag > self.last_tag:
+                tag = self.last_tag
+            if tag <= self.watermark:
+                return 0
+
+            confirmed = tag - self.watermark
+            if self.confirmed_ahead:
+                # each tag is passed over once before the watermark moves beyond it
+                # so walking the smaller of the two collections is amortized O(1)
+                if len(self.confirmed_ahead) < confirmed:
+                    below = [t for t in self.confirmed_ahead if t <= tag]
+                else:
+                    below = [t for t in range(self.watermark + 1, tag + 1) if t in self.confirmed_ahead]
+                for t in below:
+                    self.confirmed_ahead.remove(t)
+                confirmed -= len(below)
+
+            self.watermark = tag
+            self._advance()
+            return confirmed
+
+        if not self.is_outstanding(tag):
+            return 0
+
+        if tag == self.watermark + 1:
+            self.watermark = tag
+            self._advance()
+        else:
+            self.confirmed_ahead.add(tag)
+
+        return 1
+
+    def _advance(self):
+        while self.confirmed_ahead and (self.watermark + 1) in self.confirmed_ahead:
+            self.watermark += 1
+            self.confirmed_ahead.remove(self.watermark)
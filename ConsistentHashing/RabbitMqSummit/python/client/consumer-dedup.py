@@ -1,91 +1,85 @@
 #!/usr/bin/env python
-import pika
-from pika import spec
-import time
-import datetime
 import sys
 import random
-import subprocess
+import asyncio
 from command_args import get_args, get_mandatory_arg, get_optional_arg
+from rabbit_client import get_node_ip, RabbitConnection, Publisher, Consumer, ConnectionLost
+from dedup_cache import DedupCache
 
 
 class RabbitConsumer:
     connection = None
-    receive_channel = None
-    publish_channel = None
+    publisher = None
+    consumer = None
     queue_name = ""
     out_queue_name = ""
+    prefetch = 1
     processing_ms_min = 0
     processing_ms_max = 0
-    # in a production system you would need a data structure that could expire items over time
-    history = set() 
-    last_msg_time = datetime.date.now()
+    history = None
+    msg_count = 0
 
-    def get_node_ip(self, node_name):
-        bash_command = "bash ../cluster/get-node-ip.sh " + node_name
-        process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        ip = output.decode('ascii').replace('\n', '')
-        return ip
-
-    def connect(self, node):
-        ip = self.get_node_ip(node)
-        credentials = pika.PlainCredentials('jack', 'jack')
-        parameters = pika.ConnectionParameters(ip,
-                                            5672,
-                                            '/',
-                                            credentials)
-        self.connection = pika.BlockingConnection(parameters)
-        self.receive_channel = self.connection.channel()
-        self.publish_channel = self.connection.channel()
+    async def connect(self, node):
+        ip = get_node_ip(node)
+        self.connection = await RabbitConnection(ip).open()
+        self.publisher = await Publisher(self.connection, confirms=False).open()
+        self.consumer = await Consumer(self.connection, self.queue_name, self.prefetch).open()
+        print(f"Consuming queue: {self.queue_name}")
 
-    def callback(self, ch, method, properties, body):
-        # probably I am running a different demo without restarting this consumer
-        if (datetime.datetime.now() - self.last_msg_time).seconds > 5:
-            self.history.clear()
-            print("----------------------------------")
+    async def handle(self, delivery):
+        self.msg_count += 1
+        if self.msg_count % 10000 == 0:
+            print(self.history.stats())
 
-        if properties.correlation_id in self.history:
+        if self.history.seen(delivery.properties.correlation_id):
             print("Detected and ignored duplicate")
-            ch.basic_ack(delivery_tag = method.delivery_tag)
+            self.consumer.ack(delivery.delivery_tag)
         else:
-            self.history.add(properties.correlation_id)
-            self.publish_channel.basic_publish(exchange='', 
-                                                routing_key=self.out_queue_name,
-                                                body=body)   
+            self.publisher.publish_nowait(exchange='',
+                                          routing_key=self.out_queue_name,
+                                          body=delivery.body)
 
-            ch.basic_ack(delivery_tag = method.delivery_tag)
+            self.consumer.ack(delivery.delivery_tag)
 
             if self.processing_ms_max > 0:
                 wait_sec = float(random.randint(self.processing_ms_min, self.processing_ms_max) / 1000)
-                time.sleep(wait_sec)
+                await asyncio.sleep(wait_sec)
 
-        self.last_msg_time = datetime.datetime.now()
+    async def run(self, node):
+        try:
+            await self.connect(node)
+            async for delivery in self.consumer:
+                await self.handle(delivery)
+            print(f"Channel closed. Reason: {self.consumer.close_reason}")
+        except ConnectionLost as ex:
+            print(f"Channel closed. Reason: {ex}")
+        except asyncio.CancelledError:
+            pass
+        except Exception as ex:
+            template = "An exception of type {0} occurred. Arguments:{1!r}"
+            message = template.format(type(ex).__name__, ex.args)
+            print(message)
+        finally:
+            await self.disconnect()
 
-    def consume(self, queue, out_queue, prefetch, processing_ms_min, processing_ms_max):
+    def consume(self, node, queue, out_queue, prefetch, processing_ms_min, processing_ms_max, dedup_window_sec, dedup_max_entries):
         self.queue_name = queue
-        self.out_queue = out_queue
-        print(f"Consuming queue: {self.queue_name}")
-        self.receive_channel.basic_qos(prefetch_count=prefetch)
-        self.receive_channel.basic_consume(self.callback,
-                      queue=self.queue_name,
-                      no_ack=False)
+        self.out_queue_name = out_queue
+        self.prefetch = prefetch
+        self.history = DedupCache(dedup_window_sec, dedup_max_entries)
 
         self.processing_ms_min = processing_ms_min
         self.processing_ms_max = processing_ms_max
 
         try:
-            self.last_msg_time = datetime.datetime.now()
-            self.receive_channel.start_consuming()
+            asyncio.run(self.run(node))
         except KeyboardInterrupt:
-            self.disconnect()
-        except Exception as ex:
-            template = "An exception of type {0} occurred. Arguments:{1!r}"
-            message = template.format(type(ex).__name__, ex.args)
-            print(message) 
-                    
-    def disconnect(self):
-        self.connection.close()
+            pass
+
+    async def disconnect(self):
+        print(self.history.stats())
+        if self.connection is not None:
+            await self.connection.close()
 
 args = get_args(sys.argv)
 
@@ -95,8 +89,9 @@ out_queue = get_mandatory_arg(args, "--out-queue")
 prefetch =  int(get_optional_arg(args, "--prefetch", "1"))#int(sys.argv[3])
 processing_ms_min = int(get_optional_arg(args, "--min-ms", "0")) #int(sys.argv[4])
 processing_ms_max = int(get_optional_arg(args, "--max-ms", "0")) #int(sys.argv[5])
+dedup_window_sec = int(get_optional_arg(args, "--dedup-window-sec", "300"))
+dedup_max_entries = int(get_optional_arg(args, "--dedup-max-entries", "1000000"))
 print(f"Consuming queue: {queue} Writing to: {out_queue}")
 
 consumer = RabbitConsumer()
-consumer.connect(connect_node)
-consumer.consume(queue, out_queue, prefetch, processing_ms_min, processing_ms_max)
+consumer.consume(connect_node, queue, out_queue, prefetch, processing_ms_min, processing_ms_max, dedup_window_sec, dedup_max_entries)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import signal
+import asyncio
+from command_args import get_args, get_mandatory_arg, get_optional_arg
+
+# Runs one consumer.py process per partition queue of a hash exchange.
+# Queues follow the naming of cluster/declare-hashing-infra.py: --queue-prefix
+# followed by 001 to --queue-count. Workers are spread over --nodes, optionally
+# pinned one per CPU core, restarted when they exit and their throughput is
+# aggregated from the progress lines they print.
+#
+# Any argument not used here is passed on to every consumer.py, for example:
+# python consumer-group.py --queue-prefix states --queue-count 20 --out-queue output-seq --prefetch 100
+
+SUPERVISOR_ARGS = ["--queue-prefix", "--queue-count", "--nodes", "--pin-cpus",
+                   "--restart-delay-sec", "--report-sec"]
+
+class Worker:
+
+    def __init__(self, queue, node, cpu):
+        self.queue = queue
+        self.node = node
+        self.cpu = cpu
+        self.process = None
+        self.consumed = 0
+        self.consumed_before_restart = 0
+        self.last_reported = 0
+        self.restarts = 0
+
+    def total_consumed(self):
+        return self.consumed_before_restart + self.consumed
+
+
+def get_worker_args(args):
+    worker_args = list()
+    for key, value in args.items():
+        if key not in SUPERVISOR_ARGS and key not in ["--in-queue", "--node", "--report-sec"]:
+            worker_args += [key, value]
+    return worker_args
+
+def pin_to_cpu(worker):
+    if worker.cpu is None:
+        return
+    try:
+        os.sched_setaffinity(worker.process.pid, {worker.cpu})
+    except (AttributeError, OSError) as ex:
+        print(f"Could not pin {worker.queue} to cpu {worker.cpu}: {ex}")
+
+async def start_worker(worker):
+    consumer_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "consumer.py")
+    command = [sys.executable, "-u", consumer_path,
+               "--node", worker.node,
+               "--in-queue", worker.queue,
+               "--report-sec", str(min(1.0, report_sec))] + worker_args
+
+    # a new session keeps a Ctrl-C in the terminal from reaching the workers directly,
+    # the supervisor forwards it once so that every worker shuts down cleanly
+    worker.process = await asyncio.create_subprocess_exec(*command,
+                                                          stdout=asyncio.subprocess.PIPE,
+                                                          stderr=asyncio.subprocess.STDOUT,
+                                                          start_new_session=True)
+    pin_to_cpu(worker)
+    cpu = "" if worker.cpu is None else f" on cpu {worker.cpu}"
+    print(f"Started consumer of {worker.queue} connected to {worker.node}{cpu} (pid {worker.process.pid})")
+
+async def read_output(worker):
+    async for line in worker.process.stdout:
+        text = line.decode('utf-8', errors='replace').rstrip()
+        if text.startswith("Progress: consumed "):
+            worker.consumed = int(text.split()[-1])
+        else:
+            print(f"[{worker.queue}] {text}")
+
+# keeps a worker running until the group is stopped, restarting it whenever it exits
+async def supervise(worker):
+    while not stopping:
+        await start_worker(worker)
+        await read_output(worker)
+        return_code = await worker.process.wait()
+
+        worker.consumed_before_restart += worker.consumed
+        worker.consumed = 0
+        if stopping:
+            break
+
+        worker.restarts += 1
+        print(f"Consumer of {worker.queue} exited with code {return_code}, restarting in {restart_delay_sec} seconds")
+        await asyncio.sleep(restart_delay_sec)
+
+async def report():
+    last_time = time.monotonic()
+    last_total = 0
+    while True:
+        await asyncio.sleep(report_sec)
+        now = time.monotonic()
+        total = sum(worker.total_consumed() for worker in workers)
+        rate = (total - last_total) / (now - last_time)
+        per_queue = " ".join(f"{worker.queue[-3:]}={worker.total_consumed() - worker.last_reported}" for worker in workers)
+        for worker in workers:
+            worker.last_reported = worker.total_consumed()
+        restarts = sum(worker.restarts for worker in workers)
+        print(f"Group consumed: {total} rate: {rate:.0f} msg/s restarts: {restarts} | last interval per queue: {per_queue}")
+        last_time = now
+        last_total = total
+
+def stop():
+    global stopping
+    if stopping:
+        return
+    stopping = True
+    print("Stopping consumers")
+    for worker in workers:
+        if worker.process is not None and worker.process.returncode is None:
+            worker.process.send_signal(signal.SIGINT)
+
+async def main():
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, stop)
+    loop.add_signal_handler(signal.SIGTERM, stop)
+
+    reporter = asyncio.create_task(report())
+    await asyncio.gather(*[supervise(worker) for worker in workers])
+    reporter.cancel()
+
+    total = sum(worker.total_consumed() for worker in workers)
+    print(f"Final group consumed: {total} restarts: {sum(worker.restarts for worker in workers)}")
+
+args = get_args(sys.argv)
+
+queue_prefix = get_mandatory_arg(args, "--queue-prefix")
+queue_count = int(get_mandatory_arg(args, "--queue-count"))
+nodes = get_optional_arg(args, "--nodes", get_optional_arg(args, "--node", "rabbitmq1")).split(",")
+# true pins worker i to core i modulo the cores available to this process
+pin_cpus = get_optional_arg(args, "--pin-cpus", "false") == "true"
+restart_delay_sec = float(get_optional_arg(args, "--restart-delay-sec", "2"))
+report_sec = float(get_optional_arg(args, "--report-sec", "5"))
+if "--out-queue" not in args and "--out-exchange" not in args:
+    print("Missing mandatory argument --out-queue (or --out-exchange)")
+    exit(1)
+worker_args = get_worker_args(args)
+
+cpus = None
+if pin_cpus:
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        print("CPU pinning is not supported on this platform, workers will not be pinned")
+
+stopping = False
+workers = list()
+for i in range(1, queue_count+1):
+    queue = f"{queue_prefix}{i:03}"
+    node = nodes[(i-1) % len(nodes)]
+    cpu = cpus[(i-1) % len(cpus)] if cpus else None
+    workers.append(Worker(queue, node, cpu))
+
+asyncio.run(main())
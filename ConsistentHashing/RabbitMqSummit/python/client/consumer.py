@@ -1,103 +1,384 @@
 #!/usr/bin/env python
-import pika
-from pika import spec
-import time
-import datetime
 import sys
+import time
 import random
-import subprocess
+import asyncio
 from command_args import get_args, get_mandatory_arg, get_optional_arg
+from rabbit_client import get_node_ip, cluster_node_names, RabbitConnection, Publisher, Consumer, ConnectionLost
+from ack_batcher import AckBatcher
+from forward_pipeline import ForwardPipeline
+from worker_lanes import WorkerLanes
+from body_format import message_key, message_routing_key, stamp_forward
+from queue_locator import QueueLocator
+from dedup_cache import DedupCache
+from bloom_dedup import RotatingBloomFilter
+from mmap_dedup import MappedDedupLog
 
 
 class RabbitConsumer:
     connection = None
-    receive_channel = None
-    publish_channel = None
+    publisher = None
+    consumer = None
     queue_name = ""
     out_queue_name = ""
+    out_exchange = ""
+    latency_stamps = True
+    prefetch = 1
     processing_ms_min = 0
     processing_ms_max = 0
-    # in a production system you would need a data structure that could expire items over time
-    history = set() 
-    last_msg_time = datetime.datetime.now()
+    history = None
     dedup_enabled = False
+    msg_count = 0
+    acks = None
+    ack_batch = 1
+    ack_interval_ms = 0
+    forward_confirms = True
+    pipeline = None
+    report_sec = 0
+    lane_count = 0
+    lanes = None
+    lane_key = "body"
+    locator = None
+    locality_check_sec = 10
+    reconnect_delay_sec = 2
+    connected_node = None
+    stopping = False
+
+    # publisher confirms of forwarded messages are handled by the event loop
+    # while more messages are being consumed
+    async def connect(self, node):
+        ip = get_node_ip(node)
+        self.connection = await RabbitConnection(ip).open()
+        self.connected_node = node
+        # the prefetch already bounds how many forwards can be unconfirmed
+        self.publisher = await Publisher(self.connection,
+                                         confirms=self.forward_confirms,
+                                         max_in_flight=None).open()
+        # following the master, the broker cancels the consumer when the master fails over
+        arguments = {"x-cancel-on-ha-failover": True} if self.locator is not None else None
+        self.consumer = await Consumer(self.connection, self.queue_name, self.prefetch, arguments=arguments).open()
+
+        if self.acks is None:
+            self.acks = AckBatcher(self.consumer.channel, self.ack_batch, self.ack_interval_ms)
+            if self.forward_confirms or self.lane_count > 0:
+                # the dedup history only records an id once its forwarded copy is confirmed
+                on_forwarded = self.history.add if self.dedup_enabled else None
+                self.pipeline = ForwardPipeline(self.acks, on_forwarded)
+        else:
+            # reconnected, the counts carry on and acks go to the new channel
+            self.acks.channel = self.consumer.channel
+        if self.lane_count > 0:
+            self.lanes = WorkerLanes(self.lane_count)
+        print(f"Consuming queue: {self.queue_name} on {node}")
+
+    async def handle(self, delivery):
+        properties = delivery.properties
+        consume_ns = time.time_ns()
+        self.msg_count += 1
+        if self.dedup_enabled and self.msg_count % 10000 == 0:
+            print(self.history.stats())
 
-    def get_node_ip(self, node_name):
-        bash_command = "bash ../cluster/get-node-ip.sh " + node_name
-        process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE)
-        output, error = process.communicate()
-        ip = output.decode('ascii').replace('\n', '')
-        return ip
-
-    def connect(self, node):
-        ip = self.get_node_ip(node)
-        credentials = pika.PlainCredentials('jack', 'jack')
-        parameters = pika.ConnectionParameters(ip,
-                                            5672,
-                                            '/',
-                                            credentials)
-        self.connection = pika.BlockingConnection(parameters)
-        self.receive_channel = self.connection.channel()
-        self.publish_channel = self.connection.channel()
-
-    def callback(self, ch, method, properties, body):
-        # probably I am running a different demo without restarting this consumer
-        if (datetime.datetime.now() - self.last_msg_time).seconds > 5:
-            self.history.clear()
-            
-        if self.dedup_enabled and properties.correlation_id in self.history:
+        if self.dedup_enabled and self.history.contains(properties.correlation_id):
             print("Detected and ignored duplicate")
-            ch.basic_ack(delivery_tag = method.delivery_tag)
+            if self.pipeline is not None:
+                self.pipeline.skipped(delivery.delivery_tag)
+            else:
+                self.acks.ack(delivery.delivery_tag)
+        elif self.lanes is not None:
+            # the entry is added in delivery order, so acks stay in delivery order
+            # however the lanes complete
+            done = asyncio.get_running_loop().create_future()
+            self.pipeline.published(delivery.delivery_tag, done, properties.correlation_id)
+            key = delivery.method.routing_key if self.lane_key == "routing-key" else message_key(properties, delivery.body)
+            work = self.lanes.submit(key, self.process)
+            work.add_done_callback(lambda future: self.forward(delivery, future, done, consume_ns))
         else:
-            self.history.add(properties.correlation_id)
-            self.publish_channel.basic_publish(exchange='', 
-                                                routing_key=self.out_queue_name,
-                                                body=body)   
+            if self.latency_stamps:
+                stamp_forward(properties, consume_ns)
+            exchange, routing_key = self.out_target(delivery)
+            confirmed = self.publisher.publish_nowait(exchange=exchange,
+                                                      routing_key=routing_key,
+                                                      body=delivery.body,
+                                                      properties=delivery.properties)
 
-            ch.basic_ack(delivery_tag = method.delivery_tag)
+            if self.pipeline is not None:
+                # acked once the broker confirms the forwarded message
+                self.pipeline.published(delivery.delivery_tag, confirmed, properties.correlation_id)
+            else:
+                self.acks.ack(delivery.delivery_tag)
+                # recorded only once handled so a crash before this point leads to a redelivery being processed
+                if self.dedup_enabled:
+                    self.history.add(properties.correlation_id)
 
             if self.processing_ms_max > 0:
                 wait_sec = float(random.randint(self.processing_ms_min, self.processing_ms_max) / 1000)
-                time.sleep(wait_sec)
-        
-        self.last_msg_time = datetime.datetime.now()
+                await asyncio.sleep(wait_sec)
+
+    # with an output exchange the key of the body is the routing key, so that a
+    # hash exchange keeps every key on one output queue
+    def out_target(self, delivery):
+        if self.out_exchange:
+            return self.out_exchange, message_routing_key(delivery.properties, delivery.body)
+        return '', self.out_queue_name
+
+    # runs on a lane thread, the blocking sleep stands in for real work
+    def process(self):
+        if self.processing_ms_max > 0:
+            wait_sec = float(random.randint(self.processing_ms_min, self.processing_ms_max) / 1000)
+            time.sleep(wait_sec)
+
+    # back on the event loop thread once a lane has processed the delivery
+    def forward(self, delivery, work, done, consume_ns):
+        if work.cancelled() or done.done():
+            return
+        if work.exception() is not None:
+            print(f"Processing failed: {work.exception()}")
+            done.set_result(False)
+            return
+
+        if self.latency_stamps:
+            stamp_forward(delivery.properties, consume_ns)
+        try:
+            exchange, routing_key = self.out_target(delivery)
+            confirmed = self.publisher.publish_nowait(exchange=exchange,
+                                                      routing_key=routing_key,
+                                                      body=delivery.body,
+                                                      properties=delivery.properties)
+        except ConnectionLost:
+            # the input is redelivered once the connection is closed
+            done.cancel()
+            return
+
+        if confirmed is None:
+            done.set_result(True)
+        else:
+            confirmed.add_done_callback(lambda future: done.cancel() if future.cancelled() else done.set_result(future.result()))
+
+    async def ack_timer(self):
+        while True:
+            await asyncio.sleep(self.acks.interval_sec)
+            self.acks.tick()
+
+    # one line per interval that consumer-group.py parses to aggregate throughput
+    async def report_timer(self):
+        while True:
+            await asyncio.sleep(self.report_sec)
+            print(f"Progress: consumed {self.msg_count}", flush=True)
+
+    # closes the connection once the queue's master is on another node, which
+    # ends run() so that run_local() connects to the master's node
+    async def locality_timer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.locality_check_sec)
+            master = await loop.run_in_executor(None, self.locator.master_node, self.queue_name)
+            if master is not None and master != self.connected_node:
+                print(f"Master of {self.queue_name} moved to {master}, reconnecting")
+                await self.connection.close()
+                return
 
-    def consume(self, queue, out_queue, prefetch, processing_ms_min, processing_ms_max, dedup_enabled):
+    async def run(self, node):
+        ack_timer = None
+        report_timer = None
+        locality_timer = None
+        try:
+            await self.connect(node)
+            if self.ack_interval_ms > 0:
+                ack_timer = asyncio.create_task(self.ack_timer())
+            if self.report_sec > 0:
+                report_timer = asyncio.create_task(self.report_timer())
+            if self.locator is not None:
+                locality_timer = asyncio.create_task(self.locality_timer())
+
+            async for delivery in self.consumer:
+                await self.handle(delivery)
+            print(f"Channel closed. Reason: {self.consumer.close_reason}")
+        except ConnectionLost as ex:
+            # with either channel gone forwards or acks can no longer be resolved, closing
+            # the connection makes the broker redeliver every input that was not acked
+            print(f"Channel closed. Reason: {ex}")
+        except asyncio.CancelledError:
+            self.stopping = True
+        except Exception as ex:
+            template = "An exception of type {0} occurred. Arguments:{1!r}"
+            message = template.format(type(ex).__name__, ex.args)
+            print(message)
+        finally:
+            if ack_timer is not None:
+                ack_timer.cancel()
+            if report_timer is not None:
+                report_timer.cancel()
+            if locality_timer is not None:
+                locality_timer.cancel()
+            await self.disconnect()
+
+    # consumes on the node hosting the queue's master, connecting again to
+    # wherever the master is after the connection is lost or the master moves
+    async def run_local(self, default_node):
+        loop = asyncio.get_running_loop()
+        while not self.stopping:
+            master = await loop.run_in_executor(None, self.locator.master_node, self.queue_name)
+            if master is None:
+                print(f"Master of {self.queue_name} not found, connecting to {default_node}")
+                master = default_node
+            else:
+                print(f"Master of {self.queue_name} is on {master}")
+
+            await self.run(master)
+            if not self.stopping:
+                # the master may have failed over, ask again
+                self.locator.invalidate()
+                await asyncio.sleep(self.reconnect_delay_sec)
+
+    # everything after the processing times is keyword only, with the defaults of
+    # the class attributes
+    def consume(self, node, queue, out_queue, prefetch, processing_ms_min, processing_ms_max, *,
+                out_exchange="", latency_stamps=True, history=None, ack_batch=1, ack_interval_ms=0,
+                forward_confirms=True, report_sec=0, lane_count=0, lane_key="body", locator=None,
+                locality_check_sec=10):
         self.queue_name = queue
         self.out_queue_name = out_queue
-        self.dedup_enabled = dedup_enabled
-        self.receive_channel.basic_qos(prefetch_count=prefetch)
-        self.receive_channel.basic_consume(self.callback,
-                      queue=self.queue_name,
-                      no_ack=False)
+        self.out_exchange = out_exchange
+        self.latency_stamps = latency_stamps
+        self.prefetch = prefetch
+        self.dedup_enabled = history is not None
+        self.history = history
+        self.forward_confirms = forward_confirms
+        self.report_sec = report_sec
+        self.lane_key = lane_key
+        self.lane_count = lane_count
+        self.locator = locator
+        self.locality_check_sec = locality_check_sec
+
+        # the broker stops delivering once prefetch messages are unacked, so a batch can never be larger
+        if prefetch > 0 and ack_batch > prefetch:
+            print(f"Ack batch {ack_batch} is larger than the prefetch, acking every {prefetch} messages instead")
+            ack_batch = prefetch
+        elif prefetch > 0 and ack_batch == 0:
+            ack_batch = prefetch
+        if ack_batch == 0 and ack_interval_ms == 0:
+            print("An ack batch of 0 needs a prefetch or an ack interval, acking every message instead")
+            ack_batch = 1
+        self.ack_batch = ack_batch
+        self.ack_interval_ms = ack_interval_ms
 
         self.processing_ms_min = processing_ms_min
         self.processing_ms_max = processing_ms_max
 
         try:
-            self.receive_channel.start_consuming()
+            if self.locator is not None:
+                asyncio.run(self.run_local(node))
+            else:
+                asyncio.run(self.run(node))
         except KeyboardInterrupt:
-            self.disconnect()
-        except Exception as ex:
-            template = "An exception of type {0} occurred. Arguments:{1!r}"
-            message = template.format(type(ex).__name__, ex.args)
-            print(message) 
-                    
-    def disconnect(self):
-        self.connection.close()
+            pass
+
+        if self.report_sec > 0:
+            print(f"Progress: consumed {self.msg_count}", flush=True)
+        if self.acks is not None:
+            print(self.acks.stats())
+        if self.pipeline is not None:
+            print(self.pipeline.stats())
+        if self.lanes is not None:
+            print(self.lanes.stats())
+        if self.locator is not None:
+            print(self.locator.stats())
+        if self.dedup_enabled:
+            print(self.history.stats())
+            if isinstance(self.history, MappedDedupLog):
+                self.history.close()
+
+    async def disconnect(self):
+        if self.lanes is not None:
+            self.lanes.shutdown()
+        if self.pipeline is not None:
+            # forwards still waiting for a confirm stay unacked and are redelivered
+            self.pipeline.reset()
+        if self.acks is not None:
+            self.acks.flush()
+        if self.connection is not None:
+            await self.connection.close()
+            print("Connection closed. Reason: " + str(self.connection.closed.result()))
+            self.connection = None
 
 args = get_args(sys.argv)
 
 connect_node = get_optional_arg(args, "--node", "rabbitmq1") 
 queue = get_mandatory_arg(args, "--in-queue") 
-out_queue = get_mandatory_arg(args, "--out-queue") 
+out_queue = get_optional_arg(args, "--out-queue", "")
+# --out-exchange publishes to an exchange with the body's key as routing key instead,
+# e.g. the hash exchange feeding the shards of output-consumer.py --shards
+out_exchange = get_optional_arg(args, "--out-exchange", "")
+# forwarded messages get consume_ns and forward_ns headers for the hop latencies
+# output-consumer.py reports, the producer's publish time is kept as it is
+latency_stamps = get_optional_arg(args, "--latency-stamps", "true") == "true"
+if not out_queue and not out_exchange:
+    print("Missing mandatory argument --out-queue (or --out-exchange)")
+    exit(1)
 prefetch =  int(get_optional_arg(args, "--prefetch", "1"))
 processing_ms_min = int(get_optional_arg(args, "--min-ms", "0")) 
 processing_ms_max = int(get_optional_arg(args, "--max-ms", "0")) 
+# acks are sent with multiple=True once --ack-batch are pending (0 for no count limit)
+# or the oldest pending ack is --ack-interval-ms old, works best with a large --prefetch
+ack_batch = int(get_optional_arg(args, "--ack-batch", "1"))
+ack_interval_ms = int(get_optional_arg(args, "--ack-interval-ms", "0"))
+# inputs are only acked once their forwarded copy is confirmed by the broker
+forward_confirms = get_optional_arg(args, "--forward-confirms", "true") == "true"
+# --lanes N processes messages on N threads, messages with the same --lane-key
+# (body: the key of a "key=value" body or the key id of a binary one, or routing-key)
+# always use the same thread
+# so that per key order is kept, 0 processes them one at a time on the event loop
+lane_count = int(get_optional_arg(args, "--lanes", "0"))
+lane_key = get_optional_arg(args, "--lane-key", "body")
+# prints the number of consumed messages every --report-sec seconds (0 to disable)
+report_sec = float(get_optional_arg(args, "--report-sec", "0"))
+# --locality true connects to the node hosting the queue's master, found with the
+# management API of the first reachable of --cluster-size nodes, and follows the
+# master when it moves. --node is only used when the master can't be looked up
+locality = get_optional_arg(args, "--locality", "false") == "true"
+locality_check_sec = float(get_optional_arg(args, "--locality-check-sec", "10"))
+node_count = int(get_optional_arg(args, "--cluster-size", "3"))
 dedup_enabled = get_optional_arg(args, "--dedup", "false") == "true"
+dedup_mode = get_optional_arg(args, "--dedup-mode", "exact")
+dedup_window_sec = int(get_optional_arg(args, "--dedup-window-sec", "300"))
+dedup_max_entries = int(get_optional_arg(args, "--dedup-max-entries", "1000000"))
+dedup_capacity = int(get_optional_arg(args, "--dedup-capacity", "10000000"))
+dedup_fp_rate = float(get_optional_arg(args, "--dedup-fp-rate", "0.001"))
+dedup_file = get_optional_arg(args, "--dedup-file", f"dedup-{queue}.log")
+dedup_slots = int(get_optional_arg(args, "--dedup-slots", "1000000"))
+
+history = None
+if dedup_enabled:
+    if dedup_mode == "exact":
+        history = DedupCache(dedup_window_sec, dedup_max_entries)
+    elif dedup_mode == "bloom":
+        history = RotatingBloomFilter(dedup_window_sec, dedup_capacity, dedup_fp_rate)
+    elif dedup_mode == "mmap":
+        # survives consumer restarts, redeliveries of messages processed before a crash are still detected
+        history = MappedDedupLog(dedup_file, dedup_window_sec, dedup_slots)
+        print(history.stats())
+    else:
+        print(f"Unknown dedup mode {dedup_mode}, use exact, bloom or mmap")
+        exit(1)
+
+locator = None
+if locality:
+    # the management API of --node is asked first
+    mgmt_nodes = [connect_node] + [name for name in cluster_node_names(node_count) if name != connect_node]
+    locator = QueueLocator(mgmt_nodes, ttl_sec=locality_check_sec)
 
-print(f"Consuming queue: {queue} Writing to: {out_queue}")
+print(f"Consuming queue: {queue} Writing to: {out_exchange or out_queue}")
 
 consumer = RabbitConsumer()
-consumer.connect(connect_node)
-consumer.consume(queue, out_queue, prefetch, processing_ms_min, processing_ms_max, dedup_enabled)
+consumer.consume(connect_node, queue, out_queue, prefetch, processing_ms_min, processing_ms_max,
+                 out_exchange=out_exchange,
+                 latency_stamps=latency_stamps,
+                 history=history,
+                 ack_batch=ack_batch,
+                 ack_interval_ms=ack_interval_ms,
+                 forward_confirms=forward_confirms,
+                 report_sec=report_sec,
+                 lane_count=lane_count,
+                 lane_key=lane_key,
+                 locator=locator,
+                 locality_check_sec=locality_check_sec)
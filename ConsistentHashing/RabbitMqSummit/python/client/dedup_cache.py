@@ -0,0 +1,84 @@
+import time
+import uuid
+from collections import OrderedDict
+
+# Correlation ids are UUID strings, storing their 16 raw bytes instead of the
+# 36 char string keeps the per entry cost down. Anything that is not a UUID is
+# stored as its utf-8 bytes.
+def to_key(correlation_id):
+    if isinstance(correlation_id, bytes):
+        return correlation_id
+    # only uuid strings are parsed, counter based ids skip the failing parse
+    if not isinstance(correlation_id, str) or len(correlation_id) != 36:
+        return str(correlation_id).encode('utf-8')
+    try:
+        return uuid.UUID(correlation_id).bytes
+    except (ValueError, AttributeError, TypeError):
+        return str(correlation_id).encode('utf-8')
+
+# Exact deduplication store with a time window and a memory cap.
+# Entries are kept in last-seen order so the oldest are always at the front.
+# Every call expires at most a handful of old entries from the front, spreading
+# the expiry work over the message stream instead of clearing all at once.
+# When the cap is reached the least recently seen entry is evicted.
+class DedupCache:
+
+    def __init__(self, window_sec=300, max_entries=1000000, expire_batch=8):
+        self.window_sec = window_sec
+        self.max_entries = max_entries
+        self.expire_batch = expire_batch
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    # returns True when the correlation id was already seen within the window
+    def contains(self, correlation_id, now=None):
+        if now is None:
+            now = time.monotonic()
+        self.expire(now, self.expire_batch)
+
+        key = to_key(correlation_id)
+        last_seen = self.entries.get(key)
+        if last_seen is not None and now - last_seen <= self.window_sec:
+            self.hits += 1
+            self.entries[key] = now
+            self.entries.move_to_end(key)
+            return True
+
+        self.misses += 1
+        return False
+
+    def add(self, correlation_id, now=None):
+        if now is None:
+            now = time.monotonic()
+        key = to_key(correlation_id)
+        self.entries[key] = now
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+
+    # checks and records in one step, returns True for a duplicate
+    def seen(self, correlation_id, now=None):
+        if self.contains(correlation_id, now):
+            return True
+        self.add(correlation_id, now)
+        return False
+
+    def expire(self, now, limit):
+        cutoff = now - self.window_sec
+        while limit > 0 and self.entries:
+            key, last_seen = next(iter(self.entries.items()))
+            if last_seen >= cutoff:
+                break
+            del self.entries[key]
+            self.expired += 1
+            limit -= 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return f"Dedup entries: {len(self.entries)} hits: {self.hits} misses: {self.misses} expired: {self.expired} evicted: {self.evicted}"
@@ -0,0 +1,118 @@
+import time
+import random
+
+# Helpers for reconnecting to the cluster after a connection is lost.
+#
+# Backoff: the delay after a pass over the cluster in which no node could be
+# reached doubles from base_sec up to max_sec, with "equal jitter" (a random
+# delay between half and all of it) so that many clients losing the same node
+# do not all come back at the same moment.
+#
+# NodeHealth: remembers when each node last accepted a connection and when a
+# connection to it last failed or was lost. Nodes that answered recently are
+# tried first, most recent first, and nodes that failed recently last, so after
+# losing a node a client goes straight to one that is known to be up instead of
+# waiting on the dead one again. Works for any number of nodes.
+
+class Backoff:
+
+    def __init__(self, base_sec=0.05, max_sec=5.0, rng=None):
+        self.base_sec = base_sec
+        self.max_sec = max_sec
+        self.rng = rng or random.Random()
+        self.attempts = 0
+
+    def next_delay(self):
+        delay = min(self.max_sec, self.base_sec * (2 ** self.attempts))
+        self.attempts += 1
+        return delay / 2 + self.rng.uniform(0, delay / 2)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class NodeHealth:
+
+    # a failure is forgotten after failure_ttl_sec, the node is then tried in
+    # its normal turn again
+    def __init__(self, failure_ttl_sec=30):
+        self.failure_ttl_sec = failure_ttl_sec
+        self.last_success = dict()
+        self.last_failure = dict()
+
+    def succeeded(self, index):
+        self.last_success[index] = time.monotonic()
+        self.last_failure.pop(index, None)
+
+    def failed(self, index):
+        self.last_failure[index] = time.monotonic()
+
+    def recently_failed(self, index, now):
+        failed_at = self.last_failure.get(index)
+        return failed_at is not None and now - failed_at < self.failure_ttl_sec
+
+    # the node indexes in the order to try them: start_index unless it failed
+    # recently, then the nodes that answered, most recent first, then the others
+    # in ring order from start_index and last those that failed recently, the
+    # oldest failure first
+    def order(self, node_count, start_index):
+        now = time.monotonic()
+        ring = [(start_index + i) % node_count for i in range(node_count)]
+        failed = sorted([i for i in ring if self.recently_failed(i, now)], key=lambda i: self.last_failure[i])
+        healthy = [i for i in ring if not self.recently_failed(i, now)]
+        first = [start_index] if start_index in healthy else []
+        answered = sorted([i for i in healthy if i in self.last_success and i not in first],
+                          key=lambda i: -self.last_success[i])
+        rest = [i for i in healthy if i not in first and i not in answered]
+        return first + answered + rest + failed
+
+
+# shared by every connection of the process, what one connection learns about a
+# node the others use
+cluster_health = NodeHealth()
+
+
+# what the failovers of a publisher cost: per failover the time from noticing
+# the loss to the new connection's channels being open (reconnect) and to the
+# first confirm on it (resume), and how many unconfirmed messages were
+# republished, which may reach the queue twice, or lost, without republishing
+class FailoverStats:
+
+    def __init__(self):
+        self.failovers = 0
+        self.republished = 0
+        self.lost = 0
+        self.reconnect_sec = list()
+        self.resume_sec = list()
+
+    def merge(self, other):
+        self.failovers += other.failovers
+        self.republished += other.republished
+        self.lost += other.lost
+        self.reconnect_sec += other.reconnect_sec
+        self.resume_sec += other.resume_sec
+        return self
+
+    def to_dict(self):
+        return {"failovers": self.failovers, "republished": self.republished, "lost": self.lost,
+                "reconnect_sec": self.reconnect_sec, "resume_sec": self.resume_sec}
+
+    @classmethod
+    def from_dict(cls, values):
+        stats = cls()
+        stats.failovers = values["failovers"]
+        stats.republished = values["republished"]
+        stats.lost = values["lost"]
+        stats.reconnect_sec = list(values["reconnect_sec"])
+        stats.resume_sec = list(values["resume_sec"])
+        return stats
+
+    def summary(self):
+        if self.failovers == 0:
+            return "Failovers: 0"
+        text = f"Failovers: {self.failovers} republished: {self.republished} lost: {self.lost}"
+        if self.reconnect_sec:
+            text += f" reconnect max: {max(self.reconnect_sec) * 1000:.0f}ms"
+        if self.resume_sec:
+            text += f" resume avg: {sum(self.resume_sec) / len(self.resume_sec) * 1000:.0f}ms max: {max(self.resume_sec) * 1000:.0f}ms"
+        return text
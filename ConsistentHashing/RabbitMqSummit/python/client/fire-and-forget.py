@@ -1,84 +1,66 @@
 #!/usr/bin/env python
-import pika
 import sys
-import time
-import subprocess
+import asyncio
+from command_args import get_args, get_optional_arg
+from token_bucket import TokenBucket
+from message_template import MessageTemplate
+from rabbit_client import resolve_node_list, get_node_index, connect_to_cluster, Publisher, ConnectionLost
+from failover import cluster_health
 
 target_node = sys.argv[1]
 count = int(sys.argv[2])
 queue = sys.argv[3]
 
-node_names = ['rabbitmq1', 'rabbitmq2', 'rabbitmq3']
-nodes = list()
-
-def get_node_index(node_name):
-    index = 0
-    for node in node_names:
-        if node == node_name:
-            return index
-
-        index +=1
+args = get_args(sys.argv[:1] + sys.argv[4:])
+# a steady target of messages per second, 0 publishes as fast as possible
+rate = float(get_optional_arg(args, "--rate", "0"))
+rate_limiter = TokenBucket(rate) if rate > 0 else None
 
-    return -1
-
-def connect():
-    global target_node, nodes, curr_node
-    curr_node = get_node_index(target_node)
-    while True:
-        try:
-            credentials = pika.credentials.PlainCredentials('jack', 'jack')
-            connection = pika.BlockingConnection(pika.ConnectionParameters(host=nodes[curr_node], port=5672, credentials=credentials))
-            channel = connection.channel()
-            print("Connected to " + nodes[curr_node])
-            return channel
-        except:
-            curr_node += 1
-            if curr_node > 2:
-                print("Could not connect. Trying again in 5 seconds")
-                time.sleep(5)
-                curr_node  = 0
+node_names = ['rabbitmq1', 'rabbitmq2', 'rabbitmq3']
 
-def get_node_ip(node_name):
-    bash_command = "bash ../cluster/get-node-ip.sh " + node_name
-    process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE)
-    output, error = process.communicate()
-    ip = output.decode('ascii').replace('\n', '')
-    return ip
+msg = "jkhfjhjhsjsdhusdhfyfjkw4rtjn23jrnw3jkrjkwefbjsdbfjksdfsdbfbwdjhfbwejkbrjk23rjkwejkfwejkfsajkfsjkdfjksdfjksdbfjksdfjksejkdfjksdhfuiowehf3478y7834uhfuwenfnweuih34789hrtui234enfunqwef8934jhtui42398fh3uiht"
 
-for node_name in node_names:
-    nodes.append(get_node_ip(node_name))
+properties = MessageTemplate(content_type='text/plain', delivery_mode=2)
 
-channel = connect()
+async def connect(nodes, curr_node):
+    connection, curr_node = await connect_to_cluster(nodes, node_names, curr_node)
+    publisher = await Publisher(connection, confirms=False, rate_limiter=rate_limiter).open()
+    print("Connected to " + nodes[curr_node])
+    return connection, publisher, curr_node
 
-success = 0
-fail = 0
-sent = 0
+async def main():
+    nodes = resolve_node_list(node_names)
+    connection, publisher, curr_node = await connect(nodes, get_node_index(node_names, target_node))
 
-msg = "jkhfjhjhsjsdhusdhfyfjkw4rtjn23jrnw3jkrjkwefbjsdbfjksdfsdbfbwdjhfbwejkbrjk23rjkwejkfwejkfsajkfsjkdfjksdfjksdbfjksdfjksejkdfjksdhfuiowehf3478y7834uhfuwenfnweuih34789hrtui234enfunqwef8934jhtui42398fh3uiht"
+    success = 0
+    fail = 0
+    sent = 0
 
-for x in range(count):
-    try:
-        if channel.basic_publish(exchange='',
-                            routing_key=queue,
-                            body=msg,
-                            properties=pika.BasicProperties(content_type='text/plain',
-                                                            delivery_mode=2)):
-            success += 1       
-        else:
+    while sent < count:
+        try:
+            await publisher.publish(exchange='',
+                                    routing_key=queue,
+                                    body=msg,
+                                    properties=properties)
+            success += 1
+            sent += 1
+            if sent % 10000 == 0:
+                print("Success: " + str(success) + " Failed: " + str(fail))
+        except ConnectionLost:
+            # retry the message on a new connection, the lost node is tried last
+            print("Connection closed.")
             fail += 1
+            cluster_health.failed(curr_node)
+            await connection.close()
+            connection, publisher, curr_node = await connect(nodes, curr_node)
 
-        sent += 1
-        if sent % 10000 == 0:
-            print("Success: " + str(success) + " Failed: " + str(fail))
-    except pika.exceptions.ConnectionClosed:
-        print("Connection closed.")
-        time.sleep(5)
-        channel = connect()
-        count += 1 # retry it
+    await asyncio.sleep(10)
+    print("Sent " + str(sent) + " messages")
+    chan = await connection.channel()
+    res = await connection.rpc(chan, chan.queue_declare, queue=queue, durable=True, arguments={"x-queue-mode": "lazy"})
+    message_count = res.method.message_count
+    print(str(message_count) + " messages in the queue")
+    print(str(success - message_count) + " messages lost")
+    await connection.close()
 
-time.sleep(10)
-print("Sent " + str(sent) + " messages")
-res = channel.queue_declare(queue=queue, durable=True, arguments={"x-queue-mode": "lazy"})
-message_count = res.method.message_count
-print(str(message_count) + " messages in the queue")
-print(str(success - message_count) + " messages lost")
+asyncio.run(main())
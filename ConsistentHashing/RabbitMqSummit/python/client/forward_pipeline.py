@@ -0,0 +1,86 @@
+from collections import deque
+
+PENDING = 0
+CONFIRMED = 1
+FAILED = 2
+DROPPED = 3
+
+# At-least-once forwarding without waiting on each publish.
+# Every input delivery gets an entry, in delivery order, that is resolved by the
+# publisher confirm future of its forwarded copy. Only the front run of resolved
+# entries is released: confirmed ones are acked together with one multiple=True
+# ack on the input channel, nacked ones are requeued so they get forwarded again.
+# An input is therefore never acked before its output is safely with the broker,
+# while as many forwards as the prefetch allows are in flight at once.
+class ForwardPipeline:
+
+    def __init__(self, acks, on_forwarded=None):
+        self.acks = acks
+        self.on_forwarded = on_forwarded
+        self.entries = deque()
+        self.pending = 0
+        self.forwarded = 0
+        self.requeued = 0
+
+    # forgets every entry, for when the input channel is going away and its
+    # unacked deliveries will be redelivered anyway
+    def reset(self):
+        for entry in self.entries:
+            entry[1] = DROPPED
+        self.entries.clear()
+        self.pending = 0
+
+    def in_flight(self):
+        return self.pending
+
+    # call straight after publishing the forwarded copy of an input delivery,
+    # confirmed is the future returned by Publisher.publish_nowait
+    def published(self, in_tag, confirmed, correlation_id=None):
+        entry = [in_tag, PENDING, correlation_id, True]
+        self.entries.append(entry)
+        self.pending += 1
+        confirmed.add_done_callback(lambda future: self.resolve(entry, future))
+
+    # an input that needs no output (e.g. a detected duplicate) still has to wait
+    # for the inputs before it, as the multiple=True ack would cover them
+    def skipped(self, in_tag):
+        self.entries.append([in_tag, CONFIRMED, None, False])
+        self.release()
+
+    def resolve(self, entry, future):
+        # a cancelled future means the output channel closed, the input is redelivered
+        if entry[1] != PENDING or future.cancelled():
+            return
+        entry[1] = CONFIRMED if future.result() else FAILED
+        self.pending -= 1
+        self.release()
+
+    def release(self):
+        entries = self.entries
+        confirmed_tag = 0
+        confirmed = 0
+        while entries and entries[0][1] != PENDING:
+            in_tag, state, correlation_id, was_forwarded = entries.popleft()
+            if state == CONFIRMED:
+                confirmed_tag = in_tag
+                confirmed += 1
+                if was_forwarded:
+                    self.forwarded += 1
+                    if self.on_forwarded is not None and correlation_id is not None:
+                        self.on_forwarded(correlation_id)
+            else:
+                # ack what came before so the nack does not get folded into a multiple ack
+                if confirmed > 0:
+                    self.acks.ack_multiple(confirmed_tag, confirmed)
+                    confirmed = 0
+                self.acks.flush()
+                # on a closed input channel the input is redelivered without the nack
+                if self.acks.channel.is_open:
+                    self.acks.channel.basic_nack(delivery_tag=in_tag, multiple=False, requeue=True)
+                    self.requeued += 1
+
+        if confirmed > 0:
+            self.acks.ack_multiple(confirmed_tag, confirmed)
+
+    def stats(self):
+        return f"Forwarded and confirmed: {self.forwarded} requeued after nack: {self.requeued} in flight: {self.in_flight()}"
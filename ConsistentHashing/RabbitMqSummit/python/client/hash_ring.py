@@ -0,0 +1,347 @@
+import os
+import re
+import json
+import random
+import bisect
+import subprocess
+import numpy as np
+
+# Client side copy of the x-consistent-hash exchange's routing in RabbitMQ 3.7.7
+# and before, the version the cluster/blockade files pin. Every binding with
+# weight W (its binding key, "10" in declare-hashing-infra.py) adds W points,
+# picked at random in [0, 2^27), to the exchange's ring. A message goes to the
+# queue owning the first point >= erlang:phash2(Routes, 2^27), wrapping around to
+# the lowest point. Routes is the message's list of routing keys, [RoutingKey]
+# for the scripts here as none of them set CC or BCC headers.
+# As the points are random, exact placement needs the exchange's actual ring,
+# which HashRing.fetch reads from a node. HashRing.random_ring builds a ring the
+# way the exchange does, for simulations.
+# From 3.7.8 the exchange uses jump consistent hashing over a chx_hash_ring
+# table instead, which is not modelled here, HashRing.fetch refuses those nodes.
+#
+# phash2 of a binary is Erlang's make_hash2: Bob Jenkins' lookup2 block hash
+# seeded with HCONST_13. For the one element list the exchange hashes,
+# make_hash2 hashes the binary and then mixes in the [] tail with HCONST_2,
+# which is route_hash. Both are ports of erts' utils.c that are only trusted
+# once they reproduce known answers captured from a node running the pinned
+# version (cluster/capture-hash-vectors.py writes them to hash-vectors.json).
+# verify_client_routing refuses client side routing until then.
+# The bulk versions (*_bulk, KeyBatch, HashRing.queue_indices) hash and route
+# many keys at once with numpy, which requirements.txt pins.
+
+PHASH2_RANGE = 1 << 27
+GOLDEN_RATIO = 0x9e3779b9
+HCONST_2 = (GOLDEN_RATIO * 2) & 0xffffffff
+HCONST_13 = (GOLDEN_RATIO * 13) & 0xffffffff
+# the tag erts mixes in for the [] ending a list
+NIL_DEF = 0x2
+MASK32 = 0xffffffff
+# the last version whose exchange routes with the ring of random points
+RING_MAX_VERSION = (3, 7, 7)
+VECTORS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hash-vectors.json")
+
+def mix(a, b, c):
+    a = (a - b - c) & MASK32; a ^= c >> 13
+    b = (b - c - a) & MASK32; b ^= (a << 8) & MASK32
+    c = (c - a - b) & MASK32; c ^= b >> 13
+    a = (a - b - c) & MASK32; a ^= c >> 12
+    b = (b - c - a) & MASK32; b ^= (a << 16) & MASK32
+    c = (c - a - b) & MASK32; c ^= b >> 5
+    a = (a - b - c) & MASK32; a ^= c >> 3
+    b = (b - c - a) & MASK32; b ^= (a << 10) & MASK32
+    c = (c - a - b) & MASK32; c ^= b >> 15
+    return a, b, c
+
+def block_hash(data, initval):
+    a = b = GOLDEN_RATIO
+    c = initval
+    length = len(data)
+    offset = 0
+    while length - offset >= 12:
+        a = (a + int.from_bytes(data[offset:offset+4], 'little')) & MASK32
+        b = (b + int.from_bytes(data[offset+4:offset+8], 'little')) & MASK32
+        c = (c + int.from_bytes(data[offset+8:offset+12], 'little')) & MASK32
+        a, b, c = mix(a, b, c)
+        offset += 12
+
+    # the last 1-11 bytes, the lowest byte of c is taken by the length
+    tail = data[offset:]
+    c = (c + length) & MASK32
+    a = (a + int.from_bytes(tail[0:4], 'little')) & MASK32
+    b = (b + int.from_bytes(tail[4:8], 'little')) & MASK32
+    c = (c + (int.from_bytes(tail[8:11], 'little') << 8)) & MASK32
+    a, b, c = mix(a, b, c)
+    return c
+
+def to_bytes(key):
+    if isinstance(key, str):
+        return key.encode('utf-8')
+    return bytes(key)
+
+# make_hash2 of a binary, before the range is applied
+def binary_hash(data):
+    if len(data) == 0:
+        return HCONST_13
+    return block_hash(data, HCONST_13)
+
+# erlang:phash2(Binary, Range) for a power of two range
+def phash2(key, hash_range=PHASH2_RANGE):
+    return binary_hash(to_bytes(key)) & (hash_range - 1)
+
+# erlang:phash2([RoutingKey], Range), the hash the exchange routes a message by
+def route_hash(routing_key, hash_range=PHASH2_RANGE):
+    _, _, hash_value = mix((HCONST_2 + NIL_DEF) & MASK32, HCONST_2, binary_hash(to_bytes(routing_key)))
+    return hash_value & (hash_range - 1)
+
+def parse_version(text):
+    return tuple(int(part) for part in re.findall(r'\d+', text)[:3])
+
+def uses_point_ring(version):
+    return parse_version(version) <= RING_MAX_VERSION
+
+def rabbitmqctl_eval(node_name, expression):
+    command = ["docker", "exec", node_name, "rabbitmqctl", "eval", expression]
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return process.stdout.decode('utf-8'), process.stderr.decode('utf-8').strip()
+
+def node_version(node_name):
+    output, error = rabbitmqctl_eval(node_name, "rabbit_misc:version().")
+    match = re.search(r'"([^"]+)"', output)
+    if match is None:
+        raise ValueError(f"Could not read the RabbitMQ version of {node_name}: {error}")
+    return match.group(1)
+
+# the known answers of cluster/capture-hash-vectors.py, None when none were captured
+def load_vectors(path=VECTORS_FILE):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+# why the client's routing can not be trusted to match a node running version,
+# nothing once it reproduces every answer captured from a node of that version
+def client_routing_problems(version, vectors):
+    if not uses_point_ring(version):
+        return [f"RabbitMQ {version} routes with jump consistent hashing, which is not modelled"]
+    if vectors is None:
+        return ["no known-answer vectors were captured, run cluster/capture-hash-vectors.py"]
+
+    problems = list()
+    if vectors["rabbitmq_version"] != version:
+        problems.append(f"the vectors were captured from RabbitMQ {vectors['rabbitmq_version']}, not {version}")
+    wrong_hashes = [vector["key"] for vector in vectors["hashes"]
+                    if phash2(vector["key"]) != vector["phash2"] or route_hash(vector["key"]) != vector["route_hash"]]
+    if wrong_hashes:
+        problems.append(f"{len(wrong_hashes)} of {len(vectors['hashes'])} captured hashes differ, e.g. key '{wrong_hashes[0]}'")
+    ring = HashRing(vectors["ring"])
+    wrong_routes = [route["key"] for route in vectors["routes"] if ring.queue_for(route["key"]) != route["queue"]]
+    if wrong_routes:
+        problems.append(f"{len(wrong_routes)} of {len(vectors['routes'])} captured routes differ, e.g. key '{wrong_routes[0]}'")
+    return problems
+
+# raises ValueError unless keys can be routed client side for the node
+def verify_client_routing(node_name):
+    problems = client_routing_problems(node_version(node_name), load_vectors())
+    if problems:
+        raise ValueError(f"Client side routing is not verified for {node_name}: " + "; ".join(problems))
+
+
+class HashRing:
+
+    # points: (point, queue name) pairs
+    def __init__(self, points):
+        points = sorted(points)
+        self.points = [point for point, _ in points]
+        self.queues = sorted(set(queue for _, queue in points))
+        queue_index = {queue: i for i, queue in enumerate(self.queues)}
+        self.owners = [queue_index[queue] for _, queue in points]
+        self.np_points = None
+        self.np_owners = None
+
+    # picks weight distinct random points per queue like the exchange does
+    # when the queue is bound, weights is one weight for all or one per queue
+    @classmethod
+    def random_ring(cls, queues, weights, seed=None):
+        rng = random.Random(seed)
+        if isinstance(weights, int):
+            weights = [weights] * len(queues)
+        taken = set()
+        points = list()
+        for queue, weight in zip(queues, weights):
+            added = 0
+            while added < weight:
+                point = rng.randrange(PHASH2_RANGE)
+                if point not in taken:
+                    taken.add(point)
+                    points.append((point, queue))
+                    added += 1
+        return cls(points)
+
+    # reads the ring of an exchange from the node's bucket table with rabbitmqctl,
+    # which only nodes up to RING_MAX_VERSION have
+    @classmethod
+    def fetch(cls, node_name, exchange, vhost="/"):
+        version = node_version(node_name)
+        if not uses_point_ring(version):
+            raise ValueError(f"{node_name} runs RabbitMQ {version}, whose consistent hash exchange uses jump "
+                             f"consistent hashing and has no ring of points")
+        expression = ("[{N, element(4, D)} || {bucket, {{resource, VH, exchange, X}, N}, D, _} "
+                      "<- ets:tab2list(rabbit_exchange_type_consistent_hash), "
+                      f"VH =:= <<\"{vhost}\">>, X =:= <<\"{exchange}\">>].")
+        output, error = rabbitmqctl_eval(node_name, expression)
+        points = [(int(point), queue) for point, queue in re.findall(r'\{(\d+),\s*<<"([^"]*)">>\}', output)]
+        if not points:
+            raise ValueError(f"No ring found for exchange {exchange} on {node_name}: {error}")
+        return cls(points)
+
+    def owner_of_hash(self, hash_value):
+        index = bisect.bisect_left(self.points, hash_value)
+        if index == len(self.points):
+            index = 0
+        return self.owners[index]
+
+    def queue_for(self, routing_key):
+        return self.queues[self.owner_of_hash(route_hash(routing_key))]
+
+    # vectorized: queue indices (into self.queues) for many routing keys at once,
+    # keys is a sequence of str/bytes or a KeyBatch
+    def queue_indices(self, keys):
+        return self.queue_indices_of_hashes(route_hash_bulk(keys))
+
+    # the same for keys already hashed with route_hash_bulk, so many rings can be
+    # compared without hashing the keys again
+    def queue_indices_of_hashes(self, hashes):
+        if self.np_points is None:
+            self.np_points = np.array(self.points, dtype=np.uint32)
+            self.np_owners = np.array(self.owners, dtype=np.int32)
+
+        index = np.searchsorted(self.np_points, hashes, side='left')
+        index[index == len(self.np_points)] = 0
+        return self.np_owners[index]
+
+    def queues_for(self, keys):
+        return [self.queues[i] for i in self.queue_indices(keys)]
+
+
+# keys of one length packed as rows of a uint8 matrix, which is what the bulk
+# hash works on, built once and reused across rings
+class KeyBatch:
+
+    def __init__(self, groups, count):
+        # groups: (row positions, uint8 matrix with one key per row)
+        self.groups = groups
+        self.count = count
+
+    @classmethod
+    def from_keys(cls, keys):
+        by_length = dict()
+        for position, key in enumerate(keys):
+            data = to_bytes(key)
+            by_length.setdefault(len(data), ([], []))
+            positions, values = by_length[len(data)]
+            positions.append(position)
+            values.append(data)
+
+        groups = list()
+        count = 0
+        for length, (positions, values) in by_length.items():
+            matrix = np.frombuffer(b"".join(values), dtype=np.uint8).reshape(len(values), length)
+            groups.append((np.array(positions, dtype=np.int64), matrix))
+            count += len(positions)
+        return cls(groups, count)
+
+    # decimal text of integer keys with an optional prefix ("key" + "123"),
+    # without creating a python string per key
+    @classmethod
+    def from_ints(cls, values, prefix=""):
+        values = np.asarray(values, dtype=np.int64)
+        prefix_bytes = np.frombuffer(prefix.encode('utf-8'), dtype=np.uint8)
+        digits = np.ones(len(values), dtype=np.int64)
+        limit = np.full(len(values), 10, dtype=np.int64)
+        while True:
+            more = values >= limit
+            if not more.any():
+                break
+            digits += more
+            limit *= 10
+
+        groups = list()
+        for digit_count in np.unique(digits):
+            positions = np.nonzero(digits == digit_count)[0]
+            group_values = values[positions]
+            matrix = np.empty((len(positions), len(prefix_bytes) + digit_count), dtype=np.uint8)
+            matrix[:, :len(prefix_bytes)] = prefix_bytes
+            for column in range(digit_count - 1, -1, -1):
+                matrix[:, len(prefix_bytes) + column] = ord('0') + group_values % 10
+                group_values = group_values // 10
+            groups.append((positions, matrix))
+        return cls(groups, len(values))
+
+
+def vector_mix(a, b, c):
+    a -= b; a -= c; a ^= c >> 13
+    b -= c; b -= a; b ^= a << 8
+    c -= a; c -= b; c ^= b >> 13
+    a -= b; a -= c; a ^= c >> 12
+    b -= c; b -= a; b ^= a << 16
+    c -= a; c -= b; c ^= b >> 5
+    a -= b; a -= c; a ^= c >> 3
+    b -= c; b -= a; b ^= a << 10
+    c -= a; c -= b; c ^= b >> 15
+
+def vector_word(matrix, start, end):
+    word = np.zeros(matrix.shape[0], dtype=np.uint32)
+    for i in range(start, min(end, matrix.shape[1])):
+        word += matrix[:, i].astype(np.uint32) << np.uint32(8 * (i - start))
+    return word
+
+# make_hash2 of every row of a uint8 matrix of equal length keys, uint32
+# wraparound does the 32 bit masking of the scalar version
+def block_hash_rows(matrix, initval):
+    rows, length = matrix.shape
+    a = np.full(rows, GOLDEN_RATIO, dtype=np.uint32)
+    b = np.full(rows, GOLDEN_RATIO, dtype=np.uint32)
+    c = np.full(rows, initval, dtype=np.uint32)
+    offset = 0
+    while length - offset >= 12:
+        a += vector_word(matrix, offset, offset + 4)
+        b += vector_word(matrix, offset + 4, offset + 8)
+        c += vector_word(matrix, offset + 8, offset + 12)
+        vector_mix(a, b, c)
+        offset += 12
+
+    tail = matrix[:, offset:]
+    c += np.uint32(length & MASK32)
+    a += vector_word(tail, 0, 4)
+    b += vector_word(tail, 4, 8)
+    c += vector_word(tail, 8, 11) << np.uint32(8)
+    vector_mix(a, b, c)
+    return c
+
+# binary_hash of many keys, a sequence of str/bytes or a KeyBatch
+def binary_hash_bulk(keys):
+    if not isinstance(keys, KeyBatch):
+        keys = KeyBatch.from_keys(keys)
+
+    hashes = np.empty(keys.count, dtype=np.uint32)
+    with np.errstate(over='ignore'):
+        for positions, matrix in keys.groups:
+            if matrix.shape[1] == 0:
+                hashes[positions] = HCONST_13
+            else:
+                hashes[positions] = block_hash_rows(matrix, HCONST_13)
+    return hashes
+
+def phash2_bulk(keys, hash_range=PHASH2_RANGE):
+    hashes = binary_hash_bulk(keys)
+    hashes &= np.uint32(hash_range - 1)
+    return hashes
+
+def route_hash_bulk(keys, hash_range=PHASH2_RANGE):
+    hashes = binary_hash_bulk(keys)
+    a = np.full(len(hashes), (HCONST_2 + NIL_DEF) & MASK32, dtype=np.uint32)
+    b = np.full(len(hashes), HCONST_2, dtype=np.uint32)
+    with np.errstate(over='ignore'):
+        vector_mix(a, b, hashes)
+    hashes &= np.uint32(hash_range - 1)
+    return hashes
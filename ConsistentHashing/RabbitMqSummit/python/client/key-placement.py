@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+import sys
+import time
+import numpy as np
+from command_args import get_args, get_mandatory_arg, get_optional_arg
+from hash_ring import HashRing, KeyBatch, verify_client_routing
+
+# Shows which partition queue of a hash exchange every key is routed to, and so
+# which consumer owns it, using the exchange's ring read from a node.
+#   python key-placement.py --ex states --keys a,b,c,d,e
+#   python key-placement.py --ex states --key-count 1000000 --key-prefix Client
+# --weight N --queue-prefix states --queue-count 20 uses a random ring built like
+# the exchange builds it instead, when there is no cluster.
+# The placement is only what the exchange does once hash_ring.py reproduces the
+# known answers captured from the node's version, a warning says when it does not.
+
+args = get_args(sys.argv)
+connect_node = get_optional_arg(args, "--node", "rabbitmq1")
+keys = get_optional_arg(args, "--keys", "")
+key_count = int(get_optional_arg(args, "--key-count", "0"))
+key_prefix = get_optional_arg(args, "--key-prefix", "")
+weight = int(get_optional_arg(args, "--weight", "0"))
+
+if weight > 0:
+    queue_prefix = get_mandatory_arg(args, "--queue-prefix")
+    queue_count = int(get_mandatory_arg(args, "--queue-count"))
+    ring = HashRing.random_ring([f"{queue_prefix}{i:03}" for i in range(1, queue_count+1)], weight)
+else:
+    ring = HashRing.fetch(connect_node, get_mandatory_arg(args, "--ex"))
+    try:
+        verify_client_routing(connect_node)
+    except ValueError as ex:
+        print(f"Warning: {ex}")
+
+print(f"Ring of {len(ring.points)} points over {len(ring.queues)} queues")
+
+if keys:
+    for key in keys.split(","):
+        print(f"{key} -> {ring.queue_for(key)}")
+
+if key_count > 0:
+    start = time.perf_counter()
+    queue_indices = ring.queue_indices(KeyBatch.from_ints(range(key_count), key_prefix))
+    elapsed = time.perf_counter() - start
+    counts = np.bincount(queue_indices, minlength=len(ring.queues))
+    print(f"Placed {key_count} keys {key_prefix}0..{key_prefix}{key_count-1} in {elapsed:.2f}s")
+    for i, queue in enumerate(ring.queues):
+        print(f"{queue}: {counts[i]} keys ({100 * counts[i] / key_count:.1f}%)")
@@ -0,0 +1,179 @@
+from array import array
+from order_verifier import key_text
+
+# HDR style histogram of latencies in microseconds. Values below 2^precision_bits
+# get a bucket each, above that every power of two range is split into
+# 2^(precision_bits-1) equal buckets, so any recorded value is within
+# 2^(1-precision_bits) of its bucket (0.8% with the default 8 bits) from one
+# microsecond up to max_us. Recording is a bit_length and an array increment.
+class LatencyHistogram:
+
+    def __init__(self, precision_bits=8, max_us=3600 * 1000000):
+        self.precision_bits = precision_bits
+        self.sub_buckets = 1 << precision_bits
+        self.half = self.sub_buckets >> 1
+        self.max_us = max_us
+        self.counts = array('q', bytes(8 * (self.index_of(max_us) + 1)))
+        self.count = 0
+        self.max = 0
+
+    def index_of(self, value):
+        exponent = value.bit_length() - self.precision_bits
+        if exponent <= 0:
+            return value
+        return exponent * self.half + (value >> exponent)
+
+    # the lowest value counted in a bucket
+    def value_of(self, index):
+        if index < self.sub_buckets:
+            return index
+        exponent = index // self.half - 1
+        return (index - exponent * self.half) << exponent
+
+    # negative latencies (clocks of two hosts apart) are counted as 0
+    def record(self, value_us):
+        if value_us < 0:
+            value_us = 0
+        elif value_us > self.max_us:
+            value_us = self.max_us
+        self.counts[self.index_of(value_us)] += 1
+        self.count += 1
+        if value_us > self.max:
+            self.max = value_us
+
+    def percentile(self, percent):
+        if self.count == 0:
+            return 0
+        target = max(1, int(self.count * percent / 100 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.value_of(index + 1) - 1, self.max)
+        return self.max
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def reset(self):
+        self.counts = array('q', bytes(8 * len(self.counts)))
+        self.count = 0
+        self.max = 0
+
+    # only the non empty buckets, as json for another process to merge
+    def state(self):
+        return {"max": self.max, "buckets": {str(index): count for index, count in enumerate(self.counts) if count}}
+
+    def merge_state(self, state):
+        for index, count in state["buckets"].items():
+            self.counts[int(index)] += count
+            self.count += count
+        self.max = max(self.max, state["max"])
+
+    def summary(self):
+        if self.count == 0:
+            return "no samples"
+        return (f"p50 {format_us(self.percentile(50))} p99 {format_us(self.percentile(99))} "
+                f"p99.9 {format_us(self.percentile(99.9))} max {format_us(self.max)} ({self.count})")
+
+
+def format_us(value_us):
+    if value_us >= 1000000:
+        return f"{value_us / 1000000:.2f}s"
+    if value_us >= 1000:
+        return f"{value_us / 1000:.1f}ms"
+    return f"{value_us}us"
+
+
+# The latencies of the producer -> consumer.py -> output-consumer.py pipeline,
+# from the publish_ns, consume_ns and forward_ns times stamped along the way:
+#   end to end   publish -> verified
+#   queue        publish -> received by consumer.py
+#   processing   received -> forwarded by consumer.py
+#   output queue forwarded -> verified
+# End to end latencies are also kept per key, for the first max_keys keys.
+# Interval histograms are reset after every report, run histograms at run boundaries.
+HOPS = ["end to end", "queue", "processing", "output queue"]
+
+class PipelineLatencies:
+
+    def __init__(self, max_keys=100):
+        self.max_keys = max_keys
+        self.interval = {hop: LatencyHistogram() for hop in HOPS}
+        self.run = {hop: LatencyHistogram() for hop in HOPS}
+        self.per_key = dict()
+        self.keys_dropped = 0
+
+    def record_hop(self, hop, value_us):
+        self.interval[hop].record(value_us)
+        self.run[hop].record(value_us)
+
+    # times in ns since the epoch, None when not stamped
+    def record(self, key, publish_ns, consume_ns, forward_ns, verify_ns):
+        if publish_ns is not None:
+            end_to_end = (verify_ns - publish_ns) // 1000
+            self.record_hop("end to end", end_to_end)
+            histogram = self.per_key.get(key)
+            if histogram is None:
+                if len(self.per_key) < self.max_keys:
+                    histogram = LatencyHistogram()
+                    self.per_key[key] = histogram
+                else:
+                    self.keys_dropped += 1
+            if histogram is not None:
+                histogram.record(end_to_end)
+            if consume_ns is not None:
+                self.record_hop("queue", (consume_ns - publish_ns) // 1000)
+        if consume_ns is not None and forward_ns is not None:
+            self.record_hop("processing", (forward_ns - consume_ns) // 1000)
+        if forward_ns is not None:
+            self.record_hop("output queue", (verify_ns - forward_ns) // 1000)
+
+    def interval_report(self):
+        lines = [f"  {hop}: {self.interval[hop].summary()}" for hop in HOPS if self.interval[hop].count]
+        for histogram in self.interval.values():
+            histogram.reset()
+        return "\n".join(lines)
+
+    # the run's hops, then the keys with the highest p99 first
+    def run_report(self, max_keys=10):
+        lines = [f"  {hop}: {self.run[hop].summary()}" for hop in HOPS if self.run[hop].count]
+        by_p99 = sorted(self.per_key.items(), key=lambda item: item[1].percentile(99), reverse=True)
+        for key, histogram in by_p99[:max_keys]:
+            lines.append(f"    {key_text(key)}: {histogram.summary()}")
+        if len(by_p99) > max_keys:
+            lines.append(f"    ... and {len(by_p99) - max_keys} more keys")
+        if self.keys_dropped:
+            lines.append(f"    {self.keys_dropped} latencies of keys beyond the first {self.max_keys} only counted in the totals")
+        return "\n".join(lines)
+
+    def state(self):
+        return {"run": {hop: histogram.state() for hop, histogram in self.run.items()},
+                "keys": [[key_state(key), histogram.state()] for key, histogram in self.per_key.items()],
+                "keys_dropped": self.keys_dropped}
+
+    def merge_state(self, state):
+        for hop, histogram_state in state["run"].items():
+            self.run[hop].merge_state(histogram_state)
+        for key, histogram_state in state["keys"]:
+            key = key_from_state(key)
+            if key not in self.per_key:
+                self.per_key[key] = LatencyHistogram()
+            self.per_key[key].merge_state(histogram_state)
+        self.keys_dropped += state["keys_dropped"]
+
+
+# text keys as latin-1 strings, key ids as ints, so both survive json
+def key_state(key):
+    if isinstance(key, int):
+        return key
+    return key.decode('latin-1')
+
+def key_from_state(key):
+    if isinstance(key, int):
+        return key
+    return key.encode('latin-1')
@@ -0,0 +1,38 @@
+import requests
+from urllib.parse import quote
+
+# Small wrapper over the RabbitMQ management HTTP API of a node, used by the
+# cluster scripts and clients that need to look at the broker's topology.
+
+MGMT_PORT = 15672
+AUTH = ("jack", "jack")
+
+def url(host, path):
+    return f"http://{host}:{MGMT_PORT}/api/{path}"
+
+def quote_name(name):
+    return quote(name, safe='')
+
+def get(host, path, timeout=10):
+    r = requests.get(url(host, path), auth=AUTH, timeout=timeout)
+    r.raise_for_status()
+    return r.json()
+
+def put_ha_policy(host, rep_factor, vhost="/"):
+    return requests.put(url(host, f"policies/{quote_name(vhost)}/ha-queues"),
+        data = "{\"pattern\":\"\", \"definition\": {\"ha-mode\":\"exactly\", \"ha-params\": " + str(rep_factor) + " }, \"priority\":0, \"apply-to\": \"queues\"}",
+        auth=AUTH)
+
+# queue name -> queue, only the requested columns are returned by the node
+def get_queues(host, vhost="/", columns="name,durable,auto_delete,exclusive,arguments"):
+    queues = get(host, f"queues/{quote_name(vhost)}?columns={columns}")
+    return {queue["name"]: queue for queue in queues}
+
+# an exchange that does not exist yet has no bindings
+def get_source_bindings(host, exchange, vhost="/"):
+    try:
+        return get(host, f"exchanges/{quote_name(vhost)}/{quote_name(exchange)}/bindings/source")
+    except requests.HTTPError as ex:
+        if ex.response is not None and ex.response.status_code == 404:
+            return list()
+        raise
@@ -0,0 +1,127 @@
+import os
+import struct
+import itertools
+from pika import spec
+
+# Message properties for publish loops that are built once and reused for every
+# message. pika marshals the properties inside basic_publish, so one object can
+# be changed and published again as soon as publish returns, as long as only one
+# task publishes with it.
+#
+# A MessageTemplate is a BasicProperties whose fixed fields are encoded once
+# when it is created. Only the fields declared variable are encoded per message:
+# the correlation id, with variable_correlation_id=True, and non negative
+# integer headers named in int_headers, set with template.headers[name] = value.
+# They are encoded as long long, which pika decodes as unsigned. A message whose
+# headers are anything else (a str or bool value, a negative int, a header not
+# named in int_headers) is encoded by pika's BasicProperties.encode instead.
+# Encoding the headers table is the most expensive part of marshalling a
+# publish, a precompiled table of integers costs a struct.pack per header.
+# Fixed fields must not be changed after the template has been created.
+# A publisher that keeps messages to publish them again later takes a frozen
+# copy, freeze() encodes the current values once into an EncodedProperties.
+
+# the property order of the AMQP 0-9-1 content header
+FIELDS = ["content_type", "content_encoding", "headers", "delivery_mode", "priority",
+          "correlation_id", "reply_to", "expiration", "message_id", "timestamp",
+          "type", "user_id", "app_id", "cluster_id"]
+
+INT64 = struct.Struct(">q")
+INT64_MAX = (1 << 63) - 1
+TABLE_SIZE = struct.Struct(">I")
+
+class MessageTemplate(spec.BasicProperties):
+
+    def __init__(self, variable_correlation_id=False, int_headers=(), **fixed):
+        spec.BasicProperties.__init__(self, **fixed)
+        self.variable_correlation_id = variable_correlation_id
+        if int_headers:
+            if self.headers is not None:
+                raise ValueError("Fixed headers can not be combined with int_headers")
+            self.headers = {name: 0 for name in int_headers}
+        if variable_correlation_id and self.correlation_id is None:
+            self.correlation_id = ""
+
+        # an integer header is its short string name, the long long type and the value
+        self.int_headers = [(name, encode_short_string(name) + b"l") for name in int_headers]
+        self.table_size = TABLE_SIZE.pack(sum(len(key) + INT64.size for _, key in self.int_headers))
+
+        variable = list()
+        if self.int_headers:
+            variable.append("headers")
+        if variable_correlation_id:
+            variable.append("correlation_id")
+        self.flags = spec.BasicProperties.encode(self)[0]
+        # the encoded fixed fields before, between and after the variable ones
+        self.chunks = list()
+        names = list()
+        for name in FIELDS:
+            if name in variable:
+                self.chunks.append(encode_fields(self, names))
+                names = list()
+            else:
+                names.append(name)
+        self.chunks.append(encode_fields(self, names))
+
+    # called by pika's content header frame
+    def encode(self):
+        chunks = self.chunks
+        pieces = [self.flags, chunks[0]]
+        index = 1
+        if self.int_headers:
+            headers = self.headers
+            if headers is None or len(headers) != len(self.int_headers):
+                return spec.BasicProperties.encode(self)
+            pieces.append(self.table_size)
+            for name, key in self.int_headers:
+                value = headers.get(name)
+                # type() rather than isinstance, a bool is an int too
+                if type(value) is not int or not 0 <= value <= INT64_MAX:
+                    return spec.BasicProperties.encode(self)
+                pieces.append(key)
+                pieces.append(INT64.pack(value))
+            pieces.append(chunks[index])
+            index += 1
+        if self.variable_correlation_id:
+            pieces.append(encode_short_string(self.correlation_id))
+            pieces.append(chunks[index])
+        return pieces
+
+    def freeze(self):
+        return EncodedProperties(self.encode())
+
+
+# Already encoded properties, all pika needs of them to marshal a content header
+# is INDEX and encode(). pika inserts into the list it gets, so every encode
+# returns a new one.
+class EncodedProperties:
+    __slots__ = ('pieces',)
+    INDEX = spec.BasicProperties.INDEX
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    def encode(self):
+        return list(self.pieces)
+
+
+def encode_short_string(value):
+    encoded = value.encode('utf-8')
+    return bytes((len(encoded),)) + encoded
+
+def encode_fields(properties, names):
+    fields = spec.BasicProperties(**{name: getattr(properties, name) for name in names})
+    # without the flags, which are encoded first
+    return b"".join(fields.encode()[1:])
+
+
+# Correlation ids unique across producers and restarts without a uuid4 per
+# message: a random prefix per generator followed by a counter.
+class CorrelationIds:
+
+    def __init__(self, prefix=None):
+        self.prefix = prefix if prefix is not None else os.urandom(6).hex() + "-"
+        self.counter = itertools.count(1)
+
+    def next(self):
+        return f"{self.prefix}{next(self.counter)}"
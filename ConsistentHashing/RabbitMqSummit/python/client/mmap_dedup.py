@@ -0,0 +1,181 @@
+import os
+import mmap
+import time
+import bisect
+import struct
+from array import array
+import hashlib
+import numpy as np
+from dedup_cache import to_key
+
+# Dedup window that survives the consumer process dying.
+# Correlation ids are written to a fixed size ring of slots in a memory-mapped
+# file, each slot holding the 16 byte id and the wall clock time it was first
+# seen. Writes go straight to the page cache so nothing is lost when the process
+# is killed, and a restarted consumer rebuilds its index from one vectorized
+# pass over the file instead of replaying messages. That pass reads the file as
+# a numpy array (numpy is pinned in requirements.txt).
+#
+# The ids found at startup are not put in a dict, which would cost a python
+# object per live slot. They are kept as a sorted list of 64 bit fingerprints
+# (the two halves of the id xor-ed) with their slots in arrays, looked up by bisection and
+# confirmed against the id stored in the slot. Ids added after startup go in a
+# dict. Once every id found at startup has expired the sorted arrays are dropped.
+#
+# header: magic (8 bytes) | version (uint32) | slot count (uint32) | next write position (uint64)
+HEADER = struct.Struct("<8sIIQ")
+SLOT = struct.Struct("<16sd")
+SLOT_DTYPE = [("low", "<u8"), ("high", "<u8"), ("seen_at", "<f8")]
+# the fingerprints are bisected within one of 2^16 ranges picked by their top bits
+RANGE_SHIFT = 48
+MAGIC = b"DEDUPLOG"
+VERSION = 1
+
+class MappedDedupLog:
+
+    def __init__(self, path, window_sec=300, slot_count=1000000):
+        self.path = path
+        self.window_sec = window_sec
+        self.slot_count = slot_count
+        self.index = dict()
+        self.loaded_fingerprints = array('Q')
+        self.loaded_slots = array('q')
+        self.loaded_ranges = array('q')
+        self.loaded_newest = 0
+        self.hits = 0
+        self.misses = 0
+        self.overwritten = 0
+        self.loaded = 0
+
+        start = time.perf_counter()
+        self.open_file()
+        self.load()
+        self.load_ms = (time.perf_counter() - start) * 1000
+
+    def open_file(self):
+        size = HEADER.size + self.slot_count * SLOT.size
+        reuse = False
+        if os.path.exists(self.path) and os.path.getsize(self.path) == size:
+            with open(self.path, "rb") as f:
+                magic, version, slot_count, _ = HEADER.unpack(f.read(HEADER.size))
+            reuse = magic == MAGIC and version == VERSION and slot_count == self.slot_count
+
+        if not reuse:
+            if os.path.exists(self.path):
+                print(f"Dedup log {self.path} does not match the configured slot count, starting a new one")
+            with open(self.path, "wb") as f:
+                f.truncate(size)
+                f.write(HEADER.pack(MAGIC, VERSION, self.slot_count, 0))
+
+        self.file = open(self.path, "r+b")
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        _, _, _, self.head = HEADER.unpack_from(self.mm, 0)
+
+    def load(self):
+        # every slot is looked at rather than trusting the head, so a slot that was
+        # written just before a crash but whose head update was lost is still found
+        cutoff = time.time() - self.window_sec
+        slots = np.frombuffer(self.mm, dtype=SLOT_DTYPE, count=self.slot_count, offset=HEADER.size)
+        live = np.nonzero(slots["seen_at"] >= cutoff)[0]
+        fingerprints = slots["low"][live] ^ slots["high"][live]
+        order = np.argsort(fingerprints)
+        fingerprints = fingerprints[order]
+        self.loaded_fingerprints.frombytes(fingerprints.astype(np.uint64).tobytes())
+        self.loaded_slots.frombytes(live[order].astype(np.int64).tobytes())
+        starts = np.arange(1 << (64 - RANGE_SHIFT), dtype=np.uint64) << np.uint64(RANGE_SHIFT)
+        self.loaded_ranges.frombytes(np.searchsorted(fingerprints, starts).astype(np.int64).tobytes())
+        self.loaded_ranges.append(len(live))
+        if len(live):
+            self.loaded_newest = float(slots["seen_at"][live].max())
+        # the array views the map, which can not be closed while it exists
+        del slots
+        self.loaded = len(self.loaded_slots)
+
+    def find_loaded(self, key):
+        fingerprint = int.from_bytes(key[:8], 'little') ^ int.from_bytes(key[8:], 'little')
+        top = fingerprint >> RANGE_SHIFT
+        position = bisect.bisect_left(self.loaded_fingerprints, fingerprint,
+                                      self.loaded_ranges[top], self.loaded_ranges[top + 1])
+        while position < len(self.loaded_fingerprints) and self.loaded_fingerprints[position] == fingerprint:
+            slot = self.loaded_slots[position]
+            if self.mm[HEADER.size + slot * SLOT.size:HEADER.size + slot * SLOT.size + 16] == key:
+                return slot
+            position += 1
+        return None
+
+    def slot_key(self, correlation_id):
+        key = to_key(correlation_id)
+        if len(key) != 16:
+            key = hashlib.blake2b(key, digest_size=16).digest()
+        return key
+
+    # returns True when the correlation id was already seen within the window,
+    # including by a previous run of the consumer
+    def contains(self, correlation_id, now=None):
+        if now is None:
+            now = time.time()
+
+        key = self.slot_key(correlation_id)
+        slot = self.index.get(key)
+        if slot is None and self.loaded_slots:
+            if now - self.loaded_newest > self.window_sec:
+                self.loaded_fingerprints = array('Q')
+                self.loaded_slots = array('q')
+            else:
+                slot = self.find_loaded(key)
+        if slot is not None:
+            # a slot found at startup may have been written over since
+            stored_key, seen_at = SLOT.unpack_from(self.mm, HEADER.size + slot * SLOT.size)
+            if stored_key == key and now - seen_at <= self.window_sec:
+                self.hits += 1
+                return True
+            self.index.pop(key, None)
+
+        self.misses += 1
+        return False
+
+    # only record an id once the message has been handled, recording it before
+    # would make a crash in between drop the redelivery as a duplicate
+    def add(self, correlation_id, now=None):
+        if now is None:
+            now = time.time()
+
+        key = self.slot_key(correlation_id)
+        slot = self.head % self.slot_count
+        offset = HEADER.size + slot * SLOT.size
+        old_key, old_seen_at = SLOT.unpack_from(self.mm, offset)
+        if old_seen_at > 0:
+            if self.index.get(old_key) == slot:
+                del self.index[old_key]
+            if now - old_seen_at <= self.window_sec:
+                self.overwritten += 1
+
+        SLOT.pack_into(self.mm, offset, key, now)
+        self.head += 1
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.slot_count, self.head)
+        self.index[key] = slot
+
+    # checks and records in one step, returns True for a duplicate
+    def seen(self, correlation_id, now=None):
+        if self.contains(correlation_id, now):
+            return True
+        self.add(correlation_id, now)
+        return False
+
+    # the page cache already survives a process crash, flushing is only needed
+    # to also survive the host going down
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.file.close()
+
+    # the ids found at startup are counted until the end, overwritten or not
+    def __len__(self):
+        return len(self.index) + len(self.loaded_slots)
+
+    def stats(self):
+        return (f"Dedup log entries: {len(self)} loaded at startup: {self.loaded} in {self.load_ms:.1f}ms "
+                f"hits: {self.hits} misses: {self.misses} overwritten within window: {self.overwritten}")
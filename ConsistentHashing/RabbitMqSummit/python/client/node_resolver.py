@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import subprocess
+
+# Resolves cluster node names (rabbitmq1, rabbitmq2...) to addresses.
+# In order of precedence:
+#   1. RABBITMQ_NODES environment variable: "rabbitmq1=10.0.0.2,rabbitmq2=10.0.0.3:5673"
+#   2. a static host map file, RABBITMQ_HOSTS_FILE or ../cluster/hosts.json: {"rabbitmq1": "10.0.0.2"}
+#   3. a cache file written by 4, valid for RABBITMQ_NODE_CACHE_SEC seconds (default 600)
+#   4. one "docker inspect" call for every node that is still unresolved
+# An address may carry a port ("host:port"), used for example when every node
+# listens on its own port of localhost.
+# Set RABBITMQ_NODE_CACHE_SEC=0 to always ask docker, e.g. after recreating the cluster.
+
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".node-ips.json")
+DEFAULT_HOSTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cluster", "hosts.json")
+DEFAULT_CACHE_SEC = 600
+
+def parse_node_map(text):
+    nodes = dict()
+    for entry in text.split(","):
+        entry = entry.strip()
+        if entry:
+            name, address = entry.split("=", 1)
+            nodes[name.strip()] = address.strip()
+    return nodes
+
+def load_env_nodes():
+    text = os.environ.get("RABBITMQ_NODES")
+    if text:
+        return parse_node_map(text)
+    return dict()
+
+def load_hosts_file():
+    path = os.environ.get("RABBITMQ_HOSTS_FILE", DEFAULT_HOSTS_FILE)
+    if not os.path.exists(path):
+        return dict()
+    with open(path) as f:
+        return json.load(f)
+
+def cache_max_age():
+    return float(os.environ.get("RABBITMQ_NODE_CACHE_SEC", DEFAULT_CACHE_SEC))
+
+def load_cache():
+    max_age = cache_max_age()
+    if max_age <= 0 or not os.path.exists(CACHE_FILE):
+        return dict()
+    try:
+        with open(CACHE_FILE) as f:
+            cache = json.load(f)
+    except (ValueError, OSError):
+        return dict()
+
+    now = time.time()
+    return {name: entry["address"] for name, entry in cache.items() if now - entry["resolved_at"] <= max_age}
+
+def save_cache(resolved):
+    cache = dict()
+    if os.path.exists(CACHE_FILE):
+        try:
+            with open(CACHE_FILE) as f:
+                cache = json.load(f)
+        except (ValueError, OSError):
+            cache = dict()
+
+    now = time.time()
+    for name, address in resolved.items():
+        cache[name] = {"address": address, "resolved_at": now}
+
+    # written to a temporary file first so concurrent scripts never read half a file
+    temp_file = f"{CACHE_FILE}.{os.getpid()}"
+    with open(temp_file, "w") as f:
+        json.dump(cache, f)
+    os.replace(temp_file, CACHE_FILE)
+
+def invalidate_cache():
+    if os.path.exists(CACHE_FILE):
+        os.remove(CACHE_FILE)
+
+# one docker call for all the nodes instead of one bash and one docker process per node
+def docker_inspect(node_names):
+    command = ["docker", "inspect", "-f",
+               "{{.Name}} {{range .NetworkSettings.Networks}}{{.IPAddress}}{{end}}"] + list(node_names)
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as ex:
+        print(f"Could not run docker inspect: {ex}")
+        return dict()
+
+    # a missing container makes docker exit with an error but still print the others
+    resolved = dict()
+    for line in process.stdout.decode('ascii').splitlines():
+        parts = line.split()
+        # a stopped container has no address, it is not cached so it is looked up again next time
+        if len(parts) == 2:
+            resolved[parts[0].lstrip("/")] = parts[1]
+    return resolved
+
+def resolve_nodes(node_names):
+    node_names = list(node_names)
+    resolved = dict()
+    for source in [load_env_nodes, load_hosts_file, load_cache]:
+        missing = [name for name in node_names if name not in resolved]
+        if not missing:
+            break
+        found = source()
+        for name in missing:
+            if name in found:
+                resolved[name] = found[name]
+
+    missing = [name for name in node_names if name not in resolved]
+    if missing:
+        inspected = docker_inspect(missing)
+        if inspected:
+            save_cache(inspected)
+        resolved.update(inspected)
+
+    return resolved
+
+# the addresses of node_names in the same order, "" for a node that could not be resolved
+def resolve_node_list(node_names):
+    resolved = resolve_nodes(node_names)
+    return [resolved.get(name, "") for name in node_names]
+
+def get_node_ip(node_name):
+    return resolve_nodes([node_name]).get(node_name, "")
+
+def split_address(address, default_port=5672):
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        return host, int(port)
+    return address, default_port
@@ -0,0 +1,159 @@
+from array import array
+
+# Per key ordering statistics for "key=value" bodies, or key ids and sequence
+# numbers of binary bodies (verify_value), where the values of a key are
+# published as 1, 2, 3... Every message is counted as one of:
+#   in order      value is the last value + 1 (or 1 for a new key)
+#   jump forward  values were skipped
+#   jump back     value is lower than the last value
+#   duplicate     the value was already seen for the key
+# Counters live in one array per statistic indexed by a key slot, seen values in
+# a bitmap per key, so memory stays small with millions of messages and nothing
+# but a few integer operations is done per message.
+# The bitmap of a key grows up to its highest value, so a value more than
+# max_window beyond the key's last value (a corrupt body, k1=1000000000000) is
+# counted as invalid rather than allocating a bitmap that reaches it.
+class OrderVerifier:
+
+    def __init__(self, max_window=1 << 20):
+        self.max_window = max_window
+        self.slots = dict()
+        self.key_names = list()
+        self.last = array('q')
+        self.in_order = array('q')
+        self.jump_forward = array('q')
+        self.jump_back = array('q')
+        self.duplicates = array('q')
+        self.max_jump = array('q')
+        self.seen = list()
+        self.messages = 0
+        self.invalid = 0
+
+    def add_key(self, key):
+        slot = len(self.key_names)
+        self.slots[key] = slot
+        self.key_names.append(key)
+        for counters in (self.last, self.in_order, self.jump_forward, self.jump_back, self.duplicates, self.max_jump):
+            counters.append(0)
+        self.seen.append(bytearray(128))
+        return slot
+
+    # returns the key, None for a body that is not "key=value"
+    def verify(self, body):
+        key, separator, value = body.partition(b"=")
+        try:
+            value = int(value)
+        except ValueError:
+            value = -1
+        if not separator or value < 0:
+            self.invalid += 1
+            return None
+        self.verify_value(key, value)
+        return key
+
+    # key is the text key as bytes or the int key id of a binary body
+    def verify_value(self, key, value):
+        slot = self.slots.get(key)
+        last = 0 if slot is None else self.last[slot]
+        if value - last > self.max_window:
+            self.invalid += 1
+            return
+        if slot is None:
+            slot = self.add_key(key)
+        self.messages += 1
+
+        seen = self.seen[slot]
+        index = value >> 3
+        bit = 1 << (value & 7)
+        if index >= len(seen):
+            seen.extend(bytes(max(index + 1, 2 * len(seen)) - len(seen)))
+        elif seen[index] & bit:
+            # a redelivered copy does not move the key's position
+            self.duplicates[slot] += 1
+            return
+        seen[index] |= bit
+
+        if value == last + 1:
+            self.in_order[slot] += 1
+        elif value > last:
+            self.jump_forward[slot] += 1
+            if value - last > self.max_jump[slot]:
+                self.max_jump[slot] = value - last
+        else:
+            self.jump_back[slot] += 1
+            if last - value > self.max_jump[slot]:
+                self.max_jump[slot] = last - value
+        self.last[slot] = value
+
+    # the counters without the seen bitmaps, as json for another process to merge,
+    # text keys are decoded as latin-1 so that any key bytes survive the round trip
+    def state(self):
+        counters = zip(self.last, self.in_order, self.jump_forward, self.jump_back, self.duplicates, self.max_jump)
+        keys = dict()
+        key_ids = dict()
+        for key, values in zip(self.key_names, counters):
+            if isinstance(key, int):
+                key_ids[str(key)] = list(values)
+            else:
+                keys[key.decode('latin-1')] = list(values)
+        return {"messages": self.messages, "invalid": self.invalid, "keys": keys, "key_ids": key_ids}
+
+    # adds the counters of another verifier's state, for merging shards that own
+    # disjoint keys (a key present in both keeps the highest last value)
+    def merge(self, state):
+        self.messages += state["messages"]
+        self.invalid += state["invalid"]
+        keys = [(key.encode('latin-1'), values) for key, values in state["keys"].items()]
+        keys += [(int(key), values) for key, values in state.get("key_ids", {}).items()]
+        for key, (last, in_order, jump_forward, jump_back, duplicates, max_jump) in keys:
+            slot = self.slots.get(key)
+            if slot is None:
+                slot = self.add_key(key)
+            self.last[slot] = max(self.last[slot], last)
+            self.in_order[slot] += in_order
+            self.jump_forward[slot] += jump_forward
+            self.jump_back[slot] += jump_back
+            self.duplicates[slot] += duplicates
+            self.max_jump[slot] = max(self.max_jump[slot], max_jump)
+
+    # how many of the values 1..up_to of a key were never received
+    def missing(self, key, up_to):
+        slot = self.slots.get(key)
+        if slot is None:
+            return up_to
+        if up_to <= 0:
+            return 0
+        seen = int.from_bytes(bytes(self.seen[slot][:(up_to >> 3) + 1]), 'little')
+        wanted = ((1 << (up_to + 1)) - 1) & ~1
+        return up_to - bin(seen & wanted).count('1')
+
+    def totals(self):
+        return sum(self.in_order), sum(self.jump_forward), sum(self.jump_back), sum(self.duplicates)
+
+    def summary(self):
+        in_order, jump_forward, jump_back, duplicates = self.totals()
+        return (f"Messages: {self.messages} keys: {len(self.key_names)} in order: {in_order} "
+                f"jump forward: {jump_forward} jump back: {jump_back} duplicates: {duplicates} invalid: {self.invalid}")
+
+    # the summary then one line per key with ordering events, worst keys first
+    def report(self, max_keys=20):
+        lines = [self.summary()]
+        out_of_order = [slot for slot in range(len(self.key_names))
+                        if self.jump_forward[slot] or self.jump_back[slot] or self.duplicates[slot]]
+        out_of_order.sort(key=lambda slot: self.jump_forward[slot] + self.jump_back[slot] + self.duplicates[slot], reverse=True)
+        for slot in out_of_order[:max_keys]:
+            lines.append(f"  {key_text(self.key_names[slot])}: last {self.last[slot]} "
+                         f"in order {self.in_order[slot]} jump forward {self.jump_forward[slot]} "
+                         f"jump back {self.jump_back[slot]} duplicates {self.duplicates[slot]} "
+                         f"largest jump {self.max_jump[slot]}")
+        if len(out_of_order) > max_keys:
+            lines.append(f"  ... and {len(out_of_order) - max_keys} more keys with ordering events")
+        elif not out_of_order and self.messages > 0:
+            lines.append("  every key was received in order")
+        return "\n".join(lines)
+
+
+def key_text(key):
+    if isinstance(key, int):
+        return f"key id {key}"
+    return key.decode('utf-8', 'replace')
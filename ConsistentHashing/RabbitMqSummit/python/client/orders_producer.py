@@ -1,202 +1,231 @@
 #!/usr/bin/env python
-import pika
-from pika import spec
+import os
 import sys
+import json
 import time
-import subprocess
-import datetime
+import signal
+import asyncio
+from command_args import get_args, get_optional_arg
+from token_bucket import TokenBucket
+from message_template import MessageTemplate
+from rabbit_client import resolve_node_list, cluster_node_names, get_node_index, run_publishers
+from failover import FailoverStats
+
+# python orders_producer.py node cluster_size msgs clients [--connections 1] [--channels-per-connection 1] [--processes false]
+#
+# The clients' orders are spread over --connections x --channels-per-connection
+# channels, connection j connecting to the j-th node after the given one. Client i
+# always publishes on channel i modulo the channel count, so each client's orders
+# leave on one channel in order and per client order holds however many channels
+# there are. With --processes true every connection gets a process of its own
+# (this script with --connection-index), --rate is split between them and their
+# confirm counts are aggregated into one report here.
+
+REPORT_PREFIX = "Producer report: "
+PROGRESS_PREFIX = "Progress: confirmed "
 
 connect_node = sys.argv[1]
 node_count = int(sys.argv[2])
 count = int(sys.argv[3])
 client_count = int(sys.argv[4])
 
-terminate = False
-exit_triggered = False
-last_ack_time = datetime.datetime.now()
+args = get_args(sys.argv[:1] + sys.argv[5:])
+# publishing pauses at --max-in-flight unconfirmed messages and resumes once
+# confirms bring that down to --low-watermark; --rate holds a steady target of
+# messages per second, 0 publishes as fast as the credit allows
+max_in_flight = int(get_optional_arg(args, "--max-in-flight", "10000"))
+low_watermark = int(get_optional_arg(args, "--low-watermark", str(max_in_flight // 2)))
+rate = float(get_optional_arg(args, "--rate", "0"))
+# the messages left unconfirmed by a lost connection are published again on the
+# next one, with --republish false they are dropped and counted as lost
+republish = get_optional_arg(args, "--republish", "true") == "true"
+connection_count = int(get_optional_arg(args, "--connections", "1"))
+channels_per_connection = int(get_optional_arg(args, "--channels-per-connection", "1"))
+processes = get_optional_arg(args, "--processes", "false") == "true"
+# set by the supervisor of --processes true, the one connection this process runs
+connection_index = int(get_optional_arg(args, "--connection-index", "-1"))
+
 last_ack = 0
 
 clients = []
 for i in range(1, client_count+1):
     clients.append(f"Client{i}")
+# the bodies are a client's fixed prefix and the message number, the
+# properties are the same for every message and encoded once
+body_prefixes = [f"Client {client} Num: " for client in clients]
+routing_keys = [str(i) for i in range(client_count)]
+properties = MessageTemplate(content_type='text/plain', delivery_mode=2)
 
-node_names = []
+node_names = cluster_node_names(node_count)
+channel_count = connection_count * channels_per_connection
 
-curr_pos = 0
-pending_messages = list()
-pending_acks = list()
 pos_acks = 0
 neg_acks = 0
 
-for i in range(1, node_count+1):
-    node_names.append(f"rabbitmq{i}")
-nodes = list()
-
-def get_node_index(node_name):
-    index = 0
-    for node in node_names:
-        if node == node_name:
-            return index
-
-        index +=1
-
-    return -1
-
-def on_open(connection):
-    connection.channel(on_channel_open)
-    print("Connection open")
-
-def on_channel_open(chan):
-    global connection, channel
-    chan.confirm_delivery(on_delivery_confirmation)
-    channel = chan
-    publish_messages()
-
-# this is ignoring the posibility of ack + return
-# do not use in production code
-def on_delivery_confirmation(frame):
-    global last_ack_time, pending_messages, pos_acks, neg_acks, last_ack, count
-
-    if isinstance(frame.method, spec.Basic.Ack) or isinstance(frame.method, spec.Basic.Nack):
-        if frame.method.multiple == True:
-            acks = 0
-            messages_to_remove = [item for item in pending_messages if item <= frame.method.delivery_tag]
-            for val in messages_to_remove:
-                try:
-                    pending_messages.remove(val)
-                except:
-                    print(f"Could not remove multiple flag message: {val}")
-                acks += 1
-        else:
-            try:
-                pending_messages.remove(frame.method.delivery_tag) 
-            except:
-                print(f"Could not remove non-multiple flag message: {frame.method.delivery_tag}")
-            acks = 1
-
-    if isinstance(frame.method, spec.Basic.Ack):
-        pos_acks += acks
-    elif isinstance(frame.method, spec.Basic.Nack):
-        neg_acks += acks
-    elif isinstance(frame.method, spec.Basic.Return):
-        print("Undeliverable message")
-    
+def on_confirm(acked, confirmed):
+    global pos_acks, neg_acks, last_ack
+
+    if acked:
+        pos_acks += confirmed
+    else:
+        neg_acks += confirmed
 
     curr_ack = int((pos_acks + neg_acks) / 10000)
     if curr_ack > last_ack:
-        print(f"Pos acks: {pos_acks} Neg acks: {neg_acks}")
+        if connection_index >= 0:
+            print(f"{PROGRESS_PREFIX}{pos_acks} {neg_acks}")
+        else:
+            print(f"Pos acks: {pos_acks} Neg acks: {neg_acks}")
         last_ack = curr_ack
 
-    if (pos_acks + neg_acks) >= count:
-        print(f"Final Count => Pos acks: {pos_acks} Neg acks: {neg_acks}")
-        connection.close()
-        exit(0)
-
-def publish_messages():
-    global connection, channel, count, clients, client_count, pending_messages, curr_pos
-
-    client_index = 0
-    while curr_pos < count:
-        if channel.is_open:
-            curr_pos += 1
-            msg = f"Client {clients[client_index]} Num: {curr_pos}"
-            channel.basic_publish(exchange='orders',
-                                routing_key=str(client_index),
-                                body=msg,
-                                properties=pika.BasicProperties(content_type='text/plain',
-                                                        delivery_mode=2))
-
-            # channel.basic_publish(exchange='',
-            #                     routing_key='orders001',
-            #                     body=msg,
-            #                     properties=pika.BasicProperties(content_type='text/plain',
-            #                                             delivery_mode=2))
-            
-            pending_messages.append(curr_pos)
-
-            if curr_pos % 1000 == 0:
-                if len(pending_messages) > 10000:
-                    #print("Reached in-flight limit, pausing publishing for 2 seconds")
-                    if channel.is_open:
-                        connection.add_timeout(2, publish_messages)
-                        break
-            
-            client_index += 1
-            if client_index == client_count:
-                client_index = 0
-            
+# The orders of one channel: message n (from 1) is from client (n-1) modulo the
+# client count, as with a single channel, and this channel sends the messages of
+# its own clients in order of n.
+class ChannelOrders:
+
+    def __init__(self, channel_index):
+        self.client_indexes = list(range(channel_index, client_count, channel_count))
+        self.round = 0
+        self.next = 0
+
+    # publisher.publish waits for credit and, with --rate, for a token. The
+    # position only moves on once a message is published, so after a reconnect
+    # the next channel carries on with the message that failed.
+    async def publish_messages(self, publisher):
+        while self.client_indexes:
+            client_index = self.client_indexes[self.next]
+            num = self.round * client_count + client_index + 1
+            if num > count:
+                return
+            await publisher.publish(exchange='orders',
+                                    routing_key=routing_keys[client_index],
+                                    body=body_prefixes[client_index] + str(num),
+                                    properties=properties)
+
+            self.next += 1
+            if self.next == len(self.client_indexes):
+                self.next = 0
+                self.round += 1
+
+def connection_node(index):
+    return (max(get_node_index(node_names, connect_node), 0) + index) % node_count
+
+async def run_connection(nodes, index, rate_limiter):
+    channels = [ChannelOrders(index * channels_per_connection + i) for i in range(channels_per_connection)]
+    return await run_publishers(nodes, node_names, connection_node(index),
+                                [channel.publish_messages for channel in channels],
+                                on_confirm=on_confirm, max_in_flight=max_in_flight,
+                                low_watermark=low_watermark, rate_limiter=rate_limiter, republish=republish)
+
+def print_report(confirmed_pos, confirmed_neg, stats, elapsed):
+    print(f"Final Count => Pos acks: {confirmed_pos} Neg acks: {confirmed_neg}")
+    print(f"Confirmed {confirmed_pos + confirmed_neg} in {elapsed:.1f}s: {(confirmed_pos + confirmed_neg) / elapsed:.0f} msg/s "
+          f"over {connection_count} connections x {channels_per_connection} channels")
+    print(stats.summary())
+
+async def main():
+    nodes = resolve_node_list(node_names)
+    rate_limiter = TokenBucket(rate) if rate > 0 else None
+    indexes = [connection_index] if connection_index >= 0 else range(connection_count)
+    started = time.monotonic()
+    results = await asyncio.gather(*[run_connection(nodes, index, rate_limiter) for index in indexes])
+    elapsed = time.monotonic() - started
+    stats = FailoverStats()
+    for result in results:
+        stats.merge(result)
+    if connection_index >= 0:
+        print(REPORT_PREFIX + json.dumps({"pos_acks": pos_acks, "neg_acks": neg_acks,
+                                          "failover": stats.to_dict(), "elapsed": elapsed}))
+    else:
+        print_report(pos_acks, neg_acks, stats, elapsed)
+
+
+class Worker:
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.pos_acks = 0
+        self.neg_acks = 0
+        self.report = None
+
+def get_worker_args(index):
+    worker_args = list()
+    for key, value in args.items():
+        if key not in ["--processes", "--rate", "--connection-index"]:
+            worker_args += [key, value]
+    if rate > 0:
+        worker_args += ["--rate", str(rate / connection_count)]
+    return worker_args + ["--connection-index", str(index)]
+
+async def start_worker(worker):
+    command = [sys.executable, "-u", os.path.abspath(__file__)] + sys.argv[1:5] + get_worker_args(worker.index)
+    # a new session keeps a Ctrl-C in the terminal from reaching the workers
+    # directly, the supervisor forwards it once
+    worker.process = await asyncio.create_subprocess_exec(*command,
+                                                          stdout=asyncio.subprocess.PIPE,
+                                                          stderr=asyncio.subprocess.STDOUT,
+                                                          start_new_session=True)
+    print(f"Started connection {worker.index} to {node_names[connection_node(worker.index)]} (pid {worker.process.pid})")
+
+async def read_output(worker):
+    global last_ack
+
+    async for line in worker.process.stdout:
+        text = line.decode('utf-8', errors='replace').rstrip()
+        if text.startswith(PROGRESS_PREFIX):
+            worker.pos_acks, worker.neg_acks = [int(value) for value in text[len(PROGRESS_PREFIX):].split()]
+            total_pos = sum(w.pos_acks for w in workers)
+            total_neg = sum(w.neg_acks for w in workers)
+            curr_ack = int((total_pos + total_neg) / 10000)
+            if curr_ack > last_ack:
+                print(f"Pos acks: {total_pos} Neg acks: {total_neg}")
+                last_ack = curr_ack
+        elif text.startswith(REPORT_PREFIX):
+            worker.report = json.loads(text[len(REPORT_PREFIX):])
+            worker.pos_acks = worker.report["pos_acks"]
+            worker.neg_acks = worker.report["neg_acks"]
         else:
-            print("Channel closed, ceasing publishing")
-            break
-
-def on_close(connection, reason_code, reason_text):
-    connection.ioloop.stop()
-    print("Connection closed. Reason: " + reason_text)
-
-def reconnect():
-    print("Reconnect called")
-    global curr_node
-    curr_node += 1
-    if curr_node > 2:
-        print("Failed to connect. Will retry in 5 seconds")
-        time.sleep(5)
-        curr_node = 0
-    
-    connect()
-
-def connect():
-    global connection, curr_node, terminate
-    print("Attempting to connect to " + nodes[curr_node])
-    parameters = pika.URLParameters('amqp://jack:jack@' + nodes[curr_node] + ':5672/%2F')
-    connection = pika.SelectConnection(parameters=parameters,
-                                on_open_callback=on_open,
-                                on_open_error_callback=reconnect,
-                                on_close_callback=on_close)
-
+            print(f"[connection {worker.index}] {text}")
+    await worker.process.wait()
+
+def stop():
+    print("Stopping producers")
+    for worker in workers:
+        if worker.process is not None and worker.process.returncode is None:
+            worker.process.send_signal(signal.SIGINT)
+
+async def supervise():
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, stop)
+    loop.add_signal_handler(signal.SIGTERM, stop)
+
+    started = time.monotonic()
+    for worker in workers:
+        await start_worker(worker)
+    await asyncio.gather(*[read_output(worker) for worker in workers])
+    elapsed = time.monotonic() - started
+
+    # the rate over the time the workers published, without their start up
+    missing = [str(worker.index) for worker in workers if worker.report is None]
+    if missing:
+        print(f"No final report from connections {' '.join(missing)}, their last progress is counted")
+    else:
+        elapsed = max(worker.report["elapsed"] for worker in workers)
+    stats = FailoverStats()
+    for worker in workers:
+        if worker.report is not None:
+            stats.merge(FailoverStats.from_dict(worker.report["failover"]))
+    print_report(sum(worker.pos_acks for worker in workers),
+                 sum(worker.neg_acks for worker in workers),
+                 stats,
+                 elapsed)
+
+if processes and connection_index < 0:
+    workers = [Worker(index) for index in range(connection_count)]
+    asyncio.run(supervise())
+else:
     try:
-        connection.ioloop.start()
+        asyncio.run(main())
     except KeyboardInterrupt:
-        connection.close()
-        connection.ioloop.stop()
-        terminate = True
-    except Exception as ex:
-        template = "An exception of type {0} occurred. Arguments:{1!r}"
-        message = template.format(type(ex).__name__, ex.args)
-        print(message)
-
-    print("Disconnected")
-
-def get_node_ip(node_name):
-    bash_command = "bash ../cluster/get-node-ip.sh " + node_name
-    process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE)
-    output, error = process.communicate()
-    ip = output.decode('ascii').replace('\n', '')
-    return ip
-
-for node_name in node_names:
-    nodes.append(get_node_ip(node_name))
-
-curr_node = get_node_index(connect_node)
-
-# keep running until the terminate signal has been received
-while terminate == False:
-    try:
-        connect()
-    except Exception as ex:
-        template = "An exception of type {0} occurred. Arguments:{1!r}"
-        message = template.format(type(ex).__name__, ex.args)
-        print(message)
-
-        if terminate == False:
-            reconnect()
-
-# sec_since_last_ack = (datetime.datetime.now() - last_ack_time).seconds
-    # while sec_since_last_ack < 15:
-    #     sec_since_last_ack = (datetime.datetime.now() - last_ack_time).seconds
-    #     time.sleep(1)
-    
-    # # this is not true, but because of this bug https://github.com/pika/pika/issues/1137
-    # # I am unable to know when all acks have been received
-    # print(f"Pos acks: {pos_acks} Neg acks: {neg_acks}")
-    # connection.close()
-    # exit(0)
\ No newline at end of file
+        print("Disconnected")
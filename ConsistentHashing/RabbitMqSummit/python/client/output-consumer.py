@@ -1,20 +1,31 @@
 #!/usr/bin/env python
-import pika
 import sys
+import json
 import time
-import subprocess
+import signal
 import datetime
-import threading
+import asyncio
 from command_args import get_args, get_mandatory_arg, get_optional_arg
+from rabbit_client import get_node_ip, RabbitConnection, Consumer
+from ack_batcher import AckBatcher
+from order_verifier import OrderVerifier
+from verify_shards import ShardSupervisor, REPORT_PREFIX, PROGRESS_PREFIX
+from latency_histogram import PipelineLatencies
+from body_format import BINARY_CONTENT_TYPE, STATE_UPDATE, STATE_UPDATE_SIZE
 
-def get_node_ip(node_name):
-    bash_command = "bash ../cluster/get-node-ip.sh " + node_name
-    process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE)
-    output, error = process.communicate()
-    ip = output.decode('ascii').replace('\n', '')
-    return ip
+# --mode print   prints every message and whether it arrived in order
+# --mode verify  only counts ordering events per key, with a large prefetch and
+#                batched acks, printing a summary every --report-sec seconds and a
+#                report per run, to keep up with the partitioned consumers
+#                With --latency true (default) it also reports latency percentiles
+#                per interval and per run, end to end and per hop, see latency_histogram.py
+# Bodies are "key=value" text or, with content_type application/x-state-update,
+# the binary layout of body_format.py.
+# --shards N     verify mode in N processes, one per queue of a hash exchange named
+#                after --queue, see verify_shards.py. The consumers publish to it
+#                with consumer.py --out-exchange
 
-def monitor():
+async def monitor():
     global keys, last_msg_time
 
     while(True):
@@ -27,21 +38,11 @@ def monitor():
             keys.clear()
             history.clear()
             print("----------------------------------")
-        time.sleep(1)
+        await asyncio.sleep(1)
 
-def callback(ch, method, properties, body):
+def on_message(body):
     global keys, last_msg_time
 
-    # # probably I am running a different demo without restarting this consumer
-    # if (datetime.datetime.now() - last_msg_time).seconds > 2:
-    #     final_state = ""
-    #     for key, value in keys:
-    #         final_state += key + "=" + value + " "
-    #     print(final_state)
-    #     keys.clear()
-    #     history.clear()
-    #     print("----------------------------------")
-
     body_str = str(body, "utf-8")
     parts = body_str.split('=')
     key = parts[0]
@@ -70,41 +71,202 @@ def callback(ch, method, properties, body):
             print(f"{body} Jump forward {curr_value} {duplicate}")
         
     keys[key] = curr_value
-
-    ch.basic_ack(delivery_tag = method.delivery_tag)
     last_msg_time = datetime.datetime.now()
 
+# binary bodies are unpacked in place, the key id is the verifier's key
+def verify_delivery(delivery):
+    body = delivery.body
+    properties = delivery.properties
+    headers = properties.headers
+    if properties.content_type == BINARY_CONTENT_TYPE:
+        if len(body) != STATE_UPDATE_SIZE:
+            verifier.invalid += 1
+            return
+        key, seq, publish_ns, _ = STATE_UPDATE.unpack_from(body)
+        verifier.verify_value(key, seq)
+    else:
+        key = verifier.verify(body)
+        if key is None:
+            return
+        publish_ns = headers.get("publish_ns") if headers else None
+
+    if latencies is not None:
+        if headers:
+            latencies.record(key, publish_ns, headers.get("consume_ns"), headers.get("forward_ns"), time.time_ns())
+        else:
+            latencies.record(key, publish_ns, None, None, time.time_ns())
+
+def run_report():
+    report = verifier.report()
+    if latencies is not None and verifier.messages > 0:
+        report += "\nLatencies:\n" + latencies.run_report()
+    return report
+
+def new_run():
+    global verifier, latencies
+
+    verifier = OrderVerifier()
+    if latencies is not None:
+        latencies = PipelineLatencies(latency_keys)
+
+def shard_state():
+    return {"order": verifier.state(), "latency": latencies.state() if latencies is not None else None}
+
+# sends a partial batch once --ack-interval-ms has passed, without an interval
+# the last messages of a run are acked within a second
+async def ack_timer():
+    while True:
+        await asyncio.sleep(acks.interval_sec if acks.interval_sec > 0 else 1)
+        acks.tick()
+
+# a run ends once no message arrived for --idle-sec seconds, its report is
+# printed and counting starts again for the next run
+async def verify_monitor():
+    last_count = 0
+    report_count = 0
+    last_report = time.monotonic()
+    idle_since = time.monotonic()
+    while True:
+        await asyncio.sleep(min(1, report_sec))
+        if shard_worker:
+            # the supervisor decides where runs end
+            print(f"{PROGRESS_PREFIX}{verifier.messages}", flush=True)
+            continue
+
+        now = time.monotonic()
+        if verifier.messages != last_count:
+            idle_since = now
+        elif verifier.messages > 0 and now - idle_since > idle_sec:
+            print(run_report())
+            print("----------------------------------")
+            new_run()
+            report_count = 0
+            last_report = now
+        if now - last_report >= report_sec and verifier.messages > 0:
+            rate = (verifier.messages - report_count) / (now - last_report)
+            print(f"{verifier.summary()} rate: {rate:.0f} msg/s", flush=True)
+            if latencies is not None:
+                print(latencies.interval_report(), flush=True)
+            report_count = verifier.messages
+            last_report = now
+        last_count = verifier.messages
+
+# a shard worker's run boundary, the signal is handled by the event loop so it
+# falls between two deliveries
+def end_shard_run():
+    print(f"{REPORT_PREFIX}{json.dumps(shard_state())}", flush=True)
+    new_run()
+
+async def verify_main():
+    global acks
+
+    monitor_task = None
+    ack_task = None
+    connection = await RabbitConnection(ip).open()
+    try:
+        consumer = await Consumer(connection, queue, prefetch=prefetch).open()
+        acks = AckBatcher(consumer.channel, ack_batch, ack_interval_ms)
+        monitor_task = asyncio.create_task(verify_monitor())
+        ack_task = asyncio.create_task(ack_timer())
+        if shard_worker:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, end_shard_run)
+        async for delivery in consumer:
+            verify_delivery(delivery)
+            acks.ack(delivery.delivery_tag)
+        print(f"Channel closed. Reason: {consumer.close_reason}")
+    except asyncio.CancelledError:
+        pass
+    except Exception as ex:
+        template = "An exception of type {0} occurred. Arguments:{1!r}"
+        message = template.format(type(ex).__name__, ex.args)
+        print(message)
+    finally:
+        if monitor_task is not None:
+            monitor_task.cancel()
+        if ack_task is not None:
+            ack_task.cancel()
+        if acks is not None:
+            acks.flush()
+        await connection.close()
+
+async def main():
+    monitor_task = asyncio.create_task(monitor())
+    connection = await RabbitConnection(ip).open()
+    try:
+        consumer = await Consumer(connection, queue, prefetch=prefetch).open()
+        async for delivery in consumer:
+            body = delivery.body
+            if delivery.properties.content_type == BINARY_CONTENT_TYPE:
+                key_id, seq, _, _ = STATE_UPDATE.unpack_from(body)
+                body = f"{key_id}={seq}".encode('utf-8')
+            on_message(body)
+            consumer.ack(delivery.delivery_tag)
+    except asyncio.CancelledError:
+        pass
+    except Exception as ex:
+        template = "An exception of type {0} occurred. Arguments:{1!r}"
+        message = template.format(type(ex).__name__, ex.args)
+        print(message)
+    finally:
+        monitor_task.cancel()
+        await connection.close()
+
 args = get_args(sys.argv)
 connect_node = get_optional_arg(args, "--node", "rabbitmq1") #sys.argv[1]
 ip = get_node_ip(connect_node)
 
 queue = get_mandatory_arg(args, "--queue")
+mode = get_optional_arg(args, "--mode", "print")
+prefetch = int(get_optional_arg(args, "--prefetch", "1" if mode == "print" else "5000"))
+# verify mode acks with multiple=True every --ack-batch messages or --ack-interval-ms
+ack_batch = int(get_optional_arg(args, "--ack-batch", "1000"))
+ack_interval_ms = int(get_optional_arg(args, "--ack-interval-ms", "200"))
+report_sec = float(get_optional_arg(args, "--report-sec", "5"))
+if report_sec <= 0:
+    # the monitor wakes every min(1, report_sec) seconds
+    print(f"--report-sec must be greater than 0, got {report_sec}")
+    exit(1)
+idle_sec = float(get_optional_arg(args, "--idle-sec", "2"))
+shard_count = int(get_optional_arg(args, "--shards", "0"))
+# set by the supervisor of --shards for its workers
+shard_worker = get_optional_arg(args, "--shard-worker", "false") == "true"
+latency_enabled = get_optional_arg(args, "--latency", "true") == "true"
+# per key latencies are kept for this many keys
+latency_keys = int(get_optional_arg(args, "--latency-keys", "100"))
 
 keys = dict()
 history = set()
 last_msg_time = datetime.datetime.now()
+verifier = OrderVerifier()
+latencies = PipelineLatencies(latency_keys) if latency_enabled else None
+acks = None
 
-monitor_thread = threading.Thread(target=monitor)
-monitor_thread.start()
-
-credentials = pika.PlainCredentials('jack', 'jack')
-parameters = pika.ConnectionParameters(ip,
-                                    5672,
-                                    '/',
-                                    credentials)
-connection = pika.BlockingConnection(parameters)
-channel = connection.channel()
-
-channel.basic_qos(prefetch_count=1)
-channel.basic_consume(callback,
-                      queue=queue)
-
-try:
-    channel.start_consuming()
-except KeyboardInterrupt:
-    connection.close()
-except Exception as ex:
-    template = "An exception of type {0} occurred. Arguments:{1!r}"
-    message = template.format(type(ex).__name__, ex.args)
-    print(message) 
-    connection.close()
\ No newline at end of file
+if shard_count > 0:
+    nodes = get_optional_arg(args, "--nodes", connect_node).split(",")
+    worker_args = list()
+    for key in ["--prefetch", "--ack-batch", "--ack-interval-ms", "--latency", "--latency-keys"]:
+        if key in args:
+            worker_args += [key, args[key]]
+    supervisor = ShardSupervisor(queue, shard_count, nodes, worker_args, idle_sec, report_sec)
+    asyncio.run(supervisor.run())
+elif mode == "verify":
+    if ack_batch > prefetch:
+        ack_batch = prefetch
+    try:
+        asyncio.run(verify_main())
+    except KeyboardInterrupt:
+        pass
+    if shard_worker:
+        print(f"{REPORT_PREFIX}{json.dumps(shard_state())}", flush=True)
+    else:
+        print(run_report())
+    if acks is not None:
+        print(acks.stats())
+elif mode == "print":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+else:
+    print(f"Unknown mode {mode}, use print or verify")
+    exit(1)
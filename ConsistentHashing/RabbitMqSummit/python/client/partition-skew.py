@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+import sys
+import time
+import json
+import numpy as np
+from command_args import get_args, get_optional_arg
+from hash_ring import HashRing, KeyBatch, route_hash_bulk
+
+# Offline simulator for choosing the queue count and binding weight passed to
+# cluster/declare-hashing-infra.py. Keys are hashed once, then routed through a
+# ring for every queue count and weight of the sweep, with --seeds rings each
+# because the exchange picks its ring points at random. Reports per-queue load,
+# max/mean and min/mean imbalance and the hot partitions.
+#
+# Key distributions:
+#   --distribution uniform       --keys keys with the same message rate
+#   --distribution zipf          --keys keys, rate of the key with rank r ~ 1/r^--zipf-s
+#   --key-file path              sampled keys, one per line as "key" or "key<TAB>messages"
+#
+#   python partition-skew.py --keys 10000000 --queue-counts 4,8,16,20,32 --weights 1,10,50,100
+#   python partition-skew.py --key-file keys.txt --queue-counts 20 --weights 10 --show-queues true
+
+args = get_args(sys.argv)
+key_count = int(get_optional_arg(args, "--keys", "10000000"))
+key_prefix = get_optional_arg(args, "--key-prefix", "key")
+distribution = get_optional_arg(args, "--distribution", "uniform")
+zipf_s = float(get_optional_arg(args, "--zipf-s", "1.0"))
+key_file = get_optional_arg(args, "--key-file", "")
+queue_counts = [int(x) for x in get_optional_arg(args, "--queue-counts", "4,8,16,20,32").split(",")]
+weights = [int(x) for x in get_optional_arg(args, "--weights", "1,10,50,100").split(",")]
+seeds = int(get_optional_arg(args, "--seeds", "3"))
+queue_prefix = get_optional_arg(args, "--queue-prefix", "states")
+# a partition is hot when its load is above this multiple of the mean
+hot_factor = float(get_optional_arg(args, "--hot-factor", "1.2"))
+show_queues = get_optional_arg(args, "--show-queues", "false") == "true"
+json_file = get_optional_arg(args, "--json", "")
+
+def load_key_file(path):
+    keys = list()
+    loads = list()
+    with open(path, "rb") as f:
+        for line in f:
+            line = line.rstrip(b"\r\n")
+            if not line:
+                continue
+            parts = line.split(b"\t")
+            keys.append(parts[0])
+            loads.append(float(parts[1]) if len(parts) > 1 else 1.0)
+    return KeyBatch.from_keys(keys), np.array(loads)
+
+def synthetic_loads(count):
+    if distribution == "uniform":
+        return np.ones(count)
+    if distribution == "zipf":
+        # key i has rank i+1, the rank does not affect where a key hashes to
+        return 1.0 / np.power(np.arange(1, count + 1, dtype=np.float64), zipf_s)
+    print(f"Unknown distribution {distribution}, use uniform or zipf")
+    exit(1)
+
+def simulate(sorted_hashes, cumulative_loads, queue_count, weight, seed):
+    queues = [f"{queue_prefix}{i:03}" for i in range(1, queue_count+1)]
+    ring = HashRing.random_ring(queues, weight, seed)
+    # with the keys sorted by hash, each ring point owns one contiguous run of keys,
+    # (previous point, point], so only the points are searched and not every key
+    points = np.array(ring.points, dtype=np.uint32)
+    ends = np.searchsorted(sorted_hashes, points, side='right')
+    arc_loads = np.diff(cumulative_loads[ends], prepend=0.0)
+    # keys above the last point wrap around to the first
+    arc_loads[0] += cumulative_loads[-1] - cumulative_loads[ends[-1]]
+    queue_loads = np.bincount(np.array(ring.owners), weights=arc_loads, minlength=queue_count)
+    # the ring only lists queues that own a point, every queue does with weight >= 1
+    shares = queue_loads / queue_loads.sum()
+    mean = shares.mean()
+    hot = [(ring.queues[i], shares[i]) for i in np.nonzero(shares > hot_factor * mean)[0]]
+    return {
+        "queues": queue_count,
+        "weight": weight,
+        "seed": seed,
+        "max_mean": float(shares.max() / mean),
+        "min_mean": float(shares.min() / mean),
+        "cv": float(shares.std() / mean),
+        "hot": [{"queue": queue, "share": float(share)} for queue, share in hot],
+        "shares": {ring.queues[i]: float(share) for i, share in enumerate(shares)},
+    }
+
+start = time.perf_counter()
+if key_file:
+    batch, loads = load_key_file(key_file)
+    source = key_file
+else:
+    batch = KeyBatch.from_ints(np.arange(key_count), key_prefix)
+    loads = synthetic_loads(key_count)
+    source = f"{key_count} {distribution} keys"
+hashes = route_hash_bulk(batch)
+order = np.argsort(hashes, kind='stable')
+sorted_hashes = hashes[order]
+# cumulative_loads[i] is the load of the i lowest hashed keys
+cumulative_loads = np.concatenate(([0.0], np.cumsum(loads[order])))
+hash_sec = time.perf_counter() - start
+print(f"Hashed and sorted {batch.count} keys ({source}) in {hash_sec:.2f}s")
+
+# the share of the heaviest single key limits how even any partitioning can be
+top_key_share = loads.max() / loads.sum()
+if top_key_share > 0.01:
+    print(f"The hottest key alone carries {100 * top_key_share:.1f}% of the load")
+
+results = list()
+print(f"{'queues':>6} {'weight':>6} {'max/mean':>17} {'min/mean':>17} {'cv':>6} {'hot':>9}")
+for queue_count in queue_counts:
+    for weight in weights:
+        runs = [simulate(sorted_hashes, cumulative_loads, queue_count, weight, seed) for seed in range(seeds)]
+        results += runs
+        max_mean = [run["max_mean"] for run in runs]
+        min_mean = [run["min_mean"] for run in runs]
+        cv = np.mean([run["cv"] for run in runs])
+        hot = np.mean([len(run["hot"]) for run in runs])
+        print(f"{queue_count:>6} {weight:>6} {np.mean(max_mean):>8.2f} (<={max(max_mean):>5.2f}) "
+              f"{np.mean(min_mean):>8.2f} (>={min(min_mean):>5.2f}) {cv:>6.3f} {hot:>5.1f}/{queue_count:<3}")
+
+        if show_queues:
+            worst = max(runs, key=lambda run: run["max_mean"])
+            for queue, share in worst["shares"].items():
+                marker = " HOT" if share > hot_factor / queue_count else ""
+                print(f"        {queue}: {100 * share:5.2f}%{marker}")
+
+print(f"Simulated {len(results)} rings in {time.perf_counter() - start - hash_sec:.2f}s "
+      f"(max/mean and min/mean averaged over {seeds} random rings, worst case in brackets, "
+      f"hot = above {hot_factor}x the mean)")
+
+if json_file:
+    with open(json_file, "w") as f:
+        json.dump({"source": source, "keys": batch.count, "hot_factor": hot_factor, "results": results}, f, indent=2)
+    print(f"Wrote {json_file}")
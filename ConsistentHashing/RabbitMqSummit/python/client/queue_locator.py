@@ -0,0 +1,91 @@
+import os
+import json
+import time
+import requests
+import management_api
+from node_resolver import get_node_ip, split_address
+
+# Finds the node that hosts a queue's master using the management API, so that
+# a consumer can connect to that node. Otherwise every delivery makes an extra
+# hop from the master's node to the node the consumer is connected to.
+# A single request returns the master of every queue. The answer is cached for
+# ttl_sec seconds, in memory and in a file shared by all consumers on this host,
+# so the workers of consumer-group.py make one request per interval between them
+# rather than one each. The nodes are asked in order, so the lookup still works
+# while some of them are down.
+
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".queue-masters.json")
+
+class QueueLocator:
+
+    def __init__(self, node_names, ttl_sec=30, vhost="/"):
+        self.node_names = node_names
+        self.ttl_sec = ttl_sec
+        self.vhost = vhost
+        self.masters = dict()
+        self.fetched_at = 0
+        # answers fetched before this time are not used, see invalidate()
+        self.not_before = 0
+        self.requests = 0
+        self.cache_hits = 0
+
+    def is_fresh(self, fetched_at):
+        return fetched_at >= self.not_before and time.time() - fetched_at < self.ttl_sec
+
+    def load_cache(self):
+        try:
+            with open(CACHE_FILE) as f:
+                cache = json.load(f)
+        except (ValueError, OSError):
+            return False
+        if cache.get("vhost") != self.vhost or not self.is_fresh(cache["fetched_at"]):
+            return False
+        self.masters = cache["masters"]
+        self.fetched_at = cache["fetched_at"]
+        return True
+
+    def save_cache(self):
+        # written to a temporary file first so concurrent consumers never read half a file
+        temp_file = f"{CACHE_FILE}.{os.getpid()}"
+        with open(temp_file, "w") as f:
+            json.dump({"vhost": self.vhost, "fetched_at": self.fetched_at, "masters": self.masters}, f)
+        os.replace(temp_file, CACHE_FILE)
+
+    def fetch(self):
+        for node_name in self.node_names:
+            address = get_node_ip(node_name)
+            if not address:
+                continue
+            host, _ = split_address(address)
+            try:
+                self.requests += 1
+                queues = management_api.get_queues(host, self.vhost, columns="name,node")
+            except (requests.RequestException, ValueError) as ex:
+                print(f"Queue master lookup on {node_name} failed: {ex}")
+                continue
+
+            self.masters = {name: node_name_of(queue["node"]) for name, queue in queues.items() if queue.get("node")}
+            self.fetched_at = time.time()
+            self.save_cache()
+            return True
+        return False
+
+    # the cluster node name (rabbitmq2) hosting the queue's master, None if unknown
+    def master_node(self, queue):
+        if self.is_fresh(self.fetched_at) or self.load_cache():
+            self.cache_hits += 1
+        elif not self.fetch():
+            return None
+        return self.masters.get(queue)
+
+    # after a failover the cached answers, including other consumers' ones, may be stale
+    def invalidate(self):
+        self.not_before = time.time()
+
+    def stats(self):
+        return f"Queue master lookups: {self.requests} requests {self.cache_hits} cache hits"
+
+
+# "rabbit@rabbitmq2" -> "rabbitmq2", the containers are named after their host
+def node_name_of(erlang_node):
+    return erlang_node.split("@", 1)[-1]
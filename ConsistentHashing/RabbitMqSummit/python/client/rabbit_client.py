@@ -0,0 +1,529 @@
+import time
+import asyncio
+import collections
+import pika
+from pika import spec
+from pika.adapters.asyncio_connection import AsyncioConnection
+from confirm_tracker import ConfirmTracker
+from message_template import MessageTemplate
+from failover import Backoff, FailoverStats, cluster_health
+from node_resolver import get_node_ip, resolve_node_list, split_address
+
+# Shared asyncio client for the publisher and consumer scripts.
+# Every connection is driven by the running asyncio event loop, so any number of
+# publishers and consumers can share one loop in one process. Pika callbacks are
+# turned into awaitables: publishing returns a future resolved by the publisher
+# confirm, consuming is an async iterator over deliveries and publishing waits
+# while too many messages are unconfirmed.
+#
+# Publisher flow control is credit based: publishing stops once max_in_flight
+# messages are unconfirmed and resumes as soon as confirms bring that down to
+# low_watermark (half of max_in_flight by default), so a publisher keeps
+# publishing in batches of credit instead of waking up for every single confirm.
+# An optional rate limiter (token_bucket.TokenBucket) holds a target rate.
+#
+# run_publishers keeps publishing through node failures: it reconnects to the
+# node most likely to be up (failover.py) and publishes the messages that were
+# still unconfirmed when the connection was lost again, before anything new.
+
+class ConnectionLost(Exception):
+    pass
+
+# the broker closed a channel for an error in what was sent on it (404 NOT_FOUND,
+# 406 PRECONDITION_FAILED...) while the connection stayed up. Another node
+# would close it the same way, so this is not a reason to fail over.
+class ChannelError(Exception):
+    pass
+
+def cluster_node_names(node_count):
+    return [f"rabbitmq{i}" for i in range(1, node_count+1)]
+
+def get_node_index(node_names, node_name):
+    if node_name in node_names:
+        return node_names.index(node_name)
+    return -1
+
+
+# pika 0.12 checks every heartbeat + 5 seconds whether anything was received
+# since the last check and closes the connection once nothing was, so a node
+# that silently stopped answering (a partition, not a kill) is noticed one to
+# two check intervals later: 7 to 14s with a heartbeat of 2s, up to 130s with
+# RabbitMQ's default of 60s. Returns the worst case, None for heartbeats off.
+def heartbeat_detection_sec(heartbeat):
+    if heartbeat <= 0:
+        return None
+    return 2 * (heartbeat + 5)
+
+
+class RabbitConnection:
+
+    # host can also be a "host:port" address from the node resolver,
+    # connect_timeout bounds the TCP connect to a node that does not answer
+    def __init__(self, host, port=5672, user='jack', password='jack', connect_timeout=10):
+        self.host, self.port = split_address(host, port)
+        self.user = user
+        self.password = password
+        self.connect_timeout = connect_timeout
+        self.connection = None
+        self.closed = None
+        self.pending = dict()
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        opened = loop.create_future()
+        self.closed = loop.create_future()
+
+        def on_open(connection):
+            if not opened.done():
+                opened.set_result(connection)
+
+        def on_open_error(connection, error):
+            if not opened.done():
+                opened.set_exception(ConnectionLost(f"Could not connect to {self.host}: {error}"))
+
+        def on_close(connection, reply_code, reply_text):
+            if not opened.done():
+                opened.set_exception(ConnectionLost(f"Could not connect to {self.host}: {reply_text}"))
+            self.on_close(reply_code, reply_text)
+
+        parameters = pika.URLParameters(f"amqp://{self.user}:{self.password}@{self.host}:{self.port}/%2F"
+                                        f"?socket_timeout={self.connect_timeout}")
+        self.connection = AsyncioConnection(parameters=parameters,
+                                            on_open_callback=on_open,
+                                            on_open_error_callback=on_open_error,
+                                            on_close_callback=on_close,
+                                            custom_ioloop=loop)
+        await opened
+        return self
+
+    def on_close(self, reply_code, reply_text):
+        for channel_number in list(self.pending):
+            self.fail_pending(channel_number, reply_text)
+        if not self.closed.done():
+            self.closed.set_result(reply_text)
+
+    @property
+    def is_open(self):
+        return self.connection is not None and self.connection.is_open
+
+    # the heartbeat timeout in seconds negotiated with the broker, 0 when off
+    @property
+    def heartbeat(self):
+        return self.connection.params.heartbeat or 0
+
+    async def channel(self, on_close=None):
+        opened = asyncio.get_running_loop().create_future()
+        self.connection.channel(lambda chan: opened.set_result(chan))
+        chan = await opened
+        chan.add_on_close_callback(self.on_channel_close)
+        if on_close is not None:
+            chan.add_on_close_callback(on_close)
+        return chan
+
+    def on_channel_close(self, chan, reply_code, reply_text):
+        self.fail_pending(chan.channel_number, reply_text)
+
+    def fail_pending(self, channel_number, reason):
+        for future in self.pending.pop(channel_number, set()):
+            if not future.done():
+                future.set_exception(ConnectionLost(reason))
+
+    # awaits a pika channel method that takes a completion callback as its first
+    # argument (queue_declare, queue_bind, basic_qos...) and returns the reply frame
+    async def rpc(self, chan, method, *args, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        pending = self.pending.setdefault(chan.channel_number, set())
+        pending.add(future)
+
+        def on_done(frame):
+            if not future.done():
+                future.set_result(frame)
+
+        method(on_done, *args, **kwargs)
+        try:
+            return await future
+        finally:
+            pending.discard(future)
+
+    async def close(self):
+        if self.connection is not None and not (self.connection.is_closing or self.connection.is_closed):
+            self.connection.close()
+        if self.closed is not None:
+            # shielded, a cancelled caller must not cancel the future other callers wait on
+            await asyncio.shield(self.closed)
+
+
+# connects to the first reachable node, trying start_index first unless it
+# failed recently and then the nodes that answered recently (failover.NodeHealth).
+# After a pass over the cluster without success it waits a jittered delay that
+# grows with every pass.
+async def connect_to_cluster(nodes, node_names, start_index, backoff=None, health=cluster_health, connect_timeout=3):
+    if backoff is None:
+        backoff = Backoff()
+    while True:
+        for index in health.order(len(nodes), max(start_index, 0)):
+            print("Attempting to connect to " + node_names[index])
+            try:
+                connection = await RabbitConnection(nodes[index], connect_timeout=connect_timeout).open()
+                health.succeeded(index)
+                backoff.reset()
+                print("Connection open")
+                return connection, index
+            except ConnectionLost as ex:
+                health.failed(index)
+                print(ex)
+
+        delay = backoff.next_delay()
+        print(f"Failed to connect. Will retry in {delay:.2f} seconds")
+        await asyncio.sleep(delay)
+
+
+class Publisher:
+
+    # publishes yield to the event loop every yield_every messages so that
+    # buffered frames get written and confirms get read during a publish loop.
+    # With retain every message is kept until it is confirmed, so that if the
+    # channel is lost the unconfirmed ones can be taken (take_unconfirmed) and
+    # published again on a new channel (republish). MessageTemplate properties
+    # are frozen for that, other properties must not be changed once published.
+    def __init__(self, connection, confirms=True, max_in_flight=10000, on_confirm=None, yield_every=100,
+                 low_watermark=None, rate_limiter=None, retain=False):
+        self.connection = connection
+        self.confirms = confirms
+        self.max_in_flight = max_in_flight
+        if low_watermark is None and max_in_flight is not None:
+            low_watermark = max_in_flight // 2
+        self.low_watermark = low_watermark
+        self.rate_limiter = rate_limiter
+        self.on_confirm = on_confirm
+        self.yield_every = yield_every
+        self.retain = retain and confirms
+        self.channel = None
+        self.close_reason = None
+        self.channel_error = False
+        self.tracker = ConfirmTracker()
+        self.futures = dict()
+        # delivery tag -> (exchange, routing key, body, properties, mandatory)
+        self.retained = dict()
+        # messages of a lost channel to publish before anything new, each with its future
+        self.backlog = collections.deque()
+        self.can_publish = None
+        self.idle = None
+        self.published = 0
+        self.acked = 0
+        self.nacked = 0
+        self.lost = 0
+        self.republished = 0
+        self.first_confirm = None
+
+    async def open(self):
+        self.can_publish = asyncio.Event()
+        self.can_publish.set()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.channel = await self.connection.channel(on_close=self.on_channel_closed)
+        if self.confirms:
+            self.channel.confirm_delivery(self.on_delivery_confirmation)
+        return self
+
+    def in_flight(self):
+        return self.tracker.outstanding()
+
+    # this is ignoring the posibility of ack + return
+    def on_delivery_confirmation(self, frame):
+        if not (isinstance(frame.method, spec.Basic.Ack) or isinstance(frame.method, spec.Basic.Nack)):
+            return
+
+        acked = isinstance(frame.method, spec.Basic.Ack)
+        tag = frame.method.delivery_tag
+        futures = self.futures
+        if frame.method.multiple:
+            upper = self.tracker.last_tag if tag == 0 else tag
+            # tags below the watermark are already resolved so each tag is only visited once
+            tags = range(self.tracker.watermark + 1, upper + 1)
+            resolved = [futures.pop(t) for t in tags if t in futures]
+            if self.retain:
+                retained = self.retained
+                for t in tags:
+                    retained.pop(t, None)
+        else:
+            resolved = [futures.pop(tag)] if tag in futures else []
+            if self.retain:
+                self.retained.pop(tag, None)
+        confirmed = self.tracker.confirm(tag, frame.method.multiple)
+        if confirmed == 0:
+            print(f"Received confirm for unknown delivery tag: {tag}")
+        elif self.first_confirm is None:
+            self.first_confirm = time.monotonic()
+
+        for future in resolved:
+            if not future.done():
+                future.set_result(acked)
+        if acked:
+            self.acked += confirmed
+        else:
+            self.nacked += confirmed
+        if self.on_confirm is not None and confirmed > 0:
+            self.on_confirm(acked, confirmed)
+
+        self.update_events()
+
+    def update_events(self):
+        in_flight = self.tracker.outstanding()
+        if self.max_in_flight is None or in_flight <= self.low_watermark:
+            self.can_publish.set()
+        if in_flight == 0:
+            self.idle.set()
+
+    def on_channel_closed(self, chan, reply_code, reply_text):
+        self.close_reason = reply_text
+        # pika marks the connection closed before it closes the channels of a lost
+        # connection, also for a connection the node closed (320 CONNECTION_FORCED)
+        self.channel_error = self.connection.is_open
+        if self.channel_error:
+            self.close_reason = f"{reply_code} {reply_text}"
+        if self.retain:
+            # kept, with their futures, to be published again ahead of the rest of the backlog
+            unconfirmed = [self.retained[tag] + (self.futures.pop(tag, None),) for tag in sorted(self.retained)]
+            self.backlog.extendleft(reversed(unconfirmed))
+            self.retained.clear()
+        # the outcome of other unconfirmed messages is unknown, their futures are cancelled
+        self.lost += len(self.futures)
+        for future in self.futures.values():
+            future.cancel()
+        self.futures.clear()
+        self.tracker.reset()
+        # wake anyone waiting so they see the channel is gone
+        self.can_publish.set()
+        self.idle.set()
+
+    def check_open(self):
+        if self.channel is None or not self.channel.is_open:
+            if self.channel_error:
+                raise ChannelError(f"Channel closed by the broker: {self.close_reason}")
+            raise ConnectionLost(self.close_reason or "Channel closed")
+
+    # waits for a token of the rate limiter and, once the in-flight limit is
+    # reached, for confirms down to the low watermark, then publishes and returns a
+    # future that resolves to True on ack and False on nack (None without confirms)
+    async def publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        if self.rate_limiter is not None:
+            await self.rate_limiter.take()
+        if self.confirms and self.max_in_flight is not None and self.tracker.outstanding() >= self.max_in_flight:
+            await self.wait_for_credit()
+
+        future = self.publish_nowait(exchange, routing_key, body, properties, mandatory)
+        if self.published % self.yield_every == 0:
+            await asyncio.sleep(0)
+        return future
+
+    async def wait_for_credit(self):
+        while self.tracker.outstanding() >= self.max_in_flight:
+            self.check_open()
+            self.can_publish.clear()
+            await self.can_publish.wait()
+
+    def publish_nowait(self, exchange, routing_key, body, properties=None, mandatory=False):
+        self.check_open()
+        if self.retain and isinstance(properties, MessageTemplate):
+            properties = properties.freeze()
+        self.published += 1
+        return self.send(exchange, routing_key, body, properties, mandatory)
+
+    def send(self, exchange, routing_key, body, properties, mandatory, future=None):
+        self.channel.basic_publish(exchange=exchange,
+                                   routing_key=routing_key,
+                                   body=body,
+                                   properties=properties,
+                                   mandatory=mandatory)
+        if not self.confirms:
+            return None
+
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+        tag = self.tracker.published()
+        self.futures[tag] = future
+        if self.retain:
+            self.retained[tag] = (exchange, routing_key, body, properties, mandatory)
+        self.idle.clear()
+        return future
+
+    # publishes the backlog, oldest first, the futures of its messages resolve
+    # with the confirms of this channel. Whatever is not published when this
+    # channel is lost too stays in the backlog.
+    async def republish(self):
+        backlog = self.backlog
+        while backlog:
+            if self.max_in_flight is not None and self.tracker.outstanding() >= self.max_in_flight:
+                await self.wait_for_credit()
+            self.check_open()
+            exchange, routing_key, body, properties, mandatory, future = backlog[0]
+            self.send(exchange, routing_key, body, properties, mandatory, future)
+            backlog.popleft()
+            self.republished += 1
+            if self.republished % self.yield_every == 0:
+                await asyncio.sleep(0)
+
+    # the messages to publish again on a new channel
+    def take_unconfirmed(self):
+        unconfirmed = list(self.backlog)
+        self.backlog.clear()
+        return unconfirmed
+
+    # waits until every published message has been confirmed
+    async def wait_for_confirms(self):
+        while self.tracker.outstanding() > 0:
+            self.check_open()
+            await self.idle.wait()
+        self.check_open()
+
+
+class Delivery:
+    __slots__ = ('channel', 'method', 'properties', 'body')
+
+    def __init__(self, channel, method, properties, body):
+        self.channel = channel
+        self.method = method
+        self.properties = properties
+        self.body = body
+
+    @property
+    def delivery_tag(self):
+        return self.method.delivery_tag
+
+
+# async iterator over the deliveries of a queue, the prefetch bounds how many
+# deliveries can be waiting, so a slow loop body pushes back on the broker.
+# Iteration ends when the channel closes or the broker cancels the consumer.
+class Consumer:
+
+    def __init__(self, connection, queue, prefetch=1, no_ack=False, arguments=None):
+        self.connection = connection
+        self.queue = queue
+        self.prefetch = prefetch
+        self.no_ack = no_ack
+        self.arguments = arguments
+        self.channel = None
+        self.deliveries = None
+        self.close_reason = None
+
+    async def open(self):
+        self.deliveries = asyncio.Queue()
+        self.channel = await self.connection.channel(on_close=self.on_channel_closed)
+        await self.connection.rpc(self.channel, self.channel.basic_qos, prefetch_count=self.prefetch)
+        self.channel.add_on_cancel_callback(self.on_cancelled)
+        self.channel.basic_consume(self.on_message,
+                                   queue=self.queue,
+                                   no_ack=self.no_ack,
+                                   arguments=self.arguments)
+        return self
+
+    def on_message(self, chan, method, properties, body):
+        self.deliveries.put_nowait(Delivery(chan, method, properties, body))
+
+    def on_channel_closed(self, chan, reply_code, reply_text):
+        self.close_reason = reply_text
+        self.deliveries.put_nowait(None)
+
+    # e.g. the queue was deleted or, with x-cancel-on-ha-failover, its master failed over
+    def on_cancelled(self, frame):
+        self.close_reason = "Consumer cancelled by the broker"
+        self.deliveries.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        delivery = await self.deliveries.get()
+        if delivery is None:
+            raise StopAsyncIteration
+        return delivery
+
+    def ack(self, delivery_tag, multiple=False):
+        self.channel.basic_ack(delivery_tag=delivery_tag, multiple=multiple)
+
+    def nack(self, delivery_tag, multiple=False, requeue=True):
+        self.channel.basic_nack(delivery_tag=delivery_tag, multiple=multiple, requeue=requeue)
+
+
+# runs publish_messages(publisher) against the cluster, opening a new connection
+# whenever the current one is lost, until it returns. With republish the
+# messages left unconfirmed by a lost connection are published again on the new
+# one before publish_messages is called again, else they are counted as lost.
+# A channel the broker closes on a connection that stays up is no node failure:
+# its ChannelError is raised instead of failing over.
+# Returns the FailoverStats of the run.
+# The rate limiter is shared by all connections, so the rate holds across reconnects.
+async def run_publisher(nodes, node_names, start_index, publish_messages, on_confirm=None, max_in_flight=10000,
+                        low_watermark=None, rate_limiter=None, republish=True):
+    return await run_publishers(nodes, node_names, start_index, [publish_messages], on_confirm,
+                                max_in_flight, low_watermark, rate_limiter, republish)
+
+async def publish_after_backlog(publisher, publish_messages):
+    await publisher.republish()
+    await publish_messages(publisher)
+
+# the same with one channel per publish_messages function, all on one connection.
+# Each function is called again with the new channel's publisher after a
+# reconnect, so it has to keep track of where it got to itself. The unconfirmed
+# messages of a channel are republished on the channel that takes its place, so
+# what one function publishes stays in order, apart from the duplicates of
+# messages that did arrive but whose confirm was lost.
+async def run_publishers(nodes, node_names, start_index, publish_functions, on_confirm=None, max_in_flight=10000,
+                         low_watermark=None, rate_limiter=None, republish=True):
+    curr_node = start_index
+    stats = FailoverStats()
+    backoff = Backoff()
+    backlogs = [list() for _ in publish_functions]
+    lost_at = None
+    while True:
+        connection, curr_node = await connect_to_cluster(nodes, node_names, curr_node, backoff)
+        publishers = list()
+        tasks = list()
+        try:
+            for index in range(len(publish_functions)):
+                publisher = await Publisher(connection, max_in_flight=max_in_flight, on_confirm=on_confirm,
+                                            low_watermark=low_watermark, rate_limiter=rate_limiter,
+                                            retain=republish).open()
+                publisher.backlog.extend(backlogs[index])
+                backlogs[index] = list()
+                publishers.append(publisher)
+            if lost_at is not None:
+                stats.reconnect_sec.append(time.monotonic() - lost_at)
+            for publisher, publish_messages in zip(publishers, publish_functions):
+                tasks.append(asyncio.ensure_future(publish_after_backlog(publisher, publish_messages)))
+            await asyncio.gather(*tasks)
+            for publisher in publishers:
+                await publisher.wait_for_confirms()
+            await connection.close()
+            record_resume(stats, publishers, lost_at)
+            stats.republished += sum(publisher.republished for publisher in publishers)
+            return stats
+        except ChannelError:
+            # failing over would only get the channel closed again on the next node
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await connection.close()
+            raise
+        except ConnectionLost as ex:
+            record_resume(stats, publishers, lost_at)
+            lost_at = time.monotonic()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for index, publisher in enumerate(publishers):
+                backlogs[index] = publisher.take_unconfirmed()
+            stats.failovers += 1
+            stats.lost += sum(publisher.lost for publisher in publishers)
+            stats.republished += sum(publisher.republished for publisher in publishers)
+            print(f"Connection lost: {ex}, {sum(len(backlog) for backlog in backlogs)} unconfirmed messages to republish")
+            cluster_health.failed(curr_node)
+            await connection.close()
+            curr_node = (curr_node + 1) % len(nodes)
+
+# the time from losing the previous connection to the first confirm on this one
+def record_resume(stats, publishers, lost_at):
+    confirmed_at = [publisher.first_confirm for publisher in publishers if publisher.first_confirm is not None]
+    if lost_at is not None and confirmed_at:
+        stats.resume_sec.append(min(confirmed_at) - lost_at)
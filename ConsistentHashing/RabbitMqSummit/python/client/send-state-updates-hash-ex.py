@@ -1,13 +1,15 @@
 #!/usr/bin/env python
-import pika
-from pika import spec
+import os
 import sys
 import time
-import subprocess
-import datetime
-import uuid
 import random
+import asyncio
 from command_args import get_args, get_mandatory_arg, get_optional_arg
+from body_format import TEXT_CONTENT_TYPE, BINARY_CONTENT_TYPE, encode_state_update
+from message_template import MessageTemplate, CorrelationIds
+from token_bucket import TokenBucket
+from rabbit_client import resolve_node_list, cluster_node_names, get_node_index, run_publisher
+from hash_ring import HashRing, verify_client_routing
 
 args = get_args(sys.argv)
 
@@ -17,192 +19,124 @@ exchange = get_mandatory_arg(args, "--ex")
 count = int(get_mandatory_arg(args, "--msgs"))
 state_count = int(get_mandatory_arg(args, "--keys"))
 dup_rate = float(get_optional_arg(args, "--dup-rate", "0"))
+# text: "a=1" bodies, binary: the fixed layout of body_format.py with the key's
+# index as key id, the publish time and --producer-id
+body_format = get_optional_arg(args, "--body-format", "text")
+producer_id = int(get_optional_arg(args, "--producer-id", str(os.getpid())))
+# publishes each key straight to the queue the exchange would route it to,
+# using the exchange's ring read from the node. Only allowed once hash_ring.py
+# reproduces the known answers captured from a node of the node's version
+route_client_side = get_optional_arg(args, "--route-client-side", "false") == "true"
+# publishing pauses at --max-in-flight unconfirmed messages and resumes once
+# confirms bring that down to --low-watermark; --rate holds a steady target of
+# messages per second, 0 publishes as fast as the credit allows
+max_in_flight = int(get_optional_arg(args, "--max-in-flight", "10000"))
+low_watermark = int(get_optional_arg(args, "--low-watermark", str(max_in_flight // 2)))
+rate = float(get_optional_arg(args, "--rate", "0"))
+# the messages left unconfirmed by a lost connection are published again on the
+# next one, with --republish false they are dropped and counted as lost
+republish = get_optional_arg(args, "--republish", "true") == "true"
 total = count * state_count
 
 if state_count > 10:
     print("State count limit is 10")
     exit(1)
 
-terminate = False
-exit_triggered = False
-last_ack_time = datetime.datetime.now()
 last_ack = 0
 
-node_names = []
+node_names = cluster_node_names(node_count)
 
 curr_pos = 0
-pending_messages = list()
-pending_acks = list()
 pos_acks = 0
 neg_acks = 0
 state_index = 0
 states = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j']
 val = 1
-
-for i in range(1, node_count+1):
-    node_names.append(f"rabbitmq{i}")
-nodes = list()
-
-def get_node_index(node_name):
-    index = 0
-    for node in node_names:
-        if node == node_name:
-            return index
-
-        index +=1
-
-    return -1
-
-def on_open(connection):
-    connection.channel(on_channel_open)
-    print("Connection open")
-
-def on_channel_open(chan):
-    global connection, channel
-    chan.confirm_delivery(on_delivery_confirmation)
-    channel = chan
-    publish_messages()
-
-# this is ignoring the posibility of ack + return
-# do not use in production code
-def on_delivery_confirmation(frame):
-    global last_ack_time, pending_messages, pos_acks, neg_acks, last_ack, count, total
-
-    if isinstance(frame.method, spec.Basic.Ack) or isinstance(frame.method, spec.Basic.Nack):
-        if frame.method.multiple == True:
-            acks = 0
-            messages_to_remove = [item for item in pending_messages if item <= frame.method.delivery_tag]
-            for val in messages_to_remove:
-                try:
-                    pending_messages.remove(val)
-                except:
-                    print(f"Could not remove multiple flag message: {val}")
-                acks += 1
-        else:
-            try:
-                pending_messages.remove(frame.method.delivery_tag) 
-            except:
-                print(f"Could not remove non-multiple flag message: {frame.method.delivery_tag}")
-            acks = 1
-
-    if isinstance(frame.method, spec.Basic.Ack):
-        pos_acks += acks
-    elif isinstance(frame.method, spec.Basic.Nack):
-        neg_acks += acks
-    elif isinstance(frame.method, spec.Basic.Return):
-        print("Undeliverable message")
-    
+# the properties are encoded once, only the correlation id and the publish_ns
+# header of text bodies change per message; text bodies are the key's prefix
+# followed by the value, which is encoded once per round of keys
+correlation_ids = CorrelationIds()
+text_template = MessageTemplate(content_type=TEXT_CONTENT_TYPE, delivery_mode=2,
+                                variable_correlation_id=True, int_headers=["publish_ns"])
+binary_template = MessageTemplate(content_type=BINARY_CONTENT_TYPE, delivery_mode=2,
+                                  variable_correlation_id=True)
+key_prefixes = [f"{state}=".encode('utf-8') for state in states]
+val_text = b"1"
+targets = [(exchange, state) for state in states]
+
+def on_confirm(acked, confirmed):
+    global pos_acks, neg_acks, last_ack
+
+    if acked:
+        pos_acks += confirmed
+    else:
+        neg_acks += confirmed
 
     curr_ack = int((pos_acks + neg_acks) / 10000)
     if curr_ack > last_ack:
         print(f"Pos acks: {pos_acks} Neg acks: {neg_acks}")
         last_ack = curr_ack
 
-    if (pos_acks + neg_acks) >= total:
-        print(f"Final Count => Pos acks: {pos_acks} Neg acks: {neg_acks}")
-        connection.close()
-        exit(0)
-
-def publish_messages():
-    global connection, channel, exchange, count, pending_messages, curr_pos, states, state_count, state_index, val, dup_rate, total
+# publisher.publish waits for credit and, with --rate, for a token
+async def publish_messages(publisher):
+    global curr_pos, state_index, val, val_text
 
+    properties = binary_template if body_format == "binary" else text_template
     while curr_pos < total:
-        if channel.is_open:
-            curr_pos += 1
-            body = f"{states[state_index]}={val}"
-            corr_id = str(uuid.uuid4())
-            channel.basic_publish(exchange=exchange, 
-                                routing_key=states[state_index],
-                                body=body,
-                                properties=pika.BasicProperties(content_type='text/plain',
-                                                        delivery_mode=2,
-                                                        correlation_id=corr_id))
-
-            # potentially send a duplicate if enabled
-            if dup_rate > 0:
-                if random.uniform(0, 1) < dup_rate:
-                    channel.basic_publish(exchange=exchange, 
-                                routing_key=states[state_index],
-                                body=body,
-                                properties=pika.BasicProperties(content_type='text/plain',
-                                                        delivery_mode=2,
-                                                        correlation_id=corr_id))
-            
-            pending_messages.append(curr_pos)
-
-            state_index += 1
-            if state_index == state_count:
-                state_index = 0
-                val += 1
-
-            if curr_pos % 1000 == 0:
-                if len(pending_messages) > 10000:
-                    #print("Reached in-flight limit, pausing publishing for 2 seconds")
-                    if channel.is_open:
-                        connection.add_timeout(2, publish_messages)
-                        break
-            
+        # the publish time for the latencies output-consumer.py reports
+        publish_ns = time.time_ns()
+        properties.correlation_id = correlation_ids.next()
+        if body_format == "binary":
+            body = encode_state_update(state_index, val, publish_ns, producer_id)
         else:
-            print("Channel closed, ceasing publishing")
-            break
-
-def on_close(connection, reason_code, reason_text):
-    connection.ioloop.stop()
-    print("Connection closed. Reason: " + reason_text)
-
-def reconnect():
-    print("Reconnect called")
-    global curr_node
-    curr_node += 1
-    if curr_node > 2:
-        print("Failed to connect. Will retry in 5 seconds")
-        time.sleep(5)
-        curr_node = 0
-    
-    connect()
-
-def connect():
-    global connection, curr_node, terminate
-    print("Attempting to connect to " + nodes[curr_node])
-    parameters = pika.URLParameters('amqp://jack:jack@' + nodes[curr_node] + ':5672/%2F')
-    connection = pika.SelectConnection(parameters=parameters,
-                                on_open_callback=on_open,
-                                on_open_error_callback=reconnect,
-                                on_close_callback=on_close)
-
-    try:
-        connection.ioloop.start()
-    except KeyboardInterrupt:
-        connection.close()
-        connection.ioloop.stop()
-        terminate = True
-    except Exception as ex:
-        template = "An exception of type {0} occurred. Arguments:{1!r}"
-        message = template.format(type(ex).__name__, ex.args)
-        print(message)
-
+            body = key_prefixes[state_index] + val_text
+            properties.headers["publish_ns"] = publish_ns
+        target_exchange, routing_key = targets[state_index]
+        await publisher.publish(exchange=target_exchange,
+                                routing_key=routing_key,
+                                body=body,
+                                properties=properties)
+
+        # potentially send a duplicate if enabled
+        if dup_rate > 0:
+            if random.uniform(0, 1) < dup_rate:
+                await publisher.publish(exchange=target_exchange,
+                                        routing_key=routing_key,
+                                        body=body,
+                                        properties=properties)
+
+        # the position only moves on once the message is published, so after a
+        # reconnect the message that failed is the next one published
+        curr_pos += 1
+        state_index += 1
+        if state_index == state_count:
+            state_index = 0
+            val += 1
+            val_text = str(val).encode('utf-8')
+
+async def main():
+    global targets
+    nodes = resolve_node_list(node_names)
+    if route_client_side:
+        try:
+            verify_client_routing(connect_node)
+        except ValueError as ex:
+            print(ex)
+            exit(1)
+        ring = HashRing.fetch(connect_node, exchange)
+        targets = [('', ring.queue_for(state)) for state in states]
+        print("Routing client side: " + " ".join(f"{state}->{queue}" for state, (_, queue) in zip(states[:state_count], targets)))
+    curr_node = get_node_index(node_names, connect_node)
+    started = time.monotonic()
+    stats = await run_publisher(nodes, node_names, curr_node, publish_messages, on_confirm=on_confirm,
+                                max_in_flight=max_in_flight, low_watermark=low_watermark,
+                                rate_limiter=TokenBucket(rate) if rate > 0 else None, republish=republish)
+    elapsed = time.monotonic() - started
+    print(f"Final Count => Pos acks: {pos_acks} Neg acks: {neg_acks}")
+    print(f"Confirmed {pos_acks + neg_acks} in {elapsed:.1f}s: {(pos_acks + neg_acks) / elapsed:.0f} msg/s")
+    print(stats.summary())
+
+try:
+    asyncio.run(main())
+except KeyboardInterrupt:
     print("Disconnected")
-
-def get_node_ip(node_name):
-    bash_command = "bash ../cluster/get-node-ip.sh " + node_name
-    process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE)
-    output, error = process.communicate()
-    ip = output.decode('ascii').replace('\n', '')
-    return ip
-
-for node_name in node_names:
-    nodes.append(get_node_ip(node_name))
-
-curr_node = get_node_index(connect_node)
-
-# keep running until the terminate signal has been received
-while terminate == False:
-    try:
-        connect()
-    except Exception as ex:
-        template = "An exception of type {0} occurred. Arguments:{1!r}"
-        message = template.format(type(ex).__name__, ex.args)
-        print(message)
-
-        if terminate == False:
-            reconnect()
@@ -0,0 +1,33 @@
+import time
+import asyncio
+
+# Holds publishing to a steady rate of messages per second. Tokens refill
+# continuously at rate per second up to burst, every message takes one. While
+# tokens are available take() returns without yielding to the event loop; when
+# they run out it sleeps until enough have refilled. Event loop sleeps are coarser
+# than the gap between two messages at high rates, so a refill usually releases
+# several messages at once and the rate holds over any interval longer than
+# burst / rate seconds.
+class TokenBucket:
+
+    # burst defaults to 10ms of messages
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate / 100)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waits = 0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def take(self, count=1):
+        if self.tokens < count:
+            self.refill()
+        while self.tokens < count:
+            self.waits += 1
+            await asyncio.sleep((count - self.tokens) / self.rate)
+            self.refill()
+        self.tokens -= count
@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+from rabbit_client import get_node_ip, RabbitConnection
+from order_verifier import OrderVerifier
+from latency_histogram import PipelineLatencies
+
+# Runs ordering verification as one output-consumer.py worker process per shard.
+# The output is fed through an x-consistent-hash exchange named after the queue
+# (consumer.py --out-exchange), bound to one queue per shard, so every key is
+# verified by exactly one worker and per key order survives the sharding.
+#
+# Run boundaries are decided here, for all shards at once: a run ends when no
+# shard has verified a message for idle_sec seconds, or on SIGUSR1 to this
+# process. Every worker is then sent SIGUSR1, which its event loop handles
+# between two deliveries by printing its counters as a "Shard report:" line and
+# starting from zero. Once every shard has reported, the merged report of the
+# run is printed. On exit the workers' final counters are merged the same way.
+
+REPORT_PREFIX = "Shard report: "
+PROGRESS_PREFIX = "Progress: verified "
+
+class Shard:
+
+    def __init__(self, queue, node):
+        self.queue = queue
+        self.node = node
+        self.process = None
+        self.verified = 0
+        self.changed_at = time.monotonic()
+        self.reports = asyncio.Queue()
+
+
+class ShardSupervisor:
+
+    def __init__(self, queue, shard_count, nodes, worker_args, idle_sec=2, report_sec=5):
+        self.exchange = queue
+        self.shards = [Shard(f"{queue}{i:03}", nodes[(i-1) % len(nodes)]) for i in range(1, shard_count+1)]
+        self.worker_args = worker_args
+        self.idle_sec = idle_sec
+        self.report_sec = report_sec
+        self.run_number = 1
+        self.boundary = None
+        self.stopping = False
+
+    async def declare(self):
+        connection = await RabbitConnection(get_node_ip(self.shards[0].node)).open()
+        try:
+            chan = await connection.channel()
+            await connection.rpc(chan, chan.exchange_declare, exchange=self.exchange,
+                                 exchange_type='x-consistent-hash', durable=True)
+            for shard in self.shards:
+                await connection.rpc(chan, chan.queue_declare, queue=shard.queue, durable=True)
+                await connection.rpc(chan, chan.queue_bind, queue=shard.queue, exchange=self.exchange, routing_key="10")
+        finally:
+            await connection.close()
+        print(f"Verifying exchange {self.exchange} with {len(self.shards)} shards: "
+              f"{self.shards[0].queue}..{self.shards[-1].queue}")
+
+    async def start(self, shard):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output-consumer.py")
+        command = [sys.executable, "-u", script,
+                   "--node", shard.node,
+                   "--queue", shard.queue,
+                   "--mode", "verify",
+                   "--shard-worker", "true",
+                   "--report-sec", str(min(1.0, self.report_sec))] + self.worker_args
+        # a new session keeps a Ctrl-C from reaching the workers directly, they
+        # are stopped by the supervisor so their final counters can be collected
+        shard.process = await asyncio.create_subprocess_exec(*command,
+                                                             stdout=asyncio.subprocess.PIPE,
+                                                             stderr=asyncio.subprocess.STDOUT,
+                                                             start_new_session=True)
+
+    async def read_output(self, shard):
+        async for line in shard.process.stdout:
+            text = line.decode('utf-8', errors='replace').rstrip()
+            if text.startswith(PROGRESS_PREFIX):
+                verified = int(text[len(PROGRESS_PREFIX):])
+                if verified != shard.verified:
+                    shard.verified = verified
+                    shard.changed_at = time.monotonic()
+            elif text.startswith(REPORT_PREFIX):
+                # the worker starts from zero once it has reported
+                shard.verified = 0
+                shard.reports.put_nowait(json.loads(text[len(REPORT_PREFIX):]))
+            else:
+                print(f"[{shard.queue}] {text}")
+
+        await shard.process.wait()
+        if not self.stopping:
+            print(f"Verifier of {shard.queue} exited with code {shard.process.returncode}, "
+                  f"its keys are no longer verified")
+
+    def is_running(self, shard):
+        return shard.process is not None and shard.process.returncode is None
+
+    async def collect(self, shards, timeout):
+        merged = OrderVerifier()
+        latencies = None
+        missing = list()
+        for shard in shards:
+            try:
+                state = await asyncio.wait_for(shard.reports.get(), timeout)
+            except asyncio.TimeoutError:
+                missing.append(shard.queue)
+                continue
+            merged.merge(state["order"])
+            if state["latency"] is not None:
+                if latencies is None:
+                    latencies = PipelineLatencies()
+                latencies.merge_state(state["latency"])
+        return merged, latencies, missing
+
+    def print_report(self, title, merged, latencies, missing):
+        print(f"{title}, {len(self.shards) - len(missing)} of {len(self.shards)} shards")
+        print(merged.report())
+        if latencies is not None and merged.messages > 0:
+            print("Latencies:")
+            print(latencies.run_report())
+        if missing:
+            print(f"  no report from: {' '.join(missing)}")
+
+    async def end_run(self):
+        shards = [shard for shard in self.shards if self.is_running(shard)]
+        for shard in shards:
+            shard.process.send_signal(signal.SIGUSR1)
+        merged, latencies, missing = await self.collect(shards, 10)
+        self.print_report(f"Run {self.run_number} report", merged, latencies, missing)
+        print("----------------------------------", flush=True)
+        self.run_number += 1
+
+    def request_boundary(self):
+        if self.boundary is None or self.boundary.done():
+            self.boundary = asyncio.ensure_future(self.end_run())
+
+    async def monitor(self):
+        last_report = time.monotonic()
+        last_total = 0
+        while True:
+            await asyncio.sleep(0.5)
+            now = time.monotonic()
+            total = sum(shard.verified for shard in self.shards)
+            if self.boundary is not None and not self.boundary.done():
+                continue
+            if total > 0 and all(now - shard.changed_at > self.idle_sec for shard in self.shards):
+                self.request_boundary()
+                last_total = 0
+                continue
+            if now - last_report >= self.report_sec and total > 0:
+                rate = max(total - last_total, 0) / (now - last_report)
+                per_shard = " ".join(f"{shard.queue[-3:]}={shard.verified}" for shard in self.shards)
+                print(f"Run {self.run_number} verified: {total} rate: {rate:.0f} msg/s | per shard: {per_shard}", flush=True)
+                last_report = now
+                last_total = total
+
+    def stop(self):
+        if self.stopping:
+            return
+        self.stopping = True
+        print("Stopping verifiers")
+        for shard in self.shards:
+            if self.is_running(shard):
+                shard.process.send_signal(signal.SIGINT)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+        loop.add_signal_handler(signal.SIGUSR1, self.request_boundary)
+
+        await self.declare()
+        for shard in self.shards:
+            await self.start(shard)
+        monitor = asyncio.create_task(self.monitor())
+        await asyncio.gather(*[self.read_output(shard) for shard in self.shards])
+        monitor.cancel()
+        if self.boundary is not None:
+            await self.boundary
+
+        # each worker printed its final counters before exiting
+        merged, latencies, missing = await self.collect(self.shards, 0.1)
+        self.print_report(f"Final report of run {self.run_number}", merged, latencies, missing)
@@ -0,0 +1,41 @@
+import zlib
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# Runs blocking message processing on a fixed set of single threaded lanes.
+# A key always maps to the same lane and a lane runs its work in submission
+# order, so messages with the same key are processed in order while different
+# keys are processed in parallel. Completion is reported through asyncio futures
+# whose callbacks run on the event loop thread that owns the connection, so
+# publishes and acks never happen on a lane thread.
+class WorkerLanes:
+
+    def __init__(self, lane_count):
+        self.lanes = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"lane{i}") for i in range(lane_count)]
+        self.submitted = [0] * lane_count
+        self.stopped = False
+
+    def lane_for(self, key):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        return zlib.crc32(key) % len(self.lanes)
+
+    def submit(self, key, fn, *args):
+        lane = self.lane_for(key)
+        self.submitted[lane] += 1
+        return asyncio.get_running_loop().run_in_executor(self.lanes[lane], self.run, fn, args)
+
+    def run(self, fn, args):
+        # work queued behind a shutdown is dropped, its deliveries are redelivered
+        if self.stopped:
+            return None
+        return fn(*args)
+
+    def shutdown(self):
+        self.stopped = True
+        for lane in self.lanes:
+            lane.shutdown(wait=False)
+
+    def stats(self):
+        per_lane = " ".join(str(count) for count in self.submitted)
+        return f"Lanes: {len(self.lanes)} messages per lane: {per_lane}"
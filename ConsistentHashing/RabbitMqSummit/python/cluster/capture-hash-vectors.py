@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+import os
+import re
+import sys
+import json
+import asyncio
+import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+from node_resolver import get_node_ip, split_address
+from command_args import get_args, get_optional_arg
+from rabbit_client import RabbitConnection, Publisher, Consumer, ConnectionLost
+from hash_ring import (HashRing, PHASH2_RANGE, VECTORS_FILE, node_version, rabbitmqctl_eval,
+                       client_routing_problems)
+
+# python capture-hash-vectors.py [--node rabbitmq1] [--keys 1000] [--queues 10] [--weight 10] [--output ../client/hash-vectors.json]
+#
+# Captures known answers for hash_ring.py from a running node:
+#   - erlang:phash2(Key, 2^27) and erlang:phash2([Key], 2^27) of every key, the
+#     second being what the consistent hash exchange routes by
+#   - the ring of a temporary x-consistent-hash exchange with --queues queues
+#     bound with weight --weight, and the queue every key was actually routed to,
+#     found by publishing each key and consuming the queues
+# and writes them with the node's RabbitMQ version to ../client/hash-vectors.json,
+# where hash_ring.verify_client_routing checks the client's port against them.
+# Keys are k0..k<n> and keys of every length up to 40 bytes, to cover each tail
+# length of the block hash. The temporary exchange and queues are deleted after.
+
+args = get_args(sys.argv)
+node_name = get_optional_arg(args, "--node", "rabbitmq1")
+key_count = int(get_optional_arg(args, "--keys", "1000"))
+queue_count = int(get_optional_arg(args, "--queues", "10"))
+weight = int(get_optional_arg(args, "--weight", "10"))
+output = get_optional_arg(args, "--output", VECTORS_FILE)
+
+exchange_name = "hash-vectors-ex"
+queue_names = [f"hash-vectors-{i:03}" for i in range(1, queue_count+1)]
+keys = [f"k{i}" for i in range(key_count)] + ["x" * length for length in range(41)]
+
+def capture_hashes():
+    binaries = ", ".join(f'<<"{key}">>' for key in keys)
+    expression = (f"[{{erlang:phash2(K, {PHASH2_RANGE}), erlang:phash2([K], {PHASH2_RANGE})}} "
+                  f"|| K <- [{binaries}]].")
+    stdout, error = rabbitmqctl_eval(node_name, expression)
+    pairs = re.findall(r'\{(\d+),\s*(\d+)\}', stdout)
+    if len(pairs) != len(keys):
+        print(f"Expected {len(keys)} hashes from {node_name}, got {len(pairs)}: {error}")
+        exit(1)
+    return [{"key": key, "phash2": int(binary), "route_hash": int(routes)}
+            for key, (binary, routes) in zip(keys, pairs)]
+
+# publishes every key as routing key and body, then reads back where each landed
+async def capture_routes(node):
+    connection = await RabbitConnection(node).open()
+    try:
+        chan = await connection.channel()
+        await connection.rpc(chan, chan.exchange_declare, exchange=exchange_name, exchange_type='x-consistent-hash')
+        for queue_name in queue_names:
+            await connection.rpc(chan, chan.queue_declare, queue=queue_name)
+            await connection.rpc(chan, chan.queue_purge, queue=queue_name)
+            await connection.rpc(chan, chan.queue_bind, queue=queue_name, exchange=exchange_name,
+                                 routing_key=str(weight))
+
+        publisher = await Publisher(connection).open()
+        for key in keys:
+            await publisher.publish(exchange=exchange_name, routing_key=key, body=key.encode('utf-8'))
+        await publisher.wait_for_confirms()
+
+        routes = list()
+        for queue_name in queue_names:
+            consumer = await Consumer(connection, queue_name, prefetch=1000, no_ack=True).open()
+            try:
+                while True:
+                    delivery = await asyncio.wait_for(consumer.__anext__(), timeout=2)
+                    routes.append({"key": delivery.body.decode('utf-8'), "queue": queue_name})
+            except (asyncio.TimeoutError, StopAsyncIteration):
+                pass
+
+        ring = HashRing.fetch(node_name, exchange_name)
+        for queue_name in queue_names:
+            await connection.rpc(chan, chan.queue_delete, queue=queue_name)
+        await connection.rpc(chan, chan.exchange_delete, exchange=exchange_name)
+        return routes, ring
+    finally:
+        await connection.close()
+
+version = node_version(node_name)
+print(f"{node_name} runs RabbitMQ {version}")
+hashes = capture_hashes()
+node_ip, node_port = split_address(get_node_ip(node_name))
+try:
+    routes, ring = asyncio.run(capture_routes(f"{node_ip}:{node_port}"))
+except ConnectionLost as ex:
+    print(f"Capturing routes failed: {ex}")
+    exit(1)
+
+if len(routes) != len(keys):
+    print(f"Published {len(keys)} keys but consumed {len(routes)}")
+    exit(1)
+
+vectors = {"rabbitmq_version": version,
+           "node": node_name,
+           "captured": datetime.datetime.now().isoformat(),
+           "hashes": hashes,
+           "ring": [[point, ring.queues[owner]] for point, owner in zip(ring.points, ring.owners)],
+           "routes": routes}
+with open(output, "w") as f:
+    json.dump(vectors, f, indent=1)
+print(f"Wrote {len(hashes)} hashes, a ring of {len(ring.points)} points and {len(routes)} routes to {output}")
+
+problems = client_routing_problems(version, vectors)
+if problems:
+    print("hash_ring.py does not match the node: " + "; ".join(problems))
+    exit(1)
+print("hash_ring.py reproduces every captured hash and route")
@@ -1,24 +1,27 @@
 #!/usr/bin/env python
-import pika
-from pika import spec
+import os
 import sys
-import subprocess
+import time
+import asyncio
 import requests
-import json
 
-def get_node_ip(node_name):
-    bash_command = "bash ../cluster/get-node-ip.sh " + node_name
-    process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE)
-    output, error = process.communicate()
-    ip = output.decode('ascii').replace('\n', '')
-    return ip
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+from node_resolver import get_node_ip, split_address
+from command_args import get_args, get_optional_arg
+from rabbit_client import RabbitConnection, ConnectionLost
+import management_api
 
-def put_ha_policy(mgmt_node_ip):
-    r = requests.put('http://' + mgmt_node_ip + ':15672/api/policies/%2F/ha-queues', 
-        data = "{\"pattern\":\"\", \"definition\": {\"ha-mode\":\"exactly\", \"ha-params\": " + rep_factor + " }, \"priority\":0, \"apply-to\": \"queues\"}",
-        auth=("jack","jack"))
-
-    print(f"Create policy response: {r}")
+# python declare-hashing-infra.py exchange queue_prefix queue_count rep_factor purge [--connections 1] [--channels 8]
+#
+# The queues are spread over --connections x --channels channels. Every channel
+# sends the declare, bind and purge of its queues back to back without waiting
+# for the replies (nowait) and then makes one round trip to learn whether the
+# broker accepted them all, so setup time no longer grows with one round trip
+# per RPC.
+# Queues and bindings the management API shows as already existing with the same
+# arguments are skipped, so running it again against a declared cluster only
+# purges. A queue that exists with other arguments is left alone and reported,
+# redeclaring it would close the channel with PRECONDITION_FAILED.
 
 exchange_name = sys.argv[1]
 queue_prefix = sys.argv[2]
@@ -26,31 +29,98 @@ queue_count = int(sys.argv[3])
 rep_factor = sys.argv[4]
 purge = sys.argv[5]
 
-node_ip = get_node_ip("rabbitmq1")
-put_ha_policy(node_ip)
+args = get_args(sys.argv[:1] + sys.argv[6:])
+connection_count = int(get_optional_arg(args, "--connections", "1"))
+channels_per_connection = int(get_optional_arg(args, "--channels", "8"))
+
+queue_arguments = {"x-queue-mode": "lazy"}
+binding_key = "10"
+
+def get_existing(mgmt_ip):
+    try:
+        queues = management_api.get_queues(mgmt_ip)
+        bindings = management_api.get_source_bindings(mgmt_ip, exchange_name)
+    except (requests.RequestException, ValueError) as ex:
+        print(f"Could not read existing queues and bindings, declaring all of them: {ex}")
+        return dict(), set()
+
+    bound = set((binding["destination"], binding["routing_key"]) for binding in bindings
+                if binding["destination_type"] == "queue" and not binding["arguments"])
+    return queues, bound
+
+def matches(queue):
+    return (queue["durable"]
+            and not queue["auto_delete"]
+            and not queue["exclusive"]
+            and queue["arguments"] == queue_arguments)
 
-credentials = pika.PlainCredentials('jack', 'jack')
-parameters = pika.ConnectionParameters(node_ip,
-                                    5672,
-                                    '/',
-                                    credentials)
-connection = pika.BlockingConnection(parameters)
-channel = connection.channel()
+# declare, bind and purge without waiting, then one round trip that only
+# succeeds if the channel is still open, i.e. every method was accepted
+async def declare_on_channel(connection, work):
+    chan = await connection.channel()
+    for queue_name, declare, bind in work:
+        if declare:
+            chan.queue_declare(None, queue=queue_name, durable=True, nowait=True, arguments=queue_arguments)
+        if bind:
+            chan.queue_bind(None, queue=queue_name, exchange=exchange_name, routing_key=binding_key, nowait=True)
+        if purge == "true":
+            chan.queue_purge(None, queue=queue_name, nowait=True)
+    await connection.rpc(chan, chan.basic_qos, prefetch_count=0)
+    chan.close()
 
-channel.exchange_declare(exchange=exchange_name, exchange_type='x-consistent-hash', durable=True)
-print(f"Declared exchange {exchange_name}")
+async def declare(node, work):
+    connections = [await RabbitConnection(node).open() for _ in range(connection_count)]
+    try:
+        first = connections[0]
+        chan = await first.channel()
+        await first.rpc(chan, chan.exchange_declare, exchange=exchange_name, exchange_type='x-consistent-hash', durable=True)
+        chan.close()
+        print(f"Declared exchange {exchange_name}")
 
+        channel_count = connection_count * channels_per_connection
+        tasks = list()
+        for i in range(channel_count):
+            channel_work = work[i::channel_count]
+            if channel_work:
+                tasks.append(declare_on_channel(connections[i % connection_count], channel_work))
+        await asyncio.gather(*tasks)
+        return len(tasks)
+    finally:
+        for connection in connections:
+            await connection.close()
+
+start = time.perf_counter()
+node_ip, node_port = split_address(get_node_ip("rabbitmq1"))
+r = management_api.put_ha_policy(node_ip, rep_factor)
+print(f"Create policy response: {r}")
+
+existing_queues, existing_bindings = get_existing(node_ip)
+work = list()
+mismatched = list()
 for i in range(1, queue_count+1):
     suffix = f"{i:03}"
     queue_name = f"{queue_prefix}{suffix}"
-    channel.queue_declare(queue=queue_name, durable=True, arguments={"x-queue-mode": "lazy"})
-    channel.queue_bind(queue=queue_name, exchange=exchange_name, routing_key="10")
-    
-    if purge == "true":
-        channel.queue_purge(queue_name)
-        print(f"Declared, bound and purged queue {queue_name}")
-    else:
-        print(f"Declared and bound queue {queue_name}")
-
-channel.close()
-connection.close()
+    queue = existing_queues.get(queue_name)
+    if queue is not None and not matches(queue):
+        mismatched.append(queue_name)
+        continue
+    declare_queue = queue is None
+    bind_queue = (queue_name, binding_key) not in existing_bindings
+    if declare_queue or bind_queue or purge == "true":
+        work.append((queue_name, declare_queue, bind_queue))
+
+for queue_name in mismatched:
+    print(f"Skipped queue {queue_name}, it exists with other arguments: {existing_queues[queue_name]['arguments']}")
+
+try:
+    channels_used = asyncio.run(declare(f"{node_ip}:{node_port}", work))
+except ConnectionLost as ex:
+    print(f"Declaration failed: {ex}")
+    exit(1)
+
+declared = sum(1 for _, declare_queue, _ in work if declare_queue)
+bound = sum(1 for _, _, bind_queue in work if bind_queue)
+purged = len(work) if purge == "true" else 0
+print(f"Declared {declared}, bound {bound}, purged {purged} of {queue_count} queues "
+      f"({queue_count - declared - len(mismatched)} already existed, {len(mismatched)} mismatched) "
+      f"over {channels_used} channels in {time.perf_counter() - start:.2f}s")
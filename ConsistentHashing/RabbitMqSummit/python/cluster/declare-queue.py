@@ -1,17 +1,13 @@
 #!/usr/bin/env python
 import pika
 from pika import spec
+import os
 import sys
-import subprocess
 import requests
 import json
 
-def get_node_ip(node_name):
-    bash_command = "bash ../cluster/get-node-ip.sh " + node_name
-    process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE)
-    output, error = process.communicate()
-    ip = output.decode('ascii').replace('\n', '')
-    return ip
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+from node_resolver import get_node_ip, split_address
 
 def put_ha_policy(mgmt_node_ip):
     r = requests.put('http://' + mgmt_node_ip + ':15672/api/policies/%2F/ha-queues', 
@@ -24,12 +20,12 @@ queue_name = sys.argv[1]
 rep_factor = sys.argv[2]
 purge = sys.argv[3]
 
-node_ip = get_node_ip("rabbitmq1")
+node_ip, node_port = split_address(get_node_ip("rabbitmq1"))
 put_ha_policy(node_ip)
 
 credentials = pika.PlainCredentials('jack', 'jack')
 parameters = pika.ConnectionParameters(node_ip,
-                                    5672,
+                                    node_port,
                                     '/',
                                     credentials)
 connection = pika.BlockingConnection(parameters)
@@ -17,6 +17,9 @@ fi
 
 blockade status
 
+# containers are recreated with new addresses
+rm -f ../client/.node-ips.json
+
 echo "waiting for all nodes to join cluster"
 sleep 10
 
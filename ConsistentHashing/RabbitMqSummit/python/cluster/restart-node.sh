@@ -15,3 +15,6 @@ else
     blockade restart $2
     echo "$2 restarted"
 fi
+
+# a restarted container can come back with another address
+rm -f ../client/.node-ips.json
@@ -3,4 +3,6 @@
 set -e
 
 blockade start $1
+# a restarted container can come back with another address
+rm -f ../client/.node-ips.json
 echo "$1 restarted"
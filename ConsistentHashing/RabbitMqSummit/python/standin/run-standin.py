@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import signal
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+from command_args import get_args, get_optional_arg
+from standin_broker import StandInBroker
+
+# python run-standin.py [--nodes 3] [--host 127.0.0.1] [--base-port 5672] [--management-port 15672]
+#                       [--latency-ms 0] [--heartbeat 0] [--seed none]
+#
+# Runs the stand-in broker (standin_broker.py) with a node on every port from
+# --base-port and the part of the management HTTP API the scripts here use on
+# --management-port: queues with their master node, exchange bindings and the
+# policies declare-hashing-infra.py sets, which are accepted and ignored. The
+# clients find the management API on port 15672 of the first node's host.
+# Point the clients at the nodes with the printed RABBITMQ_NODES line, then for
+# example:
+#   python ../cluster/declare-hashing-infra.py state-updates-hash-ex state-updates 10 2 true
+#   python ../client/send-state-updates-hash-ex.py --ex state-updates-hash-ex --msgs 100000 --keys 10
+#
+# Failures are injected with standin-ctl.py, or with a PUT to
+#   /api/standin/nodes/{node}/kill|start|restart|pause|resume|latency
+#   /api/standin/queues/{vhost}/{queue}/move
+# with restart taking {"down_sec": n}, latency {"latency_ms": n} and move
+# {"node": name} as JSON body. GET /api/standin/rings/{vhost}/{exchange} returns
+# the points of a consistent hash exchange's ring, GET /api/standin/stats the
+# broker's message counts.
+
+args = get_args(sys.argv)
+node_count = int(get_optional_arg(args, "--nodes", "3"))
+host = get_optional_arg(args, "--host", "127.0.0.1")
+base_port = int(get_optional_arg(args, "--base-port", "5672"))
+management_port = int(get_optional_arg(args, "--management-port", "15672"))
+latency_ms = float(get_optional_arg(args, "--latency-ms", "0"))
+heartbeat = int(get_optional_arg(args, "--heartbeat", "0"))
+seed = get_optional_arg(args, "--seed", "none")
+
+broker = None
+loop = None
+
+class NotFound(Exception):
+    pass
+
+def node_of(name):
+    return f"rabbit@{name}"
+
+def queue_info(queue):
+    return {"name": queue.name, "vhost": "/", "durable": queue.durable, "auto_delete": queue.auto_delete,
+            "exclusive": queue.exclusive, "arguments": queue.arguments, "node": node_of(queue.node),
+            "messages": len(queue.messages) + queue.unacked, "messages_ready": len(queue.messages),
+            "messages_unacknowledged": queue.unacked, "consumers": len(queue.consumers),
+            "message_stats": {"publish": queue.published, "deliver_get": queue.delivered,
+                              "ack": queue.acked, "redeliver": queue.redelivered}}
+
+def get_exchange(name):
+    exchange = broker.exchanges.get(name)
+    if exchange is None:
+        raise NotFound(f"no exchange '{name}'")
+    return exchange
+
+def get_node(name):
+    if name not in broker.nodes:
+        raise NotFound(f"no node '{name}'")
+    return name
+
+# every request is handled on the broker's event loop, so it sees the broker's
+# state between two frames and never while a frame is half handled
+async def handle_get(parts):
+    if parts == ["overview"]:
+        return {"product_name": "RabbitMQ stand-in", "cluster_name": "standin",
+                "object_totals": {"queues": len(broker.queues), "exchanges": len(broker.exchanges),
+                                  "connections": len(broker.connections())},
+                "message_stats": broker.stats()}
+    if parts == ["nodes"]:
+        return [{"name": node_of(node.name), "running": node.up, "partitioned": not node.reachable.is_set(),
+                 "address": node.address(), "latency_ms": node.latency_ms} for node in broker.nodes.values()]
+    if parts[0] == "queues" and len(parts) <= 2:
+        return [queue_info(queue) for queue in broker.queues.values()]
+    if parts[0] == "queues" and len(parts) == 3:
+        queue = broker.queues.get(parts[2])
+        if queue is None:
+            raise NotFound(f"no queue '{parts[2]}'")
+        return queue_info(queue)
+    if parts[0] == "exchanges" and len(parts) == 1:
+        return [{"name": exchange.name, "vhost": "/", "type": exchange.exchange_type, "durable": exchange.durable}
+                for exchange in broker.exchanges.values()]
+    if parts[0] == "exchanges" and parts[3:] == ["bindings", "source"]:
+        exchange = get_exchange(parts[2])
+        return [{"source": exchange.name, "vhost": "/", "destination": queue, "destination_type": "queue",
+                 "routing_key": key, "arguments": {}} for queue, key in exchange.bindings]
+    if parts[:2] == ["standin", "rings"] and len(parts) == 4:
+        return [{"point": point, "queue": queue} for point, queue in get_exchange(parts[3]).ring_points()]
+    if parts == ["standin", "stats"]:
+        return broker.stats()
+    raise NotFound("/".join(parts))
+
+async def handle_put(parts, body):
+    if parts[0] == "policies":
+        return None
+    if parts[:2] == ["standin", "nodes"] and len(parts) == 4:
+        name = get_node(parts[2])
+        action = parts[3]
+        if action == "kill":
+            await broker.kill_node(name)
+        elif action == "start":
+            await broker.start_node(name)
+        elif action == "restart":
+            # the restart runs on after the reply, a node down for long would time out the request
+            asyncio.ensure_future(broker.restart_node(name, float(body.get("down_sec", 0))))
+        elif action == "pause":
+            broker.pause_node(name)
+        elif action == "resume":
+            broker.resume_node(name)
+        elif action == "latency":
+            broker.set_latency(name, float(body.get("latency_ms", 0)))
+        else:
+            raise NotFound(action)
+        return None
+    if parts[:2] == ["standin", "queues"] and parts[4:] == ["move"]:
+        if parts[3] not in broker.queues:
+            raise NotFound(f"no queue '{parts[3]}'")
+        broker.move_queue(parts[3], get_node(body.get("node", "")))
+        return None
+    raise NotFound("/".join(parts))
+
+
+class ManagementHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, content=None):
+        data = json.dumps(content).encode('utf-8') if content is not None else b''
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # /api/a/b?columns=... -> ["a", "b"], the vhost %2F becomes "/"
+    def path_parts(self):
+        path = urlparse(self.path).path
+        if not path.startswith("/api/") or path == "/api/":
+            raise NotFound(path)
+        return [unquote(part) for part in path[len("/api/"):].split("/") if part]
+
+    def handle_request(self, handler, *handler_args):
+        try:
+            future = asyncio.run_coroutine_threadsafe(handler(self.path_parts(), *handler_args), loop)
+            content = future.result(timeout=30)
+            self.reply(200 if content is not None else 204, content)
+        except NotFound as ex:
+            self.reply(404, {"error": "Object Not Found", "reason": str(ex)})
+        except ValueError as ex:
+            self.reply(400, {"error": "bad_request", "reason": str(ex)})
+
+    def do_GET(self):
+        self.handle_request(handle_get)
+
+    def do_PUT(self):
+        length = int(self.headers.get("Content-Length", 0))
+        text = self.rfile.read(length).decode('utf-8') if length > 0 else ""
+        try:
+            body = json.loads(text) if text else dict()
+        except ValueError:
+            self.reply(400, {"error": "bad_request", "reason": "body is not JSON"})
+            return
+        self.handle_request(handle_put, body)
+
+
+async def main():
+    global broker, loop
+    loop = asyncio.get_running_loop()
+    broker = StandInBroker(node_count, host, base_port, heartbeat=heartbeat,
+                           seed=None if seed == "none" else int(seed))
+    await broker.start()
+    for name in broker.nodes:
+        broker.set_latency(name, latency_ms)
+
+    server = ThreadingHTTPServer((host, management_port), ManagementHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    print(f"Stand-in broker with {node_count} nodes, management API on {host}:{management_port}")
+    print(f"export RABBITMQ_NODES={broker.node_list()}", flush=True)
+
+    stopped = asyncio.Event()
+    loop.add_signal_handler(signal.SIGINT, stopped.set)
+    loop.add_signal_handler(signal.SIGTERM, stopped.set)
+    await stopped.wait()
+    server.shutdown()
+    stats = broker.stats()
+    await broker.stop()
+    print(f"Stopped. Published: {stats['published']} Delivered: {stats['delivered']} "
+          f"Redelivered: {stats['redelivered']} Queue failovers: {stats['failovers']}")
+
+asyncio.run(main())
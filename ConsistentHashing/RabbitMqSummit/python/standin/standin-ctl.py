@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+from node_resolver import get_node_ip, split_address
+import standin_control
+
+# python standin-ctl.py kill|start|pause|resume node
+# python standin-ctl.py restart node [down_sec]
+# python standin-ctl.py latency node latency_ms
+# python standin-ctl.py move queue node
+# python standin-ctl.py stats
+#
+# The stand-in broker's counterpart of ../cluster/kill-node.sh, restart-node.sh
+# and blockade partition/join. The management API is found on the host of
+# rabbitmq1, as with the other scripts.
+
+if len(sys.argv) < 2:
+    print("Usage: standin-ctl.py kill|start|restart|pause|resume|latency|move|stats ...")
+    exit(1)
+
+command = sys.argv[1]
+mgmt_ip, _ = split_address(get_node_ip("rabbitmq1"))
+
+if command in ["kill", "start", "pause", "resume"]:
+    getattr(standin_control, f"{command}_node")(mgmt_ip, sys.argv[2])
+    print(f"{command}: {sys.argv[2]}")
+elif command == "restart":
+    down_sec = float(sys.argv[3]) if len(sys.argv) > 3 else 0
+    standin_control.restart_node(mgmt_ip, sys.argv[2], down_sec)
+    print(f"restart: {sys.argv[2]}, down for {down_sec}s")
+elif command == "latency":
+    standin_control.set_latency(mgmt_ip, sys.argv[2], float(sys.argv[3]))
+    print(f"latency: {sys.argv[2]} {sys.argv[3]}ms")
+elif command == "move":
+    standin_control.move_queue(mgmt_ip, sys.argv[2], sys.argv[3])
+    print(f"move: {sys.argv[2]} to {sys.argv[3]}")
+elif command == "stats":
+    for key, value in standin_control.get_stats(mgmt_ip).items():
+        print(f"{key}: {value}")
+else:
+    print(f"Unknown command {command}")
+    exit(1)
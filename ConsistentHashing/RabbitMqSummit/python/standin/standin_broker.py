@@ -0,0 +1,839 @@
+import os
+import random
+import struct
+import asyncio
+import collections
+from pika import spec
+from pika import frame as pika_frame
+from hash_ring import HashRing, PHASH2_RANGE
+
+# In-process stand-in for the three node RabbitMQ 3.7 cluster of ../cluster, for
+# running the clients, their benchmarks and failure experiments on one machine
+# without Docker. It speaks the part of AMQP 0-9-1 the scripts here use: queue
+# declare/bind/purge/delete, the default, direct, fanout and x-consistent-hash
+# exchanges, prefetch, acks, nacks and redelivery, publisher confirms and
+# consumer cancel notifications. Frames are decoded with pika's own codec,
+# message properties are passed through to consumers without being decoded.
+#
+# Every node is a listening port. All nodes share one set of queues, as if the
+# ha policy of declare-hashing-infra.py mirrored every queue to every node, but
+# each queue has a master node, picked like queue_master_locator min-masters of
+# rabbitmq.config, which is what the management API reports.
+#
+# The x-consistent-hash exchange routes like the 3.7 plugin: a binding with key
+# "10" adds 10 random points in [0, 2^27) to the exchange's ring and a message
+# goes to the queue owning the first point >= phash2([routing key]) (hash_ring.py).
+# As it routes with hash_ring.py it can not show that hash_ring.py matches a real
+# node, only hash-vectors.json captured from one can.
+# With a seed the rings are the same on every run.
+#
+# Failures:
+#   kill_node     drops the node's connections, their unacked messages are
+#                 requeued, and promotes a new master for the node's queues
+#   start_node    accepts connections again, masters do not move back
+#   pause_node    a partition: the node's connections stay open but nothing
+#                 flows either way, its queues fail over as with a kill. Only
+#                 heartbeats let the clients notice, pika checks for them every
+#                 heartbeat + 5 seconds so that takes 7 to 14s with a heartbeat
+#                 of 2s. New connections to it are dropped at once.
+#   resume_node   heals the partition, held back frames are delivered
+#   set_latency   delays every batch of frames a node reads
+# When a queue's master changes, consumers of the queue that asked for
+# x-cancel-on-ha-failover get a Basic.Cancel and the messages delivered but not
+# acked on the queue are requeued as redelivered, like a promoted mirror does.
+
+FRAME_MAX = 131072
+FRAME_HEADER = struct.Struct(">BHI")
+FRAME_END = b"\xce"
+METHOD_FRAME = 1
+HEADER_FRAME = 2
+BODY_FRAME = 3
+HEARTBEAT_FRAME = 8
+
+# a message keeps the encoded content header it was published with, class id,
+# weight, body size and properties, which is what every delivery sends
+class Message:
+    __slots__ = ('exchange', 'routing_key', 'header', 'body', 'redelivered')
+
+    def __init__(self, exchange, routing_key, header, body):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.header = header
+        self.body = body
+        self.redelivered = False
+
+
+class Queue:
+
+    def __init__(self, name, durable, exclusive, auto_delete, arguments, node):
+        self.name = name
+        self.durable = durable
+        self.exclusive = exclusive
+        self.auto_delete = auto_delete
+        self.arguments = arguments or dict()
+        self.node = node
+        self.messages = collections.deque()
+        self.consumers = list()
+        self.next_consumer = 0
+        self.unacked = 0
+        self.published = 0
+        self.delivered = 0
+        self.acked = 0
+        self.redelivered = 0
+
+    def requeue(self, messages):
+        for message in reversed(messages):
+            message.redelivered = True
+            self.messages.appendleft(message)
+        self.redelivered += len(messages)
+
+
+class Exchange:
+
+    def __init__(self, name, exchange_type, durable=True, rng=None):
+        self.name = name
+        self.exchange_type = exchange_type
+        self.durable = durable
+        self.rng = rng or random.Random()
+        self.bindings = list()
+        # x-consistent-hash: the points of every binding and all of them in one
+        # set, the ring built from them on the first route after a change and
+        # the queue of every routing key seen since the ring changed
+        self.points = dict()
+        self.taken = set()
+        self.ring = None
+        self.ring_stale = False
+        self.routes = dict()
+
+    def bind(self, queue_name, routing_key):
+        binding = (queue_name, routing_key)
+        if binding in self.bindings:
+            return
+        self.bindings.append(binding)
+        if self.exchange_type == 'x-consistent-hash':
+            points = list()
+            while len(points) < int(routing_key or 0):
+                point = self.rng.randrange(PHASH2_RANGE)
+                if point not in self.taken:
+                    self.taken.add(point)
+                    points.append(point)
+            self.points[binding] = points
+            self.ring_changed()
+
+    def unbind(self, queue_name, routing_key=None):
+        for binding in [b for b in self.bindings if b[0] == queue_name and routing_key in (None, b[1])]:
+            self.bindings.remove(binding)
+            self.taken.difference_update(self.points.pop(binding, ()))
+        self.ring_changed()
+
+    # declaring many partitions binds many times before anything is routed, so
+    # the ring is only built when it is next used
+    def ring_changed(self):
+        self.routes.clear()
+        self.ring = None
+        self.ring_stale = True
+
+    def build_ring(self):
+        points = [(point, queue) for (queue, _), queue_points in self.points.items() for point in queue_points]
+        self.ring = HashRing(points) if points else None
+        self.ring_stale = False
+
+    def ring_points(self):
+        return sorted((point, queue) for (queue, _), queue_points in self.points.items() for point in queue_points)
+
+    def route(self, routing_key):
+        if self.exchange_type == 'fanout':
+            return [queue for queue, _ in self.bindings]
+        if self.exchange_type == 'x-consistent-hash':
+            queues = self.routes.get(routing_key)
+            if queues is None:
+                if self.ring_stale:
+                    self.build_ring()
+                queues = [self.ring.queue_for(routing_key)] if self.ring is not None else []
+                if len(self.routes) < 100000:
+                    self.routes[routing_key] = queues
+            return queues
+        return [queue for queue, key in self.bindings if key == routing_key]
+
+
+class Consumer:
+
+    def __init__(self, channel, queue, tag, no_ack, arguments):
+        self.channel = channel
+        self.queue = queue
+        self.tag = tag
+        self.no_ack = no_ack
+        self.cancel_on_failover = bool((arguments or dict()).get('x-cancel-on-ha-failover'))
+
+
+class Channel:
+
+    def __init__(self, connection, number):
+        self.connection = connection
+        self.number = number
+        self.prefetch = 0
+        self.next_delivery_tag = 1
+        # delivery tag -> (queue, message)
+        self.unacked = collections.OrderedDict()
+        self.consumers = dict()
+        self.confirm_mode = False
+        self.publish_seq = 0
+        self.confirm_pending = 0
+        self.pending_publish = None
+        self.pending_header = None
+        self.pending_size = 0
+        self.pending_body = None
+
+    def has_capacity(self):
+        return self.prefetch == 0 or len(self.unacked) < self.prefetch
+
+
+class Node:
+
+    def __init__(self, name, host, port):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.server = None
+        self.connections = set()
+        self.latency_ms = 0
+        self.up = False
+        self.reachable = asyncio.Event()
+        self.reachable.set()
+
+    def address(self):
+        return f"{self.host}:{self.port}"
+
+
+class StandInBroker:
+
+    def __init__(self, node_count=3, host='127.0.0.1', base_port=5672, heartbeat=0, seed=None):
+        self.nodes = collections.OrderedDict()
+        for i in range(1, node_count + 1):
+            name = f"rabbitmq{i}"
+            self.nodes[name] = Node(name, host, base_port + i - 1)
+        self.heartbeat = heartbeat
+        self.rng = random.Random(seed)
+        self.queues = dict()
+        self.exchanges = dict()
+        for name, exchange_type in [('', 'direct'), ('amq.direct', 'direct'), ('amq.fanout', 'fanout')]:
+            self.exchanges[name] = Exchange(name, exchange_type, rng=self.rng)
+        self.published = 0
+        self.delivered = 0
+        self.acked = 0
+        self.redelivered = 0
+        self.failovers = 0
+        self.handlers = set()
+
+    async def start(self):
+        for node in self.nodes.values():
+            await self.start_node(node.name)
+        return self
+
+    # closes every node without failing queues over
+    async def stop(self):
+        for node in self.nodes.values():
+            if node.up:
+                node.up = False
+                node.server.close()
+                for connection in list(node.connections):
+                    connection.abort()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+
+    def addresses(self):
+        return {node.name: node.address() for node in self.nodes.values()}
+
+    # the RABBITMQ_NODES value that points the node resolver at this broker
+    def node_list(self):
+        return ",".join(f"{name}={address}" for name, address in self.addresses().items())
+
+    # --- failure injection ---
+
+    async def start_node(self, name):
+        node = self.nodes[name]
+        if node.up:
+            return
+        node.server = await asyncio.start_server(lambda r, w: self.on_client(node, r, w),
+                                                 node.host, node.port, reuse_address=True)
+        node.up = True
+        node.reachable.set()
+
+    async def kill_node(self, name):
+        node = self.nodes[name]
+        if not node.up:
+            return
+        node.up = False
+        node.server.close()
+        for connection in list(node.connections):
+            connection.abort()
+        await node.server.wait_closed()
+        self.fail_over(node)
+        node.reachable.set()
+
+    async def restart_node(self, name, down_sec=0):
+        await self.kill_node(name)
+        if down_sec > 0:
+            await asyncio.sleep(down_sec)
+        await self.start_node(name)
+
+    def pause_node(self, name):
+        node = self.nodes[name]
+        if node.up and node.reachable.is_set():
+            node.reachable.clear()
+            self.fail_over(node)
+
+    def resume_node(self, name):
+        node = self.nodes[name]
+        if not node.reachable.is_set():
+            node.reachable.set()
+            for connection in list(node.connections):
+                connection.schedule_flush()
+            self.dispatch_all()
+
+    def set_latency(self, name, latency_ms):
+        self.nodes[name].latency_ms = latency_ms
+
+    def live_nodes(self):
+        return [node for node in self.nodes.values() if node.up and node.reachable.is_set()]
+
+    # queue_master_locator min-masters, ties go to the earlier node
+    def pick_master(self, preferred=None):
+        live = self.live_nodes()
+        if not live:
+            return preferred
+        masters = collections.Counter(queue.node for queue in self.queues.values())
+        return min(live, key=lambda node: masters[node.name]).name
+
+    def fail_over(self, node):
+        for queue in list(self.queues.values()):
+            if queue.node == node.name:
+                self.move_queue(queue.name, self.pick_master(node.name))
+
+    # the queue's master moves to another node, as when a mirror is promoted
+    def move_queue(self, queue_name, node_name):
+        queue = self.queues[queue_name]
+        if node_name is None or queue.node == node_name:
+            return
+        queue.node = node_name
+        self.failovers += 1
+        for consumer in list(queue.consumers):
+            if consumer.cancel_on_failover:
+                consumer.channel.connection.cancel_consumer(consumer)
+        for connection in self.connections():
+            for channel in connection.channels.values():
+                connection.requeue_unacked(channel, queue)
+        self.dispatch(queue)
+
+    def connections(self):
+        return [connection for node in self.nodes.values() for connection in node.connections]
+
+    async def on_client(self, node, reader, writer):
+        if not node.reachable.is_set():
+            writer.transport.abort()
+            return
+        connection = ClientConnection(self, node, reader, writer)
+        node.connections.add(connection)
+        handler = asyncio.current_task()
+        self.handlers.add(handler)
+        try:
+            await connection.run()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            node.connections.discard(connection)
+            self.handlers.discard(handler)
+            connection.cleanup()
+
+    # --- queues and routing, shared by all nodes ---
+
+    def declare_queue(self, name, durable, exclusive, auto_delete, arguments, node):
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = Queue(name, durable, exclusive, auto_delete, arguments, self.pick_master(node))
+            self.queues[name] = queue
+        return queue
+
+    def delete_queue(self, name):
+        queue = self.queues.pop(name, None)
+        if queue is None:
+            return 0
+        for exchange in self.exchanges.values():
+            if any(binding[0] == name for binding in exchange.bindings):
+                exchange.unbind(name)
+        for consumer in list(queue.consumers):
+            consumer.channel.connection.cancel_consumer(consumer)
+        return len(queue.messages)
+
+    def route(self, exchange_name, routing_key):
+        if exchange_name == '':
+            return [routing_key] if routing_key in self.queues else []
+        exchange = self.exchanges.get(exchange_name)
+        if exchange is None:
+            return None
+        return exchange.route(routing_key)
+
+    def enqueue(self, queue_names, message):
+        for name in queue_names:
+            queue = self.queues.get(name)
+            if queue is not None:
+                queue.messages.append(message)
+                queue.published += 1
+                if queue.consumers:
+                    self.dispatch(queue)
+        self.published += 1
+
+    # round robin over the consumers with prefetch capacity left, none of a
+    # partitioned node
+    def dispatch(self, queue):
+        consumers = queue.consumers
+        while queue.messages and consumers:
+            consumer = None
+            for _ in range(len(consumers)):
+                candidate = consumers[queue.next_consumer % len(consumers)]
+                queue.next_consumer += 1
+                if ((candidate.no_ack or candidate.channel.has_capacity())
+                        and candidate.channel.connection.node.reachable.is_set()):
+                    consumer = candidate
+                    break
+            if consumer is None:
+                return
+            consumer.channel.connection.deliver(consumer, queue, queue.messages.popleft())
+
+    def dispatch_channel(self, channel):
+        for queue in set(consumer.queue for consumer in channel.consumers.values()):
+            self.dispatch(queue)
+
+    def dispatch_all(self):
+        for queue in list(self.queues.values()):
+            self.dispatch(queue)
+
+    def stats(self):
+        return {"published": self.published, "delivered": self.delivered, "acked": self.acked,
+                "redelivered": self.redelivered, "failovers": self.failovers,
+                "messages": sum(len(queue.messages) for queue in self.queues.values()),
+                "unacked": sum(queue.unacked for queue in self.queues.values()),
+                "connections": len(self.connections())}
+
+
+class ClientConnection:
+
+    def __init__(self, broker, node, reader, writer):
+        self.broker = broker
+        self.node = node
+        self.reader = reader
+        self.writer = writer
+        self.channels = dict()
+        self.out = list()
+        self.flush_scheduled = False
+        self.closed = False
+        self.heartbeat = 0
+        self.heartbeat_task = None
+        self.next_tag = 1
+
+    def abort(self):
+        self.closed = True
+        self.writer.transport.abort()
+
+    # frames for this connection are also produced while other connections are
+    # served (deliveries, cancels), they are written once the current callback is done
+    def schedule_flush(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def send_method(self, channel_number, method):
+        self.out.append(pika_frame.Method(channel_number, method).marshal())
+        self.schedule_flush()
+
+    def send_content(self, channel_number, method, message):
+        out = self.out
+        out.append(pika_frame.Method(channel_number, method).marshal())
+        out.append(FRAME_HEADER.pack(HEADER_FRAME, channel_number, len(message.header)))
+        out.append(message.header)
+        out.append(FRAME_END)
+        body = message.body
+        chunk = FRAME_MAX - 8
+        for offset in range(0, len(body), chunk):
+            fragment = body[offset:offset + chunk]
+            out.append(FRAME_HEADER.pack(BODY_FRAME, channel_number, len(fragment)))
+            out.append(fragment)
+            out.append(FRAME_END)
+        self.schedule_flush()
+
+    def flush(self):
+        self.flush_scheduled = False
+        for channel in self.channels.values():
+            # the confirms of everything published since the last flush go out as one multiple ack
+            if channel.confirm_pending > 0:
+                self.out.append(pika_frame.Method(channel.number, spec.Basic.Ack(
+                    delivery_tag=channel.publish_seq, multiple=channel.confirm_pending > 1)).marshal())
+                channel.confirm_pending = 0
+        # a partitioned node holds its frames back until it is reachable again
+        if self.out and not self.closed and self.node.reachable.is_set():
+            self.writer.write(b''.join(self.out))
+            self.out.clear()
+
+    async def send_heartbeats(self):
+        while not self.closed:
+            await asyncio.sleep(self.heartbeat / 2)
+            if self.node.reachable.is_set():
+                self.out.append(pika_frame.Heartbeat().marshal())
+                self.schedule_flush()
+
+    async def run(self):
+        header = await self.reader.readexactly(8)
+        if header[:4] != b'AMQP':
+            return
+        self.send_method(0, spec.Connection.Start(server_properties={
+            'product': 'RabbitMQ stand-in',
+            'capabilities': {'publisher_confirms': True, 'basic.nack': True,
+                             'consumer_cancel_notify': True, 'exchange_exchange_bindings': True,
+                             'authentication_failure_close': True, 'connection.blocked': True}},
+            mechanisms='PLAIN', locales='en_US'))
+        self.flush()
+
+        buffer = b''
+        try:
+            while not self.closed:
+                data = await self.reader.read(65536)
+                if not data:
+                    return
+                await self.node.reachable.wait()
+                if self.node.latency_ms > 0:
+                    await asyncio.sleep(self.node.latency_ms / 1000)
+                buffer = self.on_data(buffer + data)
+                self.flush()
+                await self.writer.drain()
+        finally:
+            if self.heartbeat_task is not None:
+                self.heartbeat_task.cancel()
+
+    # handles every complete frame and returns the incomplete rest
+    def on_data(self, buffer):
+        offset = 0
+        end_of_data = len(buffer)
+        while end_of_data - offset >= 7 and not self.closed:
+            frame_type, channel_number, size = FRAME_HEADER.unpack_from(buffer, offset)
+            end = offset + 7 + size
+            if end >= end_of_data:
+                break
+            if frame_type == BODY_FRAME:
+                self.on_body(channel_number, buffer[offset + 7:end])
+            elif frame_type == HEADER_FRAME:
+                self.on_header(channel_number, buffer[offset + 7:end])
+            elif frame_type == METHOD_FRAME:
+                frame = pika_frame.decode_frame(buffer[offset:end + 1])[1]
+                if channel_number == 0:
+                    self.on_connection_method(frame.method)
+                else:
+                    self.on_channel_method(channel_number, frame.method)
+            offset = end + 1
+        return buffer[offset:]
+
+    def cleanup(self):
+        self.closed = True
+        for channel in list(self.channels.values()):
+            self.close_channel(channel)
+        self.channels.clear()
+        self.broker.dispatch_all()
+
+    def close_channel(self, channel):
+        for consumer in channel.consumers.values():
+            if consumer in consumer.queue.consumers:
+                consumer.queue.consumers.remove(consumer)
+        channel.consumers.clear()
+        self.requeue_unacked(channel)
+
+    # messages delivered on the channel and not acked yet go back to their
+    # queues, all of them or those of one queue
+    def requeue_unacked(self, channel, queue=None):
+        tags = [tag for tag, (q, _) in channel.unacked.items() if queue is None or q is queue]
+        self.requeue_tags(channel, tags)
+
+    def requeue_tags(self, channel, tags):
+        by_queue = collections.OrderedDict()
+        for tag in tags:
+            queue, message = channel.unacked.pop(tag)
+            queue.unacked -= 1
+            by_queue.setdefault(queue, list()).append(message)
+        for queue, messages in by_queue.items():
+            if queue.name in self.broker.queues:
+                queue.requeue(messages)
+                self.broker.redelivered += len(messages)
+
+    def cancel_consumer(self, consumer):
+        channel = consumer.channel
+        if consumer in consumer.queue.consumers:
+            consumer.queue.consumers.remove(consumer)
+        channel.consumers.pop(consumer.tag, None)
+        if not self.closed:
+            self.send_method(channel.number, spec.Basic.Cancel(consumer_tag=consumer.tag, nowait=True))
+
+    def channel_error(self, channel, code, text, method):
+        self.send_method(channel.number, spec.Channel.Close(reply_code=code, reply_text=text,
+                                                            class_id=method.INDEX >> 16,
+                                                            method_id=method.INDEX & 0xffff))
+        self.close_channel(channel)
+        del self.channels[channel.number]
+        self.broker.dispatch_all()
+
+    def deliver(self, consumer, queue, message):
+        channel = consumer.channel
+        tag = channel.next_delivery_tag
+        channel.next_delivery_tag += 1
+        if not consumer.no_ack:
+            channel.unacked[tag] = (queue, message)
+            queue.unacked += 1
+        self.send_content(channel.number,
+                          spec.Basic.Deliver(consumer_tag=consumer.tag, delivery_tag=tag,
+                                             redelivered=message.redelivered,
+                                             exchange=message.exchange, routing_key=message.routing_key),
+                          message)
+        queue.delivered += 1
+        self.broker.delivered += 1
+
+    def on_header(self, channel_number, payload):
+        channel = self.channels.get(channel_number)
+        if channel is None or channel.pending_publish is None:
+            return
+        channel.pending_header = payload
+        channel.pending_size = struct.unpack_from(">Q", payload, 4)[0]
+        channel.pending_body = list()
+        if channel.pending_size == 0:
+            self.complete_publish(channel)
+
+    def on_body(self, channel_number, payload):
+        channel = self.channels.get(channel_number)
+        if channel is None or channel.pending_header is None:
+            return
+        channel.pending_body.append(payload)
+        channel.pending_size -= len(payload)
+        if channel.pending_size <= 0:
+            self.complete_publish(channel)
+
+    def on_connection_method(self, method):
+        if isinstance(method, spec.Connection.StartOk):
+            self.send_method(0, spec.Connection.Tune(channel_max=2047, frame_max=FRAME_MAX,
+                                                     heartbeat=self.broker.heartbeat))
+        elif isinstance(method, spec.Connection.TuneOk):
+            self.heartbeat = method.heartbeat
+            if self.heartbeat > 0:
+                self.heartbeat_task = asyncio.ensure_future(self.send_heartbeats())
+        elif isinstance(method, spec.Connection.Open):
+            self.send_method(0, spec.Connection.OpenOk())
+        elif isinstance(method, spec.Connection.Close):
+            self.send_method(0, spec.Connection.CloseOk())
+            self.flush()
+            self.closed = True
+            self.writer.close()
+        elif isinstance(method, spec.Connection.CloseOk):
+            self.closed = True
+            self.writer.close()
+
+    def on_channel_method(self, number, method):
+        if isinstance(method, spec.Channel.Open):
+            self.channels[number] = Channel(self, number)
+            self.send_method(number, spec.Channel.OpenOk())
+            return
+
+        channel = self.channels.get(number)
+        if channel is None:
+            return
+
+        if isinstance(method, spec.Basic.Publish):
+            channel.pending_publish = method
+        elif isinstance(method, spec.Basic.Ack):
+            self.on_ack(channel, method.delivery_tag, method.multiple)
+        elif isinstance(method, spec.Basic.Nack):
+            self.on_reject(channel, method.delivery_tag, method.multiple, method.requeue)
+        elif isinstance(method, spec.Basic.Reject):
+            self.on_reject(channel, method.delivery_tag, False, method.requeue)
+        elif isinstance(method, spec.Basic.Qos):
+            channel.prefetch = method.prefetch_count
+            self.send_method(number, spec.Basic.QosOk())
+            self.broker.dispatch_channel(channel)
+        elif isinstance(method, spec.Basic.Consume):
+            self.on_consume(channel, method)
+        elif isinstance(method, spec.Basic.Cancel):
+            consumer = channel.consumers.pop(method.consumer_tag, None)
+            if consumer is not None and consumer in consumer.queue.consumers:
+                consumer.queue.consumers.remove(consumer)
+            if not method.nowait:
+                self.send_method(number, spec.Basic.CancelOk(consumer_tag=method.consumer_tag))
+        elif isinstance(method, spec.Basic.CancelOk):
+            pass
+        elif isinstance(method, spec.Basic.Get):
+            self.on_get(channel, method)
+        elif isinstance(method, spec.Confirm.Select):
+            channel.confirm_mode = True
+            if not method.nowait:
+                self.send_method(number, spec.Confirm.SelectOk())
+        elif isinstance(method, spec.Queue.Declare):
+            self.on_queue_declare(channel, method)
+        elif isinstance(method, spec.Queue.Bind):
+            exchange = self.broker.exchanges.get(method.exchange)
+            if exchange is None or method.queue not in self.broker.queues:
+                self.channel_error(channel, 404, f"NOT_FOUND - no exchange '{method.exchange}' or queue '{method.queue}'", method)
+                return
+            exchange.bind(method.queue, method.routing_key)
+            if not method.nowait:
+                self.send_method(number, spec.Queue.BindOk())
+        elif isinstance(method, spec.Queue.Unbind):
+            exchange = self.broker.exchanges.get(method.exchange)
+            if exchange is not None:
+                exchange.unbind(method.queue, method.routing_key)
+            self.send_method(number, spec.Queue.UnbindOk())
+        elif isinstance(method, spec.Queue.Purge):
+            queue = self.broker.queues.get(method.queue)
+            if queue is None:
+                self.channel_error(channel, 404, f"NOT_FOUND - no queue '{method.queue}'", method)
+                return
+            count = len(queue.messages)
+            queue.messages.clear()
+            if not method.nowait:
+                self.send_method(number, spec.Queue.PurgeOk(message_count=count))
+        elif isinstance(method, spec.Queue.Delete):
+            count = self.broker.delete_queue(method.queue)
+            if not method.nowait:
+                self.send_method(number, spec.Queue.DeleteOk(message_count=count))
+        elif isinstance(method, spec.Exchange.Declare):
+            self.on_exchange_declare(channel, method)
+        elif isinstance(method, spec.Exchange.Delete):
+            self.broker.exchanges.pop(method.exchange, None)
+            if not method.nowait:
+                self.send_method(number, spec.Exchange.DeleteOk())
+        elif isinstance(method, spec.Channel.Flow):
+            self.send_method(number, spec.Channel.FlowOk(active=method.active))
+        elif isinstance(method, spec.Channel.Close):
+            self.close_channel(channel)
+            del self.channels[number]
+            self.send_method(number, spec.Channel.CloseOk())
+            self.broker.dispatch_all()
+        elif isinstance(method, spec.Channel.CloseOk):
+            self.channels.pop(number, None)
+        else:
+            self.channel_error(channel, 540, f"NOT_IMPLEMENTED - {method.NAME} is not supported by the stand-in", method)
+
+    def on_exchange_declare(self, channel, method):
+        exchange = self.broker.exchanges.get(method.exchange)
+        if exchange is None:
+            if method.passive:
+                self.channel_error(channel, 404, f"NOT_FOUND - no exchange '{method.exchange}'", method)
+                return
+            if method.type not in ['direct', 'fanout', 'x-consistent-hash']:
+                self.channel_error(channel, 503, f"COMMAND_INVALID - unknown exchange type '{method.type}'", method)
+                return
+            self.broker.exchanges[method.exchange] = Exchange(method.exchange, method.type, method.durable, self.broker.rng)
+        elif not method.passive and exchange.exchange_type != method.type:
+            self.channel_error(channel, 406, f"PRECONDITION_FAILED - inequivalent arg 'type' for exchange '{method.exchange}'", method)
+            return
+        if not method.nowait:
+            self.send_method(channel.number, spec.Exchange.DeclareOk())
+
+    def on_queue_declare(self, channel, method):
+        name = method.queue or f"amq.gen-{os.urandom(11).hex()}"
+        queue = self.broker.queues.get(name)
+        if queue is None:
+            if method.passive:
+                self.channel_error(channel, 404, f"NOT_FOUND - no queue '{name}'", method)
+                return
+            queue = self.broker.declare_queue(name, method.durable, method.exclusive, method.auto_delete,
+                                              method.arguments, self.node.name)
+        elif not method.passive and queue.arguments != (method.arguments or dict()):
+            self.channel_error(channel, 406, f"PRECONDITION_FAILED - inequivalent arguments for queue '{name}'", method)
+            return
+        if not method.nowait:
+            self.send_method(channel.number, spec.Queue.DeclareOk(queue=name,
+                                                                  message_count=len(queue.messages),
+                                                                  consumer_count=len(queue.consumers)))
+
+    def on_consume(self, channel, method):
+        queue = self.broker.queues.get(method.queue)
+        if queue is None:
+            self.channel_error(channel, 404, f"NOT_FOUND - no queue '{method.queue}'", method)
+            return
+        tag = method.consumer_tag
+        if not tag:
+            tag = f"amq.ctag-{self.node.name}-{self.next_tag}"
+            self.next_tag += 1
+        consumer = Consumer(channel, queue, tag, method.no_ack, method.arguments)
+        channel.consumers[tag] = consumer
+        queue.consumers.append(consumer)
+        if not method.nowait:
+            self.send_method(channel.number, spec.Basic.ConsumeOk(consumer_tag=tag))
+        self.broker.dispatch(queue)
+
+    def on_get(self, channel, method):
+        queue = self.broker.queues.get(method.queue)
+        if queue is None:
+            self.channel_error(channel, 404, f"NOT_FOUND - no queue '{method.queue}'", method)
+            return
+        if not queue.messages:
+            self.send_method(channel.number, spec.Basic.GetEmpty())
+            return
+        message = queue.messages.popleft()
+        tag = channel.next_delivery_tag
+        channel.next_delivery_tag += 1
+        if not method.no_ack:
+            channel.unacked[tag] = (queue, message)
+            queue.unacked += 1
+        self.send_content(channel.number,
+                          spec.Basic.GetOk(delivery_tag=tag, redelivered=message.redelivered,
+                                           exchange=message.exchange, routing_key=message.routing_key,
+                                           message_count=len(queue.messages)),
+                          message)
+        queue.delivered += 1
+        self.broker.delivered += 1
+
+    def complete_publish(self, channel):
+        method = channel.pending_publish
+        message = Message(method.exchange, method.routing_key, channel.pending_header,
+                          b''.join(channel.pending_body))
+        channel.pending_publish = None
+        channel.pending_header = None
+        channel.pending_body = None
+
+        queue_names = self.broker.route(method.exchange, method.routing_key)
+        if queue_names is None:
+            self.channel_error(channel, 404, f"NOT_FOUND - no exchange '{method.exchange}'", method)
+            return
+        if not queue_names and method.mandatory:
+            self.send_content(channel.number,
+                              spec.Basic.Return(reply_code=312, reply_text="NO_ROUTE",
+                                                exchange=method.exchange, routing_key=method.routing_key),
+                              message)
+        self.broker.enqueue(queue_names, message)
+        if channel.confirm_mode:
+            channel.publish_seq += 1
+            channel.confirm_pending += 1
+
+    def acked_tags(self, channel, delivery_tag, multiple):
+        if not multiple:
+            return [delivery_tag] if delivery_tag in channel.unacked else []
+        tags = list()
+        for tag in channel.unacked:
+            if delivery_tag != 0 and tag > delivery_tag:
+                break
+            tags.append(tag)
+        return tags
+
+    # tags the broker no longer knows, acks of messages requeued by a
+    # failover, are ignored instead of closing the channel
+    def on_ack(self, channel, delivery_tag, multiple):
+        for tag in self.acked_tags(channel, delivery_tag, multiple):
+            queue, _ = channel.unacked.pop(tag)
+            queue.unacked -= 1
+            queue.acked += 1
+            self.broker.acked += 1
+        self.broker.dispatch_channel(channel)
+
+    def on_reject(self, channel, delivery_tag, multiple, requeue):
+        tags = self.acked_tags(channel, delivery_tag, multiple)
+        if requeue:
+            self.requeue_tags(channel, tags)
+            self.broker.dispatch_all()
+        else:
+            for tag in tags:
+                queue, _ = channel.unacked.pop(tag)
+                queue.unacked -= 1
+            self.broker.dispatch_channel(channel)
@@ -0,0 +1,44 @@
+import requests
+import management_api
+from management_api import quote_name
+from hash_ring import HashRing
+
+# Failure injection for the stand-in broker, over the control endpoints
+# run-standin.py adds to its management API. host is the management API's host,
+# as for management_api.
+
+def put(host, path, body=None, timeout=30):
+    r = requests.put(management_api.url(host, f"standin/{path}"), json=body or dict(),
+                     auth=management_api.AUTH, timeout=timeout)
+    r.raise_for_status()
+
+def kill_node(host, node):
+    put(host, f"nodes/{node}/kill")
+
+def start_node(host, node):
+    put(host, f"nodes/{node}/start")
+
+# returns at once, the node comes back after down_sec
+def restart_node(host, node, down_sec=0):
+    put(host, f"nodes/{node}/restart", {"down_sec": down_sec})
+
+def pause_node(host, node):
+    put(host, f"nodes/{node}/pause")
+
+def resume_node(host, node):
+    put(host, f"nodes/{node}/resume")
+
+def set_latency(host, node, latency_ms):
+    put(host, f"nodes/{node}/latency", {"latency_ms": latency_ms})
+
+def move_queue(host, queue, node, vhost="/"):
+    put(host, f"queues/{quote_name(vhost)}/{quote_name(queue)}/move", {"node": node})
+
+def get_stats(host):
+    return management_api.get(host, "standin/stats")
+
+# the consistent hash exchange's actual ring, what HashRing.fetch reads from a
+# real node with rabbitmqctl
+def fetch_ring(host, exchange, vhost="/"):
+    points = management_api.get(host, f"standin/rings/{quote_name(vhost)}/{quote_name(exchange)}")
+    return HashRing([(point["point"], point["queue"]) for point in points])
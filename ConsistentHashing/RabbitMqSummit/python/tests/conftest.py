@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The client modules and the stand-in broker are scripts with their modules next
+# to them rather than a package, so the tests import them the way the scripts do.
+# From the python directory:
+#   python -m pytest -q tests
+HERE = os.path.dirname(os.path.abspath(__file__))
+for directory in ["client", "standin"]:
+    sys.path.insert(0, os.path.join(HERE, "..", directory))
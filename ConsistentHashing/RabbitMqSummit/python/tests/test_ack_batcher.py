@@ -0,0 +1,70 @@
+import time
+from ack_batcher import AckBatcher
+
+# records the acks and nacks the consumer would send on its input channel
+class FakeChannel:
+
+    def __init__(self):
+        self.is_open = True
+        self.calls = list()
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.calls.append(("ack", delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.calls.append(("nack", delivery_tag, multiple))
+
+
+def test_unbatched_acks_go_out_one_by_one():
+    channel = FakeChannel()
+    acks = AckBatcher(channel)
+    acks.ack(1)
+    acks.ack(2)
+    assert channel.calls == [("ack", 1, False), ("ack", 2, False)]
+    assert acks.ack_frames == 2
+
+def test_a_full_batch_is_one_multiple_ack():
+    channel = FakeChannel()
+    acks = AckBatcher(channel, batch_size=3)
+    for tag in range(1, 8):
+        acks.ack(tag)
+    assert channel.calls == [("ack", 3, True), ("ack", 6, True)]
+    assert acks.pending == 1
+    acks.flush()
+    assert channel.calls[-1] == ("ack", 7, True)
+    assert acks.acked == 7
+
+def test_ack_multiple_counts_toward_the_batch():
+    channel = FakeChannel()
+    acks = AckBatcher(channel, batch_size=10)
+    acks.ack_multiple(6, 6)
+    acks.ack_multiple(12, 6)
+    assert channel.calls == [("ack", 12, True)]
+    assert acks.acked == 12
+
+def test_a_partial_batch_goes_out_once_the_interval_passed():
+    channel = FakeChannel()
+    acks = AckBatcher(channel, batch_size=100, interval_ms=20)
+    acks.ack(1)
+    acks.tick()
+    assert channel.calls == []
+    time.sleep(0.03)
+    acks.tick()
+    assert channel.calls == [("ack", 1, True)]
+
+def test_acks_of_a_closed_channel_are_discarded():
+    channel = FakeChannel()
+    acks = AckBatcher(channel, batch_size=10)
+    acks.ack(1)
+    acks.ack(2)
+    channel.is_open = False
+    acks.flush()
+    assert channel.calls == []
+    assert acks.discarded == 2
+
+    unbatched = AckBatcher(channel)
+    unbatched.ack(3)
+    unbatched.ack_multiple(5, 5)
+    assert channel.calls == []
+    assert unbatched.discarded == 6
+    assert unbatched.acked == 0
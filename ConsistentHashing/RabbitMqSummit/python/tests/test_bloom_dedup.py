@@ -0,0 +1,34 @@
+from bloom_dedup import RotatingBloomFilter
+
+def test_bloom_filter_finds_every_id_seen():
+    bloom = RotatingBloomFilter(window_sec=100, capacity=10000, fp_rate=0.001)
+    ids = [f"id-{i}" for i in range(2000)]
+    assert not any(bloom.seen(correlation_id, now=0) for correlation_id in ids)
+    assert all(bloom.seen(correlation_id, now=1) for correlation_id in ids)
+    # stays within the slice capacity (2500), so no early rotation
+    false_positives = sum(bloom.seen(f"other-{i}", now=1) for i in range(500))
+    assert false_positives < 5
+    assert bloom.early_rotations == 0
+
+def test_bloom_filter_forgets_after_the_window():
+    bloom = RotatingBloomFilter(window_sec=100, capacity=1000, slices=4)
+    bloom.seen("a", now=0)
+    for now in [25, 50, 75, 100]:
+        assert bloom.seen("a", now=now)
+    # the filter of "a" is wiped once every other filter has had its turn
+    assert not bloom.seen("a", now=125)
+    assert bloom.rotations == 5
+
+def test_bloom_filter_rotates_early_when_a_slice_is_full():
+    bloom = RotatingBloomFilter(window_sec=100, capacity=400, slices=4)
+    for i in range(250):
+        bloom.seen(f"id-{i}", now=0)
+    assert bloom.early_rotations == 2
+    assert bloom.seen("id-249", now=0)
+
+def test_bloom_filter_contains_does_not_record():
+    bloom = RotatingBloomFilter(window_sec=100, capacity=1000)
+    assert not bloom.contains("a", now=0)
+    assert not bloom.contains("a", now=1)
+    bloom.add("a", now=1)
+    assert bloom.contains("a", now=2)
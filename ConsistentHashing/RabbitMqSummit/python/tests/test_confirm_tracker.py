@@ -0,0 +1,78 @@
+from confirm_tracker import ConfirmTracker
+
+def publish(tracker, count):
+    return [tracker.published() for _ in range(count)]
+
+def test_tags_start_at_one_and_restart_on_reset():
+    tracker = ConfirmTracker()
+    assert publish(tracker, 3) == [1, 2, 3]
+    tracker.reset()
+    assert tracker.published() == 1
+    assert tracker.outstanding() == 1
+
+def test_single_acks_in_order():
+    tracker = ConfirmTracker()
+    publish(tracker, 3)
+    assert tracker.confirm(1, False) == 1
+    assert tracker.confirm(2, False) == 1
+    assert tracker.outstanding() == 1
+    assert tracker.watermark == 2
+
+def test_single_acks_out_of_order_advance_the_watermark_once_filled():
+    tracker = ConfirmTracker()
+    publish(tracker, 5)
+    assert tracker.confirm(3, False) == 1
+    assert tracker.confirm(5, False) == 1
+    assert tracker.watermark == 0
+    assert not tracker.is_outstanding(3)
+    assert tracker.is_outstanding(2)
+    assert tracker.outstanding() == 3
+
+    assert tracker.confirm(1, False) == 1
+    assert tracker.confirm(2, False) == 1
+    assert tracker.watermark == 3
+    assert tracker.confirm(4, False) == 1
+    assert tracker.watermark == 5
+    assert tracker.outstanding() == 0
+    assert not tracker.confirmed_ahead
+
+def test_repeated_and_unknown_tags_confirm_nothing():
+    tracker = ConfirmTracker()
+    publish(tracker, 2)
+    assert tracker.confirm(1, False) == 1
+    assert tracker.confirm(1, False) == 0
+    assert tracker.confirm(7, False) == 0
+    assert tracker.confirm(0, False) == 0
+    assert tracker.outstanding() == 1
+
+def test_multiple_skips_tags_already_confirmed_ahead():
+    tracker = ConfirmTracker()
+    publish(tracker, 10)
+    tracker.confirm(4, False)
+    tracker.confirm(9, False)
+    assert tracker.confirm(6, True) == 5
+    assert tracker.watermark == 6
+    assert tracker.confirmed_ahead == {9}
+    assert tracker.confirm(10, True) == 3
+    assert tracker.outstanding() == 0
+    assert not tracker.confirmed_ahead
+
+def test_multiple_walks_the_range_when_it_is_smaller_than_the_set():
+    tracker = ConfirmTracker()
+    publish(tracker, 100)
+    for tag in range(10, 101, 2):
+        tracker.confirm(tag, False)
+    assert tracker.confirm(3, True) == 3
+    assert tracker.watermark == 3
+    assert tracker.confirm(99, True) == 99 - 3 - len(range(10, 99, 2))
+    assert tracker.watermark == 100
+    assert tracker.outstanding() == 0
+
+def test_multiple_with_tag_zero_or_beyond_the_last_confirms_everything():
+    tracker = ConfirmTracker()
+    publish(tracker, 4)
+    assert tracker.confirm(0, True) == 4
+    publish(tracker, 2)
+    assert tracker.confirm(100, True) == 2
+    assert tracker.confirm(6, True) == 0
+    assert tracker.outstanding() == 0
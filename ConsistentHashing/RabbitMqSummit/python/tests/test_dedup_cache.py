@@ -0,0 +1,48 @@
+import uuid
+from dedup_cache import DedupCache, to_key
+
+def test_to_key_packs_uuids_and_keeps_other_ids():
+    correlation_id = str(uuid.uuid4())
+    assert to_key(correlation_id) == uuid.UUID(correlation_id).bytes
+    assert to_key("abc-1") == b"abc-1"
+    assert to_key(b"raw") == b"raw"
+    assert to_key(42) == b"42"
+    assert to_key("x" * 36) == b"x" * 36
+
+def test_dedup_cache_window():
+    cache = DedupCache(window_sec=10)
+    assert not cache.seen("a", now=0)
+    assert cache.seen("a", now=5)
+    # seeing it again moves its last seen time on
+    assert cache.seen("a", now=14)
+    assert not cache.seen("a", now=25)
+    assert cache.hits == 2
+
+def test_dedup_cache_expires_a_batch_per_call():
+    cache = DedupCache(window_sec=10, expire_batch=2)
+    for i in range(5):
+        cache.seen(str(i), now=i)
+    # each call expires two, then records the new id
+    cache.seen("new", now=100)
+    assert len(cache) == 4
+    cache.seen("new", now=100)
+    assert len(cache) == 2
+    assert cache.expired == 4
+
+def test_dedup_cache_evicts_least_recently_seen():
+    cache = DedupCache(window_sec=100, max_entries=2)
+    cache.seen("a", now=0)
+    cache.seen("b", now=1)
+    cache.seen("a", now=2)
+    cache.seen("c", now=3)
+    assert cache.evicted == 1
+    assert cache.seen("a", now=4)
+    assert not cache.seen("b", now=4)
+
+def test_dedup_cache_contains_does_not_record():
+    cache = DedupCache(window_sec=10)
+    assert not cache.contains("a", now=0)
+    assert not cache.contains("a", now=1)
+    cache.add("a", now=1)
+    assert cache.contains("a", now=2)
+    assert cache.misses == 2
@@ -0,0 +1,45 @@
+import random
+from failover import Backoff, NodeHealth, FailoverStats
+
+def test_backoff_doubles_up_to_the_maximum_with_jitter():
+    backoff = Backoff(base_sec=0.1, max_sec=1.0, rng=random.Random(1))
+    delays = [backoff.next_delay() for _ in range(6)]
+    for delay, full in zip(delays, [0.1, 0.2, 0.4, 0.8, 1.0, 1.0]):
+        assert full / 2 <= delay <= full
+    backoff.reset()
+    assert backoff.next_delay() <= 0.1
+
+def test_node_health_order():
+    health = NodeHealth(failure_ttl_sec=30)
+    assert health.order(3, 1) == [1, 2, 0]
+
+    # a failed start node goes last, a node that answered goes first after it
+    health.failed(1)
+    health.succeeded(0)
+    assert health.order(3, 1) == [0, 2, 1]
+    assert health.order(3, 2) == [2, 0, 1]
+
+    # the most recent success first, the oldest failure before newer ones
+    health.succeeded(2)
+    health.failed(0)
+    assert health.order(3, 1) == [2, 1, 0]
+
+def test_node_health_forgets_failures():
+    health = NodeHealth(failure_ttl_sec=30)
+    health.failed(0)
+    health.last_failure[0] -= 31
+    assert health.order(2, 0) == [0, 1]
+
+def test_failover_stats_round_trip_and_merge():
+    stats = FailoverStats()
+    assert stats.summary() == "Failovers: 0"
+    stats.failovers = 1
+    stats.republished = 10
+    stats.reconnect_sec.append(0.5)
+    stats.resume_sec.append(0.75)
+    merged = FailoverStats().merge(FailoverStats.from_dict(stats.to_dict())).merge(stats)
+    assert merged.failovers == 2
+    assert merged.republished == 20
+    assert merged.resume_sec == [0.75, 0.75]
+    assert merged.summary() == ("Failovers: 2 republished: 20 lost: 0 reconnect max: 500ms "
+                                "resume avg: 750ms max: 750ms")
@@ -0,0 +1,103 @@
+import asyncio
+from ack_batcher import AckBatcher
+from forward_pipeline import ForwardPipeline
+
+# records the acks and nacks the consumer would send on its input channel
+class FakeChannel:
+
+    def __init__(self):
+        self.is_open = True
+        self.calls = list()
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.calls.append(("ack", delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.calls.append(("nack", delivery_tag, multiple))
+
+
+# runs the pipeline on an event loop, as the future callbacks need one
+def run_pipeline(steps, channel=None):
+    async def main():
+        pipeline = ForwardPipeline(AckBatcher(channel))
+        await steps(pipeline, asyncio.get_running_loop())
+        return pipeline
+    channel = channel or FakeChannel()
+    return asyncio.run(main()), channel
+
+def test_inputs_are_acked_in_delivery_order():
+    async def steps(pipeline, loop):
+        confirms = [loop.create_future() for _ in range(4)]
+        for tag, confirmed in enumerate(confirms, 1):
+            pipeline.published(tag, confirmed)
+        # the later forwards are confirmed first, nothing can be acked yet
+        confirms[3].set_result(True)
+        confirms[1].set_result(True)
+        await asyncio.sleep(0)
+        assert pipeline.acks.channel.calls == []
+        confirms[0].set_result(True)
+        await asyncio.sleep(0)
+        assert pipeline.acks.channel.calls == [("ack", 2, True)]
+        confirms[2].set_result(True)
+        await asyncio.sleep(0)
+
+    pipeline, channel = run_pipeline(steps)
+    assert channel.calls == [("ack", 2, True), ("ack", 4, True)]
+    assert pipeline.forwarded == 4
+    assert pipeline.in_flight() == 0
+
+def test_a_nacked_forward_requeues_its_input_alone():
+    async def steps(pipeline, loop):
+        confirms = [loop.create_future() for _ in range(3)]
+        for tag, confirmed in enumerate(confirms, 1):
+            pipeline.published(tag, confirmed)
+        confirms[1].set_result(False)
+        confirms[2].set_result(True)
+        confirms[0].set_result(True)
+        await asyncio.sleep(0)
+
+    pipeline, channel = run_pipeline(steps)
+    assert channel.calls == [("ack", 1, True), ("nack", 2, False), ("ack", 3, True)]
+    assert pipeline.requeued == 1
+    assert pipeline.forwarded == 2
+
+def test_a_skipped_input_waits_for_the_ones_before_it():
+    forwarded = list()
+
+    async def steps(pipeline, loop):
+        pipeline.on_forwarded = forwarded.append
+        confirmed = loop.create_future()
+        pipeline.published(1, confirmed, correlation_id="c1")
+        pipeline.skipped(2)
+        assert pipeline.acks.channel.calls == []
+        confirmed.set_result(True)
+        await asyncio.sleep(0)
+
+    pipeline, channel = run_pipeline(steps)
+    assert channel.calls == [("ack", 2, True)]
+    assert forwarded == ["c1"]
+    assert pipeline.forwarded == 1
+
+def test_no_nack_on_a_closed_input_channel():
+    async def steps(pipeline, loop):
+        confirmed = loop.create_future()
+        pipeline.published(1, confirmed)
+        pipeline.acks.channel.is_open = False
+        confirmed.set_result(False)
+        await asyncio.sleep(0)
+
+    pipeline, channel = run_pipeline(steps)
+    assert channel.calls == []
+    assert pipeline.requeued == 0
+
+def test_reset_drops_entries_whose_confirms_arrive_later():
+    async def steps(pipeline, loop):
+        confirmed = loop.create_future()
+        pipeline.published(1, confirmed)
+        pipeline.reset()
+        confirmed.set_result(True)
+        await asyncio.sleep(0)
+
+    pipeline, channel = run_pipeline(steps)
+    assert channel.calls == []
+    assert pipeline.in_flight() == 0
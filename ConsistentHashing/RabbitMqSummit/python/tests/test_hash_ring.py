@@ -0,0 +1,63 @@
+import pytest
+import hash_ring
+from hash_ring import (HashRing, KeyBatch, phash2, route_hash, phash2_bulk, route_hash_bulk,
+                       PHASH2_RANGE, client_routing_problems, load_vectors, uses_point_ring)
+
+# every tail length of the 12 byte blocks and a few full blocks
+KEYS = ["", "a", "key1", "state-updates"] + ["x" * length for length in range(1, 40)] + [f"k{i}" for i in range(200)]
+
+def test_hashes_are_in_range():
+    for key in KEYS:
+        assert 0 <= phash2(key) < PHASH2_RANGE
+        assert 0 <= route_hash(key) < PHASH2_RANGE
+        assert phash2(key, 1 << 8) == phash2(key) & 0xff
+
+def test_bulk_hashes_match_the_scalar_ones():
+    assert list(phash2_bulk(KEYS)) == [phash2(key) for key in KEYS]
+    assert list(route_hash_bulk(KEYS)) == [route_hash(key) for key in KEYS]
+
+def test_key_batch_of_ints_matches_the_text_keys():
+    values = [0, 7, 10, 99, 12345, 10 ** 9]
+    assert list(route_hash_bulk(KeyBatch.from_ints(values, prefix="k"))) == [route_hash(f"k{v}") for v in values]
+
+def test_ring_routes_to_the_first_point_at_or_after_the_hash():
+    ring = HashRing([(100, "q2"), (10, "q1"), (1000, "q3")])
+    assert ring.queues[ring.owner_of_hash(0)] == "q1"
+    assert ring.queues[ring.owner_of_hash(10)] == "q1"
+    assert ring.queues[ring.owner_of_hash(11)] == "q2"
+    assert ring.queues[ring.owner_of_hash(1000)] == "q3"
+    assert ring.queues[ring.owner_of_hash(1001)] == "q1"
+
+def test_bulk_routing_matches_queue_for():
+    ring = HashRing.random_ring([f"q{i}" for i in range(5)], 10, seed=3)
+    assert len(ring.points) == 50
+    assert ring.queues_for(KEYS) == [ring.queue_for(key) for key in KEYS]
+
+def test_versions_after_3_7_7_are_not_modelled():
+    assert uses_point_ring("3.7.7")
+    assert uses_point_ring("3.6.16")
+    assert not uses_point_ring("3.7.8")
+    assert not uses_point_ring("3.8.0-rc.1")
+
+def test_client_routing_is_refused_without_vectors():
+    assert client_routing_problems("3.7.7", None)
+    assert "jump consistent hashing" in client_routing_problems("3.8.0", None)[0]
+
+def test_vectors_that_disagree_are_reported():
+    ring = HashRing.random_ring(["q1", "q2"], 10, seed=1)
+    vectors = {"rabbitmq_version": "3.7.7",
+               "hashes": [{"key": "a", "phash2": phash2("a"), "route_hash": route_hash("a") ^ 1}],
+               "ring": [[point, ring.queues[owner]] for point, owner in zip(ring.points, ring.owners)],
+               "routes": [{"key": key, "queue": ring.queue_for(key)} for key in KEYS]}
+    problems = client_routing_problems("3.7.7", vectors)
+    assert len(problems) == 1 and "captured hashes differ" in problems[0]
+    vectors["hashes"][0]["route_hash"] = route_hash("a")
+    assert client_routing_problems("3.7.7", vectors) == []
+    assert "captured from RabbitMQ 3.7.7" in client_routing_problems("3.7.6", vectors)[0]
+
+# the known answers captured from a real node by cluster/capture-hash-vectors.py
+def test_known_answers_of_a_real_node():
+    vectors = load_vectors()
+    if vectors is None:
+        pytest.skip(f"no vectors captured in {hash_ring.VECTORS_FILE}")
+    assert client_routing_problems(vectors["rabbitmq_version"], vectors) == []
@@ -0,0 +1,80 @@
+import json
+from latency_histogram import LatencyHistogram, PipelineLatencies, format_us
+
+def test_small_values_have_a_bucket_each():
+    histogram = LatencyHistogram()
+    for value in range(256):
+        assert histogram.index_of(value) == value
+        assert histogram.value_of(value) == value
+
+def test_indices_are_contiguous_and_monotonic():
+    histogram = LatencyHistogram()
+    previous = histogram.index_of(255)
+    for exponent in range(8, 32):
+        for value in [1 << exponent, (1 << exponent) + 1, (3 << exponent) // 2, (1 << (exponent + 1)) - 1]:
+            index = histogram.index_of(value)
+            assert index >= previous
+            previous = index
+    assert histogram.index_of(256) == 256
+    assert histogram.index_of(511) == 383
+    assert histogram.index_of(512) == 384
+
+def test_a_value_is_within_the_precision_of_its_bucket():
+    histogram = LatencyHistogram()
+    for value in [256, 300, 1000, 12345, 999999, 3600 * 1000000]:
+        low = histogram.value_of(histogram.index_of(value))
+        high = histogram.value_of(histogram.index_of(value) + 1)
+        assert low <= value < high
+        assert (high - low) / value <= 1 / 128
+
+def test_percentiles():
+    histogram = LatencyHistogram()
+    for value in range(1, 1001):
+        histogram.record(value)
+    assert histogram.percentile(50) in range(496, 505)
+    assert histogram.percentile(99) in range(984, 995)
+    assert histogram.percentile(100) == 1000
+    assert histogram.max == 1000
+
+def test_out_of_range_values_are_clamped():
+    histogram = LatencyHistogram(max_us=1000000)
+    histogram.record(-5)
+    histogram.record(10 ** 9)
+    assert histogram.counts[0] == 1
+    assert histogram.max == 1000000
+    assert histogram.percentile(100) == 1000000
+
+def test_merge_and_state_round_trip():
+    first = LatencyHistogram()
+    second = LatencyHistogram()
+    for value in range(100):
+        first.record(value)
+        second.record((value + 1) * 1000)
+    merged = LatencyHistogram()
+    merged.merge(first)
+    merged.merge_state(json.loads(json.dumps(second.state())))
+    assert merged.count == 200
+    assert merged.max == 100000
+    assert merged.percentile(50) == first.percentile(100)
+
+def test_pipeline_hops():
+    latencies = PipelineLatencies(max_keys=1)
+    publish_ns = 1000000000
+    latencies.record(b"a", publish_ns, publish_ns + 2000000, publish_ns + 2005000, publish_ns + 3000000)
+    latencies.record(b"b", publish_ns, None, None, publish_ns + 1000)
+    assert latencies.run["end to end"].count == 2
+    assert latencies.run["queue"].percentile(100) == 2000
+    assert latencies.run["processing"].percentile(100) == 5
+    assert latencies.run["output queue"].count == 1
+    assert list(latencies.per_key) == [b"a"]
+    assert latencies.keys_dropped == 1
+
+    merged = PipelineLatencies()
+    merged.merge_state(json.loads(json.dumps(latencies.state())))
+    assert merged.run["end to end"].count == 2
+    assert merged.per_key[b"a"].count == 1
+
+def test_format_us():
+    assert format_us(999) == "999us"
+    assert format_us(1500) == "1.5ms"
+    assert format_us(2500000) == "2.50s"
@@ -0,0 +1,77 @@
+import pytest
+from pika import spec
+from message_template import MessageTemplate, EncodedProperties, CorrelationIds
+
+def encoded(properties):
+    return b"".join(properties.encode())
+
+def decoded(data):
+    properties = spec.BasicProperties()
+    properties.decode(data)
+    return properties
+
+def test_fixed_fields_encode_like_pika():
+    fixed = dict(content_type="text/plain", delivery_mode=2, app_id="test", headers={"a": "b"})
+    assert encoded(MessageTemplate(**fixed)) == encoded(spec.BasicProperties(**fixed))
+
+def test_variable_fields_encode_like_pika():
+    template = MessageTemplate(content_type="text/plain", delivery_mode=2, message_id="m",
+                               variable_correlation_id=True, int_headers=["publish_ns", "other"])
+    for correlation_id, publish_ns in [("abc-1", 1 << 40), ("abc-22", 1 << 62)]:
+        template.correlation_id = correlation_id
+        template.headers["publish_ns"] = publish_ns
+        template.headers["other"] = 5 << 33
+        expected = spec.BasicProperties(content_type="text/plain", delivery_mode=2, message_id="m",
+                                        correlation_id=correlation_id,
+                                        headers={"publish_ns": publish_ns, "other": 5 << 33})
+        assert encoded(template) == encoded(expected)
+
+def test_small_int_headers_decode_to_the_same_values():
+    template = MessageTemplate(variable_correlation_id=True, int_headers=["publish_ns"])
+    template.correlation_id = "id"
+    template.headers["publish_ns"] = 7
+    properties = decoded(encoded(template))
+    assert properties.correlation_id == "id"
+    assert properties.headers == {"publish_ns": 7}
+    assert properties.content_type is None
+
+def test_headers_round_trip_through_pika_decode():
+    template = MessageTemplate(content_type="text/plain", delivery_mode=2,
+                               variable_correlation_id=True, int_headers=["publish_ns", "other"])
+    template.correlation_id = "abc-1"
+    cases = [{"publish_ns": 1 << 62, "other": 0},
+             # anything but non negative ints is left to pika's own encoding
+             {"publish_ns": "text", "other": 1},
+             {"publish_ns": True, "other": False},
+             {"publish_ns": -5, "other": 1},
+             {"publish_ns": 1, "other": 2, "extra": b"bytes"},
+             {"other": 2}]
+    for headers in cases:
+        template.headers = dict(headers)
+        properties = decoded(encoded(template))
+        assert properties.headers == headers
+        # True == 1, so the bools are compared apart
+        assert [name for name, value in properties.headers.items() if isinstance(value, bool)] == \
+            [name for name, value in headers.items() if isinstance(value, bool)]
+        assert properties.correlation_id == "abc-1"
+        assert (properties.content_type, properties.delivery_mode) == ("text/plain", 2)
+
+def test_frozen_copies_keep_the_values_at_freeze_time():
+    template = MessageTemplate(content_type="x", variable_correlation_id=True)
+    template.correlation_id = "first"
+    frozen = template.freeze()
+    template.correlation_id = "second"
+    assert isinstance(frozen, EncodedProperties)
+    assert decoded(encoded(frozen)).correlation_id == "first"
+    assert frozen.encode() is not frozen.encode()
+
+def test_fixed_headers_can_not_be_combined_with_int_headers():
+    with pytest.raises(ValueError):
+        MessageTemplate(headers={"a": 1}, int_headers=["b"])
+
+def test_correlation_ids_are_unique_per_generator():
+    first = CorrelationIds()
+    second = CorrelationIds()
+    ids = [first.next() for _ in range(3)] + [second.next() for _ in range(3)]
+    assert len(set(ids)) == 6
+    assert CorrelationIds(prefix="p-").next() == "p-1"
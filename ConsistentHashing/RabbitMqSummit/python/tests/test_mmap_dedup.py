@@ -0,0 +1,69 @@
+import time
+import uuid
+from mmap_dedup import MappedDedupLog, HEADER, SLOT
+
+def test_mapped_log_survives_a_restart(tmpdir):
+    path = str(tmpdir.join("dedup.log"))
+    ids = [str(uuid.uuid4()) for _ in range(500)] + [f"counter-{i}" for i in range(500)]
+    start = time.time()
+    log = MappedDedupLog(path, window_sec=100, slot_count=2000)
+    for i, correlation_id in enumerate(ids):
+        assert not log.seen(correlation_id, now=start + i / 100)
+    log.close()
+
+    reloaded = MappedDedupLog(path, window_sec=100, slot_count=2000)
+    assert reloaded.loaded == len(ids)
+    assert all(reloaded.contains(correlation_id, now=start + 50) for correlation_id in ids)
+    assert not reloaded.contains("never-seen", now=start + 50)
+    assert len(reloaded) == len(ids)
+    reloaded.close()
+
+def test_mapped_log_reload_skips_expired_slots(tmpdir):
+    path = str(tmpdir.join("dedup.log"))
+    log = MappedDedupLog(path, window_sec=100, slot_count=10)
+    log.add("old", now=1)
+    log.close()
+    reloaded = MappedDedupLog(path, window_sec=100, slot_count=10)
+    assert reloaded.loaded == 0
+    assert not reloaded.contains("old")
+    reloaded.close()
+
+def test_mapped_log_does_not_trust_a_slot_written_over_since_the_reload(tmpdir):
+    path = str(tmpdir.join("dedup.log"))
+    start = time.time()
+    log = MappedDedupLog(path, window_sec=100, slot_count=4)
+    for correlation_id in ["a", "b", "c", "d"]:
+        log.add(correlation_id, now=start)
+    log.close()
+
+    reloaded = MappedDedupLog(path, window_sec=100, slot_count=4)
+    # the ring is full, so the next id goes into the slot of "a"
+    reloaded.add("e", now=start + 1)
+    assert reloaded.overwritten == 1
+    assert not reloaded.contains("a", now=start + 2)
+    assert reloaded.contains("b", now=start + 2)
+    assert reloaded.contains("e", now=start + 2)
+    reloaded.close()
+
+def test_mapped_log_drops_the_loaded_ids_once_all_expired(tmpdir):
+    path = str(tmpdir.join("dedup.log"))
+    start = time.time()
+    log = MappedDedupLog(path, window_sec=100, slot_count=10)
+    log.add("a", now=start)
+    log.close()
+
+    reloaded = MappedDedupLog(path, window_sec=100, slot_count=10)
+    assert reloaded.contains("a", now=start + 50)
+    assert not reloaded.contains("a", now=start + 101)
+    assert len(reloaded.loaded_slots) == 0
+    reloaded.close()
+
+def test_mapped_log_starts_over_with_another_slot_count(tmpdir):
+    path = str(tmpdir.join("dedup.log"))
+    log = MappedDedupLog(path, window_sec=100, slot_count=10)
+    log.add("a")
+    log.close()
+    resized = MappedDedupLog(path, window_sec=100, slot_count=20)
+    assert resized.loaded == 0
+    assert resized.mm.size() == HEADER.size + 20 * SLOT.size
+    resized.close()
@@ -0,0 +1,89 @@
+from order_verifier import OrderVerifier
+
+def verify_all(verifier, bodies):
+    for body in bodies:
+        verifier.verify(body)
+
+def test_counts_every_kind_of_ordering_event():
+    verifier = OrderVerifier()
+    verify_all(verifier, [b"a=1", b"a=2", b"a=5", b"a=3", b"a=3", b"b=1"])
+    assert verifier.totals() == (3, 1, 1, 1)
+    slot = verifier.slots[b"a"]
+    assert verifier.last[slot] == 3
+    assert verifier.max_jump[slot] == 3
+    assert verifier.messages == 6
+
+def test_invalid_bodies_are_counted_apart():
+    verifier = OrderVerifier()
+    assert verifier.verify(b"no separator") is None
+    assert verifier.verify(b"a=x") is None
+    assert verifier.verify(b"a=-1") is None
+    assert verifier.verify(b"a=1") == b"a"
+    assert verifier.invalid == 3
+    assert verifier.messages == 1
+
+def test_binary_key_ids():
+    verifier = OrderVerifier()
+    for value in range(1, 2001):
+        verifier.verify_value(7, value)
+    assert verifier.totals() == (2000, 0, 0, 0)
+    assert "every key was received in order" in verifier.report()
+
+def test_values_beyond_the_first_bitmap():
+    verifier = OrderVerifier()
+    verify_all(verifier, [b"k=%d" % value for value in range(1, 5001)])
+    assert verifier.totals() == (5000, 0, 0, 0)
+    verify_all(verifier, [b"k=4000"])
+    assert verifier.totals() == (5000, 0, 0, 1)
+
+def test_missing_values():
+    verifier = OrderVerifier()
+    verify_all(verifier, [b"a=1", b"a=2", b"a=4", b"a=9"])
+    assert verifier.missing(b"a", 4) == 1
+    assert verifier.missing(b"a", 9) == 5
+    assert verifier.missing(b"a", 20) == 16
+    assert verifier.missing(b"a", 0) == 0
+    assert verifier.missing(b"unknown", 3) == 3
+
+def test_missing_across_bitmap_growth():
+    verifier = OrderVerifier()
+    for value in range(1, 5001):
+        if value % 1000:
+            verifier.verify_value(1, value)
+    assert verifier.missing(1, 5000) == 5
+    assert verifier.missing(1, 999) == 0
+
+def test_values_far_beyond_the_last_are_invalid():
+    verifier = OrderVerifier(max_window=1000)
+    verify_all(verifier, [b"k1=1000000000000", b"k2=1", b"k2=1001", b"k2=1000"])
+    verifier.verify_value(7, 1 << 63)
+    assert verifier.invalid == 2
+    assert verifier.messages == 3
+    assert b"k1" not in verifier.slots and 7 not in verifier.slots
+    assert verifier.totals() == (1, 1, 1, 0)
+    assert max(len(seen) for seen in verifier.seen) <= 256
+    assert verifier.missing(b"k2", 1001) == 998
+
+def test_merged_states_add_up():
+    first = OrderVerifier()
+    verify_all(first, [b"a=1", b"a=2", b"a=2"])
+    first.verify_value(3, 1)
+    second = OrderVerifier()
+    verify_all(second, [b"b=1", b"b=3", b"\xff=1"])
+
+    merged = OrderVerifier()
+    merged.merge(first.state())
+    merged.merge(second.state())
+    assert merged.messages == 7
+    assert merged.totals() == (5, 1, 0, 1)
+    assert set(merged.key_names) == {b"a", 3, b"b", b"\xff"}
+    assert merged.last[merged.slots[b"b"]] == 3
+
+def test_report_lists_the_worst_keys_first():
+    verifier = OrderVerifier()
+    verify_all(verifier, [b"a=1", b"a=3", b"b=2", b"b=1", b"b=1", b"c=1"])
+    lines = verifier.report().splitlines()
+    assert lines[0] == verifier.summary()
+    assert lines[1].startswith("  b: last 1")
+    assert lines[2].startswith("  a: last 3")
+    assert len(lines) == 3
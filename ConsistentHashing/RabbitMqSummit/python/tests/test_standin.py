@@ -0,0 +1,157 @@
+import socket
+import asyncio
+import collections
+import pytest
+from standin_broker import StandInBroker
+from rabbit_client import RabbitConnection, Publisher, Consumer, ChannelError, run_publisher, cluster_node_names
+from order_verifier import OrderVerifier
+from hash_ring import HashRing
+
+# End to end through the stand-in broker (standin/standin_broker.py), which runs
+# on the test's own event loop next to the clients.
+
+# pika 0.12 (requirements.txt) calls collections.Callable, which Python 3.10
+# removed, so the clients and the stand-in need Python 3.9 or older
+pytestmark = pytest.mark.skipif(not hasattr(collections, "Callable"), reason="pika 0.12 needs Python < 3.10")
+
+NODE_COUNT = 3
+
+def free_base_port():
+    for base_port in range(35672, 45672, 10):
+        sockets = list()
+        try:
+            for port in range(base_port, base_port + NODE_COUNT):
+                s = socket.socket()
+                sockets.append(s)
+                s.bind(("127.0.0.1", port))
+            return base_port
+        except OSError:
+            pass
+        finally:
+            for s in sockets:
+                s.close()
+    raise RuntimeError("no free ports for the stand-in broker")
+
+def run_with_broker(scenario):
+    async def main():
+        broker = await StandInBroker(NODE_COUNT, base_port=free_base_port(), seed=1).start()
+        try:
+            return await asyncio.wait_for(scenario(broker), timeout=30)
+        finally:
+            await broker.stop()
+    return asyncio.run(main())
+
+def node_addresses(broker):
+    return list(broker.addresses().values())
+
+async def declare_queue(connection, chan, queue):
+    await connection.rpc(chan, chan.queue_declare, queue=queue, durable=True)
+
+# consumes and acks count messages of a queue, returns their bodies
+async def drain(connection, queue, count):
+    bodies = list()
+    consumer = await Consumer(connection, queue, prefetch=100).open()
+    while len(bodies) < count:
+        delivery = await asyncio.wait_for(consumer.__anext__(), timeout=5)
+        bodies.append(delivery.body)
+        consumer.ack(delivery.delivery_tag)
+    return bodies
+
+
+def test_publish_consume_verify_through_a_hash_exchange():
+    keys = ["a", "b", "c", "d", "e"]
+    queues = ["states001", "states002", "states003"]
+
+    async def scenario(broker):
+        connection = await RabbitConnection(node_addresses(broker)[0]).open()
+        try:
+            chan = await connection.channel()
+            await connection.rpc(chan, chan.exchange_declare, exchange="states", exchange_type="x-consistent-hash")
+            for queue in queues:
+                await declare_queue(connection, chan, queue)
+                await connection.rpc(chan, chan.queue_bind, queue=queue, exchange="states", routing_key="10")
+
+            publisher = await Publisher(connection).open()
+            for value in range(1, 201):
+                for key in keys:
+                    await publisher.publish(exchange="states", routing_key=key, body=f"{key}={value}".encode('utf-8'))
+            await publisher.wait_for_confirms()
+
+            ring = HashRing(broker.exchanges["states"].ring_points())
+            expected = {queue: [key for key in keys if ring.queue_for(key) == queue] for queue in queues}
+            verifier = OrderVerifier()
+            for queue in queues:
+                for body in await drain(connection, queue, 200 * len(expected[queue])):
+                    key = verifier.verify(body)
+                    assert key.decode('utf-8') in expected[queue]
+            return publisher, verifier
+        finally:
+            await connection.close()
+
+    publisher, verifier = run_with_broker(scenario)
+    assert publisher.acked == 1000
+    assert verifier.messages == 1000
+    assert verifier.totals() == (1000, 0, 0, 0)
+    assert all(verifier.missing(key.encode('utf-8'), 200) == 0 for key in keys)
+
+def test_publisher_republishes_what_a_killed_node_left_unconfirmed():
+    count = 1000
+    position = [0]
+    killed = list()
+
+    async def scenario(broker):
+        addresses = node_addresses(broker)
+        connection = await RabbitConnection(addresses[1]).open()
+        chan = await connection.channel()
+        await declare_queue(connection, chan, "sequence")
+        await connection.close()
+
+        # publish_messages is called again on every new connection, so it keeps
+        # its own position, which only moves on once a publish went out
+        async def publish_messages(publisher):
+            while position[0] < count:
+                if position[0] == count // 2 and not killed:
+                    killed.append(position[0])
+                    await broker.kill_node("rabbitmq1")
+                await publisher.publish(exchange="", routing_key="sequence",
+                                        body=f"k={position[0] + 1}".encode('utf-8'))
+                position[0] += 1
+
+        stats = await run_publisher(addresses, cluster_node_names(NODE_COUNT), 0, publish_messages)
+
+        connection = await RabbitConnection(addresses[1]).open()
+        try:
+            queued = len(broker.queues["sequence"].messages)
+            return stats, queued, await drain(connection, "sequence", queued)
+        finally:
+            await connection.close()
+
+    stats, queued, bodies = run_with_broker(scenario)
+    assert killed == [count // 2]
+    assert stats.failovers == 1
+    verifier = OrderVerifier()
+    for body in bodies:
+        verifier.verify(body)
+    # duplicates of messages whose confirm was lost are allowed, gaps and reordering are not
+    assert queued >= count
+    assert verifier.missing(b"k", count) == 0
+    in_order, jump_forward, jump_back, duplicates = verifier.totals()
+    assert (in_order, jump_forward, jump_back) == (count, 0, 0)
+    assert duplicates == queued - count
+
+def test_a_channel_error_stops_the_publisher_without_failing_over():
+    calls = [0]
+
+    async def scenario(broker):
+        async def publish_messages(publisher):
+            calls[0] += 1
+            await publisher.publish(exchange="no-such-exchange", routing_key="k", body=b"k=1")
+            await publisher.wait_for_confirms()
+
+        with pytest.raises(ChannelError) as raised:
+            await run_publisher(node_addresses(broker), cluster_node_names(NODE_COUNT), 0, publish_messages)
+        return str(raised.value)
+
+    error = run_with_broker(scenario)
+    assert "404" in error and "no-such-exchange" in error
+    assert calls[0] == 1
@@ -0,0 +1,32 @@
+import time
+import asyncio
+from token_bucket import TokenBucket
+
+def test_token_bucket_holds_the_rate():
+    async def take(bucket, count):
+        started = time.monotonic()
+        for _ in range(count):
+            await bucket.take()
+        return time.monotonic() - started
+
+    bucket = TokenBucket(1000)
+    elapsed = asyncio.run(take(bucket, 300))
+    # the first burst (10 messages) is free, the other 290 take 0.29s
+    assert 0.25 < elapsed < 0.6
+    assert bucket.waits > 0
+
+def test_token_bucket_does_not_wait_within_the_burst():
+    async def take(bucket):
+        for _ in range(50):
+            await bucket.take()
+
+    bucket = TokenBucket(10, burst=50)
+    asyncio.run(take(bucket))
+    assert bucket.waits == 0
+
+def test_token_bucket_refills_up_to_the_burst():
+    bucket = TokenBucket(100000, burst=5)
+    bucket.tokens = 0
+    time.sleep(0.01)
+    bucket.refill()
+    assert bucket.tokens == 5